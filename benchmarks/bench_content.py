@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark content assertion matching
+
+Compares :py:meth:`ValidatorSpecRule.matches` against the previous matching
+loop, which tested each ``present`` and ``absent`` value against
+``resp.text``, decoding the response body once per assertion. Run with::
+
+    python benchmarks/bench_content.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import random
+import string
+import timeit
+
+from requests import Response
+
+from validatehttp.spec import ValidatorSpecRule
+
+
+def build_response(size, charset=None):
+    """Build response with a random body of roughly ``size`` bytes"""
+    rand = random.Random(42)
+    words = [
+        "".join(rand.choice(string.ascii_lowercase) for _ in range(rand.randint(3, 10)))
+        for _ in range(5000)
+    ]
+    body = []
+    length = 0
+    while length < size:
+        word = rand.choice(words)
+        body.append(word)
+        length += len(word) + 1
+    resp = Response()
+    resp.status_code = 200
+    resp.headers = {}
+    if charset is not None:
+        resp.headers["content-type"] = "text/html; charset={0}".format(charset)
+        resp.encoding = charset
+    resp._content = " ".join(body).encode("utf-8")
+    return (resp, words)
+
+
+def previous_match(content, resp):
+    """Content matching loop as it was before assertions were compiled"""
+    for status, contents in content.items():
+        for value in contents:
+            if status == "present" and value not in resp.text:
+                raise ValueError(value)
+            if status == "absent" and value in resp.text:
+                raise ValueError(value)
+
+
+def main():
+    for size in (100 * 1024, 2 * 1024 * 1024):
+        for charset in ("utf-8", None):
+            (resp, words) = build_response(size, charset)
+            content = {
+                "present": words[:20],
+                "absent": ['<div class="missing-{0}">'.format(n) for n in range(20)],
+            }
+            rule = ValidatorSpecRule("http://example.com", content=content)
+            number = 3
+            previous = timeit.timeit(lambda: previous_match(content, resp), number=number)
+            current = timeit.timeit(lambda: rule.matches(resp), number=number)
+            print(
+                "{size:>8} bytes, charset {charset:<5}: "
+                "previous {previous:8.2f}ms, current {current:8.2f}ms, {speedup:6.1f}x".format(
+                    size=size,
+                    charset=charset or "none",
+                    previous=previous / number * 1000,
+                    current=current / number * 1000,
+                    speedup=previous / current,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
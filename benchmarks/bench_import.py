@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark import time of each entry point, against a regression budget
+
+Runs each console script entry point in a fresh interpreter with ``-X
+importtime``, loading a JSON spec as a check would, and totals the time spent
+importing modules, less the imports of a bare interpreter. Exits with status
+1 if the best time of any entry point is over its budget. Run with::
+
+    python benchmarks/bench_import.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+# Import time budget of each entry point, in milliseconds. Most of the time
+# goes to requests and pynag, which can't be deferred.
+BUDGETS = [
+    ("validatehttp", "from validatehttp.cli import ValidatorCLI", 200),
+    ("check_validatehttp", "from validatehttp.nagios import CheckURLSpecPlugin", 300),
+    ("check_validatehttp_client", "from validatehttp.client import CheckClient", 30),
+]
+
+# Load a JSON spec, as the entry points do before running
+LOAD_SPEC = "from validatehttp.validate import Validator; Validator.load({0!r})"
+
+RUNS = 9
+
+
+def get_import_time(code):
+    """Return microseconds spent importing modules for running code"""
+    # Installed interpreters run from cached byte code
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stderr
+    total = 0
+    for line in output.splitlines():
+        if line.startswith("import time:") and not line.endswith("imported package"):
+            try:
+                total += int(line.split("|")[0].split(":")[1])
+            except ValueError:
+                continue
+    return total
+
+
+def get_best(code):
+    """Return best import time of code over several runs, in milliseconds
+
+    The best run is the least disturbed by other processes.
+    """
+    return min(get_import_time(code) for _ in range(RUNS)) / 1000.0
+
+
+def main():
+    (fd, spec_path) = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as handle:
+        json.dump({"https://example.com/": {"status_code": 200}}, handle)
+    entry_points = []
+    for name, code, budget in BUDGETS:
+        if "client" not in name:
+            code = "; ".join([code, LOAD_SPEC.format(spec_path)])
+        entry_points.append((name, code, budget))
+    try:
+        # Warm up, so that the byte code is cached for all runs
+        for _, code, _ in entry_points:
+            get_import_time(code)
+        baseline = get_best("pass")
+        failed = False
+        for name, code, budget in entry_points:
+            elapsed = get_best(code) - baseline
+            over = elapsed > budget
+            failed = failed or over
+            print(
+                "{0:<28} {1:8.1f}ms  (budget {2}ms){3}".format(
+                    name, elapsed, budget, "  OVER BUDGET" if over else ""
+                )
+            )
+    finally:
+        os.unlink(spec_path)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark request preparation and matching for repeated runs
+
+Compares building and preparing a request from the spec rule on every
+request, against copying the prepared request template of a compiled rule.
+Run with::
+
+    python benchmarks/bench_prepare.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import timeit
+
+from requests import Response
+
+from validatehttp.spec import ValidatorSpecRule
+
+
+def main():
+    rule = ValidatorSpecRule(
+        "https://example.com/en/latest/some/page.html?query=value",
+        request={"headers": {"Accept-Language": "en", "X-Forwarded-Proto": "https"}},
+        status_code=200,
+        headers={"Cache-Control": "max-age=600", "Content-Type": "text/html"},
+    )
+    compiled = rule.compile()
+    resp = Response()
+    resp.status_code = 200
+    resp.headers["Cache-Control"] = "max-age=600"
+    resp.headers["Content-Type"] = "text/html"
+
+    number = 20000
+    timings = [
+        ("get_request().prepare()", lambda: rule.get_request("10.0.0.1", 8080).prepare()),
+        ("compile().prepare()", lambda: rule.compile().prepare("10.0.0.1", 8080)),
+        ("compiled.matches()", lambda: compiled.matches(resp)),
+    ]
+    for name, func in timings:
+        elapsed = timeit.timeit(func, number=number)
+        print("{0:<26} {1:8.2f}us".format(name, elapsed / number * 1000000))
+
+
+if __name__ == "__main__":
+    main()
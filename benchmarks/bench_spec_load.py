@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark loading large YAML spec files
+
+Times cold loads with the pure Python YAML loader, cold loads with the libyaml
+loader, and warm loads from the parsed spec cache, for generated specs of 1k,
+10k and 100k rules. Run with::
+
+    python benchmarks/bench_spec_load.py [rules ...]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+from mock import patch
+
+from validatehttp.spec import YamlValidatorSpec
+
+
+def write_spec(path, count):
+    """Write spec file with ``count`` rules"""
+    with open(path, "w") as handle:
+        for n in range(count):
+            handle.write(
+                "http://example.com/en/latest/page-{0}.html:\n"
+                "  request:\n"
+                "    headers:\n"
+                "      Accept-Language: en\n"
+                "  status_code: 200\n"
+                "  headers:\n"
+                "    Cache-Control: max-age=600\n"
+                "  content:\n"
+                "    present:\n"
+                "      - 'Page {0}'\n".format(n)
+            )
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(counts):
+    path = tempfile.mkdtemp()
+    try:
+        for count in counts:
+            spec_file = os.path.join(path, "spec-{0}.yaml".format(count))
+            cache_dir = os.path.join(path, "cache")
+            write_spec(spec_file, count)
+            with patch.object(yaml, "CSafeLoader", yaml.SafeLoader):
+                python = timed(lambda: YamlValidatorSpec.load(spec_file))
+            libyaml = None
+            if getattr(yaml, "__with_libyaml__", False):
+                libyaml = timed(lambda: YamlValidatorSpec.load(spec_file))
+            # First load populates the cache
+            YamlValidatorSpec.load(spec_file, cache_dir=cache_dir)
+            warm = timed(lambda: YamlValidatorSpec.load(spec_file, cache_dir=cache_dir))
+            print(
+                "{count:>7} rules: cold python {python:8.3f}s, cold libyaml {libyaml}, "
+                "warm cache {warm:8.3f}s".format(
+                    count=count,
+                    python=python,
+                    libyaml="n/a" if libyaml is None else "{0:8.3f}s".format(libyaml),
+                    warm=warm,
+                )
+            )
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main([int(count) for count in sys.argv[1:]] or [1000, 10000, 100000])
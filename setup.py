@@ -19,15 +19,20 @@ setup(
     author_email="aj@ohess.org",
     license="MIT",
     packages=find_packages(),
-    install_requires=["requests", "pyyaml", "termcolor"],
+    # --resolve relies on connection pool keys from requests 2.32, and on
+    # per-request TLS server names from aiohttp 3.9
+    install_requires=["requests>=2.32", "pyyaml", "termcolor"],
     extras_require={
         "Nagios": ["pynag"],
+        "Async": ["aiohttp>=3.9"],
     },
     tests_require=["pytest", "mock", "pyyaml"],
     test_suite="nose.collector",
     entry_points={
         "console_scripts": [
             "check_validatehttp=validatehttp.nagios:CheckURLSpecPlugin.run",
+            "check_validatehttp_client=validatehttp.client:CheckClient.cli",
+            "validatehttp-daemon=validatehttp.daemon:CheckDaemon.cli",
             "validatehttp=validatehttp.cli:ValidatorCLI.cli",
         ],
     },
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import gc
+import threading
+from unittest import TestCase
+from unittest import skipIf
+
+from validatehttp.spec import ValidationTimeout
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.validate import ValidationFail
+from validatehttp.validate import ValidationPass
+from validatehttp.validate import Validator
+
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if aiohttp is not None:
+    from validatehttp.aio import AsyncValidator
+    from validatehttp.aio import iterate
+
+
+class StandInServer(object):
+    """Minimal asyncio HTTP server, responding with the request path"""
+
+    def __init__(self):
+        self.server = None
+        self.requests = []
+        self.methods = {}
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        while True:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.IncompleteReadError:
+                break
+            lines = head.decode("latin-1").split("\r\n")
+            (method, path, _) = lines[0].split(" ")
+            self.requests.append((path, lines[1:]))
+            self.methods[path] = method
+            # aiohttp sends idempotent requests again once on dropped
+            # connections, before retries
+            if path == "/flaky" and len([r for r in self.requests if r[0] == path]) <= 2:
+                break
+            if path == "/bad-status":
+                writer.write(b"HTTP/1.1 OK\r\n\r\n")
+                await writer.drain()
+                break
+            if path == "/truncated":
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\npartial")
+                await writer.drain()
+                break
+            if path == "/slow":
+                await asyncio.sleep(0.3)
+            status = "404 Not Found" if path == "/missing" else "200 OK"
+            body = "Served {0}".format(path).encode("utf-8")
+            if path == "/big":
+                body = b"x" * (1024 * 1024)
+            writer.write(
+                "HTTP/1.1 {0}\r\nContent-Length: {1}\r\nX-Test: foobar\r\n\r\n".format(
+                    status, len(body)
+                ).encode("latin-1")
+                + (body if method != "HEAD" else b"")
+            )
+            await writer.drain()
+        writer.close()
+
+
+@skipIf(aiohttp is None, "aiohttp is not installed")
+class TestAsyncValidator(TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+
+    def run_validator(self, rules, **kwargs):
+        async def _run():
+            port = await self.server.start()
+            validator = AsyncValidator(
+                YamlValidatorSpec(rules), host="127.0.0.1", port=port, **kwargs
+            )
+            try:
+                return [result async for result in validator.validate()]
+            finally:
+                await self.server.stop()
+
+        return asyncio.run(_run())
+
+    def test_response_match(self):
+        """Responses from stand in server match rules"""
+        rules = [
+            ValidatorSpecRule(
+                "http://example.com/{0}".format(n),
+                status_code=200,
+                headers={"x-test": "foobar"},
+                content={"present": ["Served /{0}".format(n)]},
+            )
+            for n in range(20)
+        ]
+        results = self.run_validator(rules, concurrency=5)
+        self.assertEqual([result.rule for result in results], rules)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+        self.assertIn("Host: example.com", self.server.requests[0][1])
+
+    def test_response_mismatch(self):
+        """Mismatched status code fails"""
+        rules = [ValidatorSpecRule("http://example.com/missing", status_code=200)]
+        results = self.run_validator(rules)
+        self.assertIsInstance(results[0], ValidationFail)
+        self.assertEqual(results[0].mismatch(), (200, 404))
+
+    def test_connection_error(self):
+        """Refused connection fails"""
+
+        async def _run():
+            port = await self.server.start()
+            await self.server.stop()
+            rules = [ValidatorSpecRule("http://example.com/", status_code=200)]
+            validator = AsyncValidator(YamlValidatorSpec(rules), host="127.0.0.1", port=port)
+            return [result async for result in validator.validate()]
+
+        results = asyncio.run(_run())
+        self.assertIsInstance(results[0], ValidationFail)
+
+    def test_iterate(self):
+        """Async results can be consumed synchronously"""
+
+        async def _start():
+            return await self.server.start()
+
+        loop = asyncio.new_event_loop()
+        port = loop.run_until_complete(_start())
+        rules = [ValidatorSpecRule("http://example.com/", status_code=200)]
+        validator = AsyncValidator(YamlValidatorSpec(rules), host="127.0.0.1", port=port)
+        # Serve from a separate thread, as iterate() runs its own event loop
+        thread = threading.Thread(target=loop.run_forever)
+        thread.start()
+        try:
+            results = list(iterate(validator.validate()))
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.run_until_complete(self.server.stop())
+            loop.close()
+        self.assertIsInstance(results[0], ValidationPass)
+
+    def test_malformed_response(self):
+        """Malformed and truncated responses fail their rule, without stopping the run"""
+        rules = [
+            ValidatorSpecRule("http://example.com/bad-status", status_code=200),
+            ValidatorSpecRule("http://example.com/truncated", status_code=200, text="partial"),
+            ValidatorSpecRule("http://example.com/ok", status_code=200),
+        ]
+        results = self.run_validator(rules)
+        self.assertEqual(len(results), 3)
+        for result in results[:2]:
+            self.assertIsInstance(result, ValidationFail)
+            self.assertIsInstance(result.error, aiohttp.ClientError)
+        self.assertIsInstance(results[2], ValidationPass)
+
+    def test_timeout(self):
+        """Timed out requests fail with a timeout error"""
+        rules = [
+            ValidatorSpecRule("http://example.com/slow", status_code=200),
+            ValidatorSpecRule("http://example.com/fast", status_code=200),
+        ]
+        results = self.run_validator(rules, timeout=0.1)
+        self.assertIsInstance(results[0], ValidationFail)
+        self.assertIsInstance(results[0].error, ValidationTimeout)
+        self.assertIsInstance(results[1], ValidationPass)
+
+    def test_header_only(self):
+        """Header only rules don't download large response bodies"""
+        rules = [
+            ValidatorSpecRule("http://example.com/big", status_code=200),
+            ValidatorSpecRule("http://example.com/small", status_code=200),
+            ValidatorSpecRule("http://example.com/big", content={"present": ["xxx"]}),
+        ]
+        results = self.run_validator(rules, keep_responses=True, dedupe=False)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+        self.assertIsNone(results[0].response._content)
+        self.assertEqual(results[1].response.content, b"Served /small")
+        self.assertEqual(len(results[2].response.content), 1024 * 1024)
+
+    def test_head(self):
+        """Header only rules send HEAD requests"""
+        rules = [
+            ValidatorSpecRule("http://example.com/small", status_code=200),
+            ValidatorSpecRule("http://example.com/body", content={"present": ["Served"]}),
+        ]
+        results = self.run_validator(rules, head=True)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+        self.assertEqual(self.server.methods, {"/small": "HEAD", "/body": "GET"})
+
+    def test_retry(self):
+        """Dropped connections are retried, and results count the attempts"""
+        rules = [ValidatorSpecRule("http://example.com/flaky", status_code=200)]
+        (result,) = self.run_validator(rules, retries=2, retry_backoff=0.01)
+        self.assertIsInstance(result, ValidationPass)
+        self.assertEqual(result.attempts, 2)
+        self.assertEqual([path for (path, _) in self.server.requests], ["/flaky"] * 3)
+
+    def test_max_failures(self):
+        """Validation stops after the maximum number of failures"""
+        rules = [
+            ValidatorSpecRule("http://example.com/{0}".format(n), status_code=404)
+            for n in range(20)
+        ]
+        results = self.run_validator(rules, concurrency=4, max_failures=2)
+        self.assertEqual(len(results), 2)
+        self.assertLess(len(self.server.requests), 20)
+
+    def test_resolve(self):
+        """Pinned host names connect to the pinned address"""
+
+        async def _run():
+            port = await self.server.start()
+            rules = [ValidatorSpecRule("http://pinned.invalid:{0}/".format(port), status_code=200)]
+            validator = AsyncValidator(
+                YamlValidatorSpec(rules), resolve={("pinned.invalid", port): ["127.0.0.1"]}
+            )
+            try:
+                return [result async for result in validator.validate()]
+            finally:
+                await self.server.stop()
+
+        (result,) = asyncio.run(_run())
+        self.assertIsInstance(result, ValidationPass)
+
+
+@skipIf(aiohttp is None, "aiohttp is not installed")
+class TestRunnerParity(TestCase):
+    """The threaded and async runners give the same results for bad responses"""
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.loop = asyncio.new_event_loop()
+        self.port = self.loop.run_until_complete(self.server.start())
+        # Serve from a separate thread, so both runners can run in this one
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+
+    def get_results(self, rules, **kwargs):
+        """Return comparable results of both runners, threaded first"""
+        validator = Validator(YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, **kwargs)
+        threaded = list(validator.validate())
+        validator.close()
+        # Sockets of responses that failed to parse are closed when collected
+        gc.collect()
+        validator = AsyncValidator(
+            YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, **kwargs
+        )
+        async_results = list(iterate(validator.validate()))
+        return [
+            [(result.rule.uri, type(result), result.attempts) for result in results]
+            for results in (threaded, async_results)
+        ]
+
+    def test_malformed_status(self):
+        """Malformed status lines fail the rule in both runners"""
+        rules = [
+            ValidatorSpecRule("http://example.com/bad-status", status_code=200),
+            ValidatorSpecRule("http://example.com/ok", status_code=200),
+        ]
+        for kwargs in ({}, {"retries": 1, "retry_backoff": 0.01}):
+            (threaded, async_results) = self.get_results(rules, **kwargs)
+            self.assertEqual(threaded, async_results)
+            self.assertEqual(threaded[0][1:], (ValidationFail, 1 + kwargs.get("retries", 0)))
+            self.assertEqual(threaded[1][1], ValidationPass)
+
+    def test_truncated_body(self):
+        """Bodies cut short of their content length fail the rule in both runners"""
+        rules = [
+            ValidatorSpecRule(
+                "http://example.com/truncated", status_code=200, content={"present": ["partial"]}
+            ),
+            ValidatorSpecRule("http://example.com/ok", status_code=200),
+        ]
+        for kwargs in ({}, {"retries": 1, "retry_backoff": 0.01}):
+            (threaded, async_results) = self.get_results(rules, **kwargs)
+            self.assertEqual(threaded, async_results)
+            self.assertEqual(threaded[0][1:], (ValidationFail, 1 + kwargs.get("retries", 0)))
+            self.assertEqual(threaded[1][1], ValidationPass)
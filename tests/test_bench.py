@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import TestCase
+
+from validatehttp.bench import LatencyHistogram
+from validatehttp.bench import LoadBench
+from validatehttp.bench import get_bucket
+from validatehttp.bench import get_bucket_range
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.validate import Validator
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        status = 404 if self.path == "/missing" else 200
+        self.send_response(status)
+        if self.path == "/truncated":
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"ok")
+            self.close_connection = True
+            return
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestLatencyHistogram(TestCase):
+    def test_buckets(self):
+        """Latencies fall in the bucket covering them, buckets are narrow"""
+        for value in list(range(0, 5000)) + [10**6, 10**9 + 7]:
+            (low, high) = get_bucket_range(get_bucket(value))
+            self.assertTrue(low <= value <= high, value)
+            self.assertLessEqual(high - low, max(value / 64.0, 0))
+
+    def test_percentiles(self):
+        """Percentiles are within the bucket precision"""
+        histogram = LatencyHistogram()
+        for n in range(1, 1001):
+            histogram.record(n / 1000.0)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.get_percentile(50), 0.5, delta=0.5 / 64)
+        self.assertAlmostEqual(histogram.get_percentile(99), 0.99, delta=0.99 / 64)
+        self.assertEqual(histogram.get_percentile(100), 1.0)
+        self.assertAlmostEqual(histogram.get_mean(), 0.5005, places=6)
+        self.assertLess(len(histogram.counts), 500)
+
+    def test_merge(self):
+        """Merged histograms count the latencies of both"""
+        first = LatencyHistogram()
+        second = LatencyHistogram()
+        first.record(0.001)
+        second.record(0.002)
+        second.record(0.003)
+        first.merge(second)
+        self.assertEqual(first.count, 3)
+        self.assertEqual((first.min, first.max), (1000, 3000))
+        self.assertIsNone(LatencyHistogram().get_percentile(50))
+
+    def test_write_distribution(self):
+        """Distribution ends at the 100th percentile"""
+        histogram = LatencyHistogram()
+        for n in range(10):
+            histogram.record(0.01 * (n + 1))
+        out = io.StringIO()
+        histogram.write_distribution(out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].strip().startswith("Value"))
+        self.assertIn("1.000000000000", lines[-3])
+        self.assertTrue(lines[-1].startswith("#[Buckets"))
+
+
+class TestLoadBench(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_validator(self, **kwargs):
+        rules = [
+            ValidatorSpecRule(self.base + "/ok", status_code=200, content={"present": ["ok"]}),
+            ValidatorSpecRule(self.base + "/missing", status_code=200),
+        ]
+        return Validator(YamlValidatorSpec(rules), **kwargs)
+
+    def test_iterations(self):
+        """Every request is matched and counted, without keeping results"""
+        validator = self.get_validator(concurrency=3)
+        bench = LoadBench(validator, iterations=5)
+        stats = bench.run()
+        validator.close()
+        self.assertEqual(stats.requests, 10)
+        self.assertEqual(stats.passes, 5)
+        self.assertEqual(stats.mismatches, 5)
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.latency.count, 10)
+        self.assertEqual(stats.bytes, 20)
+        self.assertEqual(dict(stats.failed_rules), {self.base + "/missing": 5})
+        out = io.StringIO()
+        bench.report(stats, out)
+        self.assertIn("10 requests in", out.getvalue())
+        self.assertIn("Mismatches:        5 (50.00%)", out.getvalue())
+
+    def test_rate(self):
+        """Requests are paced to the rate for the duration"""
+        validator = self.get_validator(concurrency=2)
+        stats = LoadBench(validator, duration=0.5, rate=20).run()
+        validator.close()
+        self.assertTrue(9 <= stats.requests <= 10, stats.requests)
+
+    def test_connection_errors(self):
+        """Requests that get no response are counted as errors"""
+        validator = Validator(
+            YamlValidatorSpec([ValidatorSpecRule("http://127.0.0.1:1/")]), timeout=1
+        )
+        stats = LoadBench(validator, iterations=2).run()
+        validator.close()
+        self.assertEqual((stats.requests, stats.errors), (2, 2))
+        self.assertEqual(stats.latency.count, 2)
+
+    def test_truncated(self):
+        """Responses cut short before the end of their body are counted as errors"""
+        rules = [
+            ValidatorSpecRule(
+                self.base + "/truncated", status_code=200, content={"present": ["ok"]}
+            )
+        ]
+        validator = Validator(YamlValidatorSpec(rules), timeout=1)
+        stats = LoadBench(validator, iterations=2).run()
+        validator.close()
+        self.assertEqual((stats.requests, stats.errors), (2, 2))
+        self.assertEqual(dict(stats.failed_rules), {self.base + "/truncated": 2})
+
+    def test_cli(self):
+        """Exit status is 1 on mismatches, and the histogram file is written"""
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        spec_file = os.path.join(tmp_dir, "spec.json")
+        histogram_file = os.path.join(tmp_dir, "latency.hgrm")
+        with open(spec_file, "w") as handle:
+            json.dump({self.base + "/ok": {"status_code": 200}}, handle)
+        argv = ["-f", spec_file, "-n", "3", "--histogram", histogram_file]
+        self.assertEqual(LoadBench.cli(argv), 0)
+        with open(histogram_file) as handle:
+            self.assertIn("Total count    =            3", handle.read())
+        with open(spec_file, "w") as handle:
+            json.dump({self.base + "/missing": {"status_code": 200}}, handle)
+        self.assertEqual(LoadBench.cli(argv), 1)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest import skipIf
+
+from validatehttp.cache import ResultCache
+from validatehttp.cache import atomic_write
+from validatehttp.cache import fcntl
+from validatehttp.cache import locked_file
+
+
+class TestAtomicWrite(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.path, "data", "file.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_replace(self):
+        """Files are replaced once written"""
+        with atomic_write(self.file_path) as handle:
+            handle.write("old")
+        with atomic_write(self.file_path) as handle:
+            handle.write("new")
+            with open(self.file_path) as current:
+                self.assertEqual(current.read(), "old")
+        with open(self.file_path) as current:
+            self.assertEqual(current.read(), "new")
+        self.assertEqual(os.listdir(os.path.dirname(self.file_path)), ["file.json"])
+
+    def test_failed_write(self):
+        """Failed writes leave the file as it was, without temporary files"""
+        with atomic_write(self.file_path) as handle:
+            handle.write("old")
+        with self.assertRaises(ValueError):
+            with atomic_write(self.file_path) as handle:
+                handle.write("partial")
+                raise ValueError("Failed")
+        with open(self.file_path) as current:
+            self.assertEqual(current.read(), "old")
+        self.assertEqual(os.listdir(os.path.dirname(self.file_path)), ["file.json"])
+
+    def test_mode(self):
+        """Files are private, unless given a mode"""
+        with atomic_write(self.file_path) as handle:
+            handle.write("private")
+        self.assertEqual(stat.S_IMODE(os.stat(self.file_path).st_mode), 0o600)
+        with atomic_write(self.file_path, mode=0o644) as handle:
+            handle.write("public")
+        self.assertEqual(stat.S_IMODE(os.stat(self.file_path).st_mode), 0o644)
+
+
+class TestResultCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.path, "cache", "results.json"), ttl=60)
+        self.key = ResultCache.get_key(b"spec", {"hosts": ["example.com"], "deadline": None})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_key(self):
+        """Checks of other specs or with other options have other keys"""
+        options = {"hosts": ["example.com"], "deadline": None}
+        keys = set(
+            [
+                self.key,
+                ResultCache.get_key(b"spec", dict(options)),
+                ResultCache.get_key(b"other", options),
+                ResultCache.get_key(b"spec", dict(options, hosts=["example.org"])),
+                ResultCache.get_key(b"spec", dict(options, deadline=10.0)),
+                ResultCache.get_key(b"spec", dict(options, port="8080")),
+            ]
+        )
+        self.assertEqual(len(keys), 5)
+
+    def test_get_or_run(self):
+        """Results are reused until they expire"""
+        runs = []
+
+        def run():
+            runs.append(None)
+            return {"code": 0, "run": len(runs)}
+
+        self.assertEqual(self.cache.get_or_run(self.key, run), {"code": 0, "run": 1})
+        self.assertEqual(self.cache.get_or_run(self.key, run), {"code": 0, "run": 1})
+        self.assertEqual(len(runs), 1)
+        self.cache.ttl = 0
+        self.assertEqual(self.cache.get_or_run(self.key, run), {"code": 0, "run": 2})
+
+    def test_merge(self):
+        """Results of other checks are kept, expired results are dropped"""
+        other = ResultCache.get_key(b"other", {"hosts": ["example.com"]})
+        self.cache.set(other, "other")
+        self.cache.set(self.key, "result")
+        self.assertEqual(self.cache.get(other), "other")
+        self.cache.ttl = 0.1
+        time.sleep(0.1)
+        self.cache.set(self.key, "result")
+        self.assertEqual(list(self.cache.read()), [self.key])
+
+    def test_corrupt_cache(self):
+        """Corrupt cache files are ignored"""
+        os.makedirs(os.path.dirname(self.cache.path))
+        with open(self.cache.path, "w") as handle:
+            handle.write("{garbage")
+        self.assertIsNone(self.cache.get(self.key))
+        self.assertEqual(self.cache.get_or_run(self.key, lambda: "result"), "result")
+
+    @skipIf(fcntl is None, "fcntl is not available")
+    def test_wait(self):
+        """Identical checks wait for the check in progress, and reuse its result"""
+        started = threading.Event()
+        finish = threading.Event()
+        runs = []
+
+        def run():
+            runs.append(None)
+            started.set()
+            finish.wait(5)
+            return "result"
+
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(self.cache.get_or_run(self.key, run))
+        )
+        first.start()
+        started.wait(5)
+        second = threading.Thread(
+            target=lambda: results.append(self.cache.get_or_run(self.key, run))
+        )
+        second.start()
+        time.sleep(0.2)
+        self.assertEqual(results, [])
+        finish.set()
+        first.join()
+        second.join()
+        self.assertEqual(results, ["result", "result"])
+        self.assertEqual(len(runs), 1)
+
+    @skipIf(fcntl is None, "fcntl is not available")
+    def test_wait_timeout(self):
+        """Checks stop waiting for the check in progress at the timeout"""
+        with locked_file(self.cache.get_lock_path(self.key)):
+            start = time.monotonic()
+            self.assertIsNone(self.cache.get_or_run(self.key, lambda: "result", timeout=0.2))
+            self.assertGreaterEqual(time.monotonic() - start, 0.2)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from unittest import skipIf
+
+from mock import patch
+from requests import Response
+
+from validatehttp.cache import ResultCache
+from validatehttp.cache import locked_file
+from validatehttp.client import CheckClient
+
+
+try:
+    from validatehttp.daemon import CheckDaemon
+    from validatehttp.nagios import UNSHARED_OPTIONS
+    from validatehttp.nagios import CheckURLSpecPlugin
+except ImportError:
+    CheckDaemon = None
+
+
+@skipIf(CheckDaemon is None, "pynag is not installed")
+class TestCheckDaemon(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spec_file = os.path.join(self.path, "spec.json")
+        self.write_spec(200, mtime=1000000000)
+        self.socket_path = os.path.join(self.path, "check.sock")
+        self.daemon = CheckDaemon(self.socket_path, spec_dirs=[self.path], state_dir=self.path)
+        self.thread = threading.Thread(target=self.daemon.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.client = CheckClient(self.socket_path, timeout=5)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        shutil.rmtree(self.path)
+
+    def write_spec(self, status_code, mtime):
+        with open(self.spec_file, "w") as handle:
+            json.dump({"http://example.com/": {"status_code": status_code}}, handle)
+        os.utime(self.spec_file, (mtime, mtime))
+
+    @patch("validatehttp.validate.Session.send")
+    def test_check(self, mock):
+        """Daemon returns plugin output and status code"""
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        (code, output) = self.client.request({"file": self.spec_file, "host": "127.0.0.1"})
+        self.assertEqual(code, 0)
+        self.assertTrue(output.startswith("OK: 1/1 Spec tests passed | "))
+        self.assertIn("'results'=1;;;;", output)
+        self.assertIn("'failures'=0;;;;1", output)
+
+        # Validator and connection pools are reused
+        self.client.request({"file": self.spec_file, "host": "127.0.0.1"})
+        self.assertEqual(len(self.daemon.validators), 1)
+
+    @patch("validatehttp.validate.Session.send")
+    def test_spec_reload(self, mock):
+        """Spec is reloaded when the spec file changes"""
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        (code, _) = self.client.request({"file": self.spec_file})
+        self.assertEqual(code, 0)
+        self.write_spec(404, mtime=1000000100)
+        (code, output) = self.client.request({"file": self.spec_file})
+        self.assertEqual(code, 2)
+        self.assertIn("spec http://example.com/ failed", output)
+
+    @patch("validatehttp.validate.Session.send")
+    def test_spec_reload_running(self, mock):
+        """Specs reloaded during a check are only used by later checks"""
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        self.client.request({"file": self.spec_file})
+        (((_, options), (validator, lock)),) = self.daemon.validators.items()
+        spec = validator.spec
+        self.write_spec(404, mtime=1000000100)
+        with lock:
+            (_, _, new_spec) = self.daemon.get_validator(self.spec_file, json.loads(options))
+            self.assertIsNot(new_spec, spec)
+            self.assertIs(validator.spec, spec)
+        (code, _) = self.client.request({"file": self.spec_file})
+        self.assertEqual(code, 2)
+
+    @patch("validatehttp.validate.Session.send")
+    def test_max_failures(self, mock):
+        """Checks stop at the maximum number of failures"""
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        self.write_spec(404, mtime=1000000100)
+        (code, output) = self.client.request({"file": self.spec_file, "max-failures": "1"})
+        self.assertEqual(code, 2)
+        self.assertIn("stopped after 1 failures", output)
+        self.assertIn("'failures'=1;;;;1", output)
+
+    @patch("validatehttp.validate.Session.send")
+    def test_result_cache(self, mock):
+        """Checks sharing a result cache reuse results of identical checks"""
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        params = {
+            "file": self.spec_file,
+            "host": "127.0.0.1",
+            "result-cache": os.path.join(self.path, "results.json"),
+        }
+        (code, output) = self.client.request(params)
+        self.assertEqual(code, 0)
+        self.assertEqual(self.client.request(params), (code, output))
+        # Checks using other validators still share results, unless their
+        # options change the outcome
+        self.client.request(dict(params, concurrency="2"))
+        self.assertEqual(mock.call_count, 1)
+        self.client.request(dict(params, host="127.0.0.2"))
+        self.assertEqual(mock.call_count, 2)
+        self.client.request(dict(params, deadline="10"))
+        self.client.request(dict(params, **{"max-failures": "1"}))
+        self.assertEqual(mock.call_count, 4)
+
+    def assert_invalid(self, params, message):
+        (code, output) = self.client.request(params)
+        self.assertEqual(code, 3)
+        self.assertIn("Invalid check parameters: {0}".format(message), output)
+
+    def test_unknown_params(self):
+        """Only known check parameters of the right type are accepted"""
+        self.assert_invalid(
+            {"file": self.spec_file, "cache-dir": self.path, "verbose": 1},
+            "unknown parameters cache-dir, verbose",
+        )
+        self.assert_invalid({"file": self.spec_file, "concurrency": "many"}, "concurrency must")
+        self.assert_invalid({"file": self.spec_file, "hedge": "yes"}, "hedge must be a bool")
+        self.assert_invalid({"file": self.spec_file, "host": ["a"]}, "host must be a str")
+        self.assert_invalid({"host": "127.0.0.1"}, "file is required")
+
+    def test_paths_outside(self):
+        """Checks can't read or write files outside the configured directories"""
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        other_spec = os.path.join(outside, "spec.json")
+        shutil.copy(self.spec_file, other_spec)
+        self.assert_invalid({"file": other_spec}, "file is outside of")
+        self.assert_invalid({"file": "spec.json"}, "file must be an absolute path")
+        self.assert_invalid(
+            {"file": self.spec_file, "hosts-file": "/etc/passwd"}, "hosts-file is outside of"
+        )
+        for key in ("history-file", "result-cache"):
+            self.assert_invalid(
+                {"file": self.spec_file, key: os.path.join(outside, "state")},
+                "{0} is outside of".format(key),
+            )
+        # Symbolic links are resolved
+        link = os.path.join(self.path, "link.json")
+        os.symlink(other_spec, link)
+        self.assert_invalid({"file": link}, "file is outside of")
+        self.assert_invalid({"file": os.path.join(self.path, "..", "spec.json")}, "file is outside")
+        self.assertEqual(os.listdir(outside), ["spec.json"])
+
+    def test_socket_mode(self):
+        """Socket is only open to the daemon user and group"""
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode), 0o660)
+
+    def test_foreign_socket_path(self):
+        """Files taking the socket path aren't replaced"""
+        other_path = os.path.join(self.path, "other.sock")
+        with open(other_path, "w"):
+            pass
+        self.assertRaises(OSError, CheckDaemon, other_path)
+        self.assertTrue(os.path.isfile(other_path))
+
+    def test_missing_spec(self):
+        """Missing spec file is reported as unknown"""
+        (code, output) = self.client.request({"file": os.path.join(self.path, "missing.json")})
+        self.assertEqual(code, 3)
+        self.assertTrue(output.startswith("UNKNOWN: "))
+
+
+class TestCheckClient(TestCase):
+    @patch("validatehttp.client.CheckClient.request")
+    def test_cli(self, mock):
+        """Plugin arguments are passed to the daemon, with the same meaning"""
+        mock.return_value = (0, "OK")
+        argv = ["check_validatehttp_client", "-f", "spec.json", "-t", "5", "-C", "/tmp/cache"]
+        argv += ["--socket-timeout", "20"]
+        with patch("sys.argv", argv), patch("sys.stdout"):
+            with self.assertRaises(SystemExit) as exit_code:
+                CheckClient.cli()
+        self.assertEqual(exit_code.exception.code, 0)
+        (params,) = mock.call_args[0]
+        self.assertEqual(params["file"], os.path.abspath("spec.json"))
+        self.assertEqual(params["timeout"], "5")
+        self.assertNotIn("cache-dir", params)
+
+
+@skipIf(CheckDaemon is None, "pynag is not installed")
+class TestCheckShared(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.spec_file = os.path.join(self.path, "spec.json")
+        with open(self.spec_file, "w") as handle:
+            json.dump({"http://example.com/": {"status_code": 200}}, handle)
+        self.plugin = CheckURLSpecPlugin()
+        self.plugin["file"] = self.spec_file
+        self.plugin["deadline"] = "1"
+        self.plugin["result-cache"] = os.path.join(self.path, "results.json")
+
+    def test_wait_deadline(self):
+        """Checks run after waiting on an identical check only get the rest of the deadline"""
+        options = self.plugin.get_options()
+        cache = self.plugin.get_result_cache()
+        key = ResultCache.get_key(
+            json.dumps({"http://example.com/": {"status_code": 200}}).encode("utf-8"),
+            dict(
+                (name, value) for (name, value) in options.items() if name not in UNSHARED_OPTIONS
+            ),
+        )
+        locked = threading.Event()
+        deadlines = []
+
+        def hold_lock():
+            # An identical check, failing without storing a result
+            with locked_file(cache.get_lock_path(key)):
+                locked.set()
+                time.sleep(0.4)
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait(5)
+
+        def run_check(deadline):
+            deadlines.append(deadline)
+            return (0, "OK")
+
+        self.assertEqual(self.plugin.check_shared(run_check, options), (0, "OK"))
+        thread.join()
+        (deadline,) = deadlines
+        self.assertLess(deadline, 0.7)
+        self.assertGreater(deadline, 0.3)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from mock import patch
+from requests import Response
+
+from validatehttp.history import HISTORY_TTL
+from validatehttp.history import RunHistory
+from validatehttp.history import get_rule_key
+from validatehttp.history import update_record
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.validate import Validator
+
+
+class TestRunHistory(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "history", "history.json")
+        self.rules = [
+            ValidatorSpecRule("http://example.com/fast"),
+            ValidatorSpecRule("http://example.com/slow"),
+            ValidatorSpecRule("http://example.com/failing"),
+            ValidatorSpecRule("http://example.com/new"),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_update_record(self):
+        """Records keep the last outcome and moving averages"""
+        record = update_record(None, False, [0.1, 0.3], 100)
+        self.assertEqual(record["last"], "pass")
+        self.assertAlmostEqual(record["latency"], 0.2)
+        self.assertEqual(record["flaky"], 0)
+        record = update_record(record, True, [1.2], 200)
+        self.assertEqual(record["last"], "fail")
+        self.assertAlmostEqual(record["latency"], 0.5)
+        self.assertAlmostEqual(record["flaky"], 0.3)
+        self.assertEqual(record["runs"], 2)
+        record = update_record(record, True, [], 300)
+        self.assertAlmostEqual(record["latency"], 0.5)
+        self.assertAlmostEqual(record["flaky"], 0.21)
+
+    def test_rule_key(self):
+        """Rules for the same URI are told apart"""
+        self.assertNotEqual(
+            get_rule_key(ValidatorSpecRule("http://example.com/", status_code=200)),
+            get_rule_key(ValidatorSpecRule("http://example.com/", status_code=404)),
+        )
+        self.assertTrue(get_rule_key(self.rules[0]).startswith("http://example.com/fast#"))
+
+    def test_save(self):
+        """Outcomes are merged into the history file"""
+        first = RunHistory(self.path)
+        second = RunHistory(self.path)
+        first.add(self.rules[0], False, 0.1)
+        second.add(self.rules[1], False, 0.2)
+        first.save()
+        second.save()
+        rules = RunHistory(self.path).load()
+        self.assertEqual(sorted(rules), sorted(get_rule_key(rule) for rule in self.rules[:2]))
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(self.path))), ["history.json", "history.json.lock"]
+        )
+
+    def test_concurrent_save(self):
+        """Concurrent checks sharing the history file don't lose outcomes"""
+
+        def run():
+            history = RunHistory(self.path)
+            for _ in range(10):
+                history.add(self.rules[0], False, 0.1)
+                history.save()
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        record = RunHistory(self.path).get(self.rules[0])
+        self.assertEqual(record["runs"], 80)
+
+    def test_expired(self):
+        """Rules that are no longer run expire"""
+        history = RunHistory(self.path)
+        history.add(self.rules[0], False)
+        with patch("time.time", return_value=1000.0):
+            history.save()
+        history.add(self.rules[1], False)
+        with patch("time.time", return_value=1000.0 + HISTORY_TTL):
+            history.save()
+        self.assertEqual(list(history.load()), [get_rule_key(self.rules[1])])
+
+    def test_invalid_file(self):
+        """Invalid history files are ignored"""
+        os.makedirs(os.path.dirname(self.path))
+        for content in ("{", json.dumps({"version": 0, "rules": {"a": {}}})):
+            with open(self.path, "w") as handle:
+                handle.write(content)
+            self.assertEqual(RunHistory(self.path).load(), {})
+
+    def test_order(self):
+        """Failing rules run first, then new rules, then the slowest rules"""
+        history = RunHistory(self.path)
+        history.add(self.rules[0], False, 0.01)
+        history.add(self.rules[1], False, 2.0)
+        history.add(self.rules[2], True, 0.01)
+        history.save()
+        validator = Validator(
+            YamlValidatorSpec(self.rules), history_file=self.path, order="history"
+        )
+        validator.start_run()
+        uris = [rules[0].uri for rules, _, _ in validator.get_jobs()]
+        self.assertEqual(
+            uris,
+            [
+                "http://example.com/failing",
+                "http://example.com/new",
+                "http://example.com/slow",
+                "http://example.com/fast",
+            ],
+        )
+        validator.order = "spec"
+        uris = [rules[0].uri for rules, _, _ in validator.get_jobs()]
+        self.assertEqual(uris, [rule.uri for rule in self.rules])
+
+    @patch("validatehttp.validate.Session.send")
+    def test_validate(self, mock):
+        """Validation records the outcome of each rule"""
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        rules = [
+            ValidatorSpecRule("http://example.com/ok", status_code=200),
+            ValidatorSpecRule("http://example.com/failing", status_code=404),
+        ]
+        validator = Validator(
+            YamlValidatorSpec(rules), history_file=self.path, order="history", max_failures=1
+        )
+        self.assertEqual([result.rule for result in validator.validate()], rules)
+        self.assertEqual(validator.history.get(rules[1])["last"], "fail")
+        # The failing rule runs first, stopping the run at once
+        self.assertEqual([result.rule for result in validator.validate()], rules[1:])
+        self.assertEqual(validator.history.get(rules[0])["runs"], 1)
+        self.assertEqual(validator.history.get(rules[1])["runs"], 2)
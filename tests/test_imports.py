@@ -0,0 +1,69 @@
+"""
+Test modules imported by entry points
+"""
+
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+
+# Modules only needed for YAML specs, terminal output, debugging, or other
+# run modes, that entry points shouldn't import when checking a JSON spec
+DEFERRED_MODULES = (
+    "yaml",
+    "termcolor",
+    "pprint",
+    "concurrent.futures",
+    "multiprocessing",
+    "xml.sax.saxutils",
+)
+
+
+class TestEntryPointImports(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spec_path = os.path.join(self.tmpdir, "spec.json")
+        with open(self.spec_path, "w") as handle:
+            json.dump({"https://example.com/": {"status_code": 200}}, handle)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def get_imported(self, code, modules=DEFERRED_MODULES):
+        """Return deferred modules imported by running code in a new interpreter"""
+        code = "\n".join(
+            [
+                "import json, sys",
+                code,
+                "from validatehttp.validate import Validator",
+                "Validator.load({0!r})".format(self.spec_path),
+                "print(json.dumps([name for name in {0!r} if name in sys.modules]))".format(
+                    modules
+                ),
+            ]
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=root)
+        return json.loads(output.decode("utf-8"))
+
+    def test_cli(self):
+        """CLI checking a JSON spec doesn't import deferred modules"""
+        self.assertEqual(self.get_imported("import validatehttp.cli"), [])
+
+    def test_nagios(self):
+        """Nagios plugin checking a JSON spec doesn't import deferred modules"""
+        self.assertEqual(self.get_imported("import validatehttp.nagios"), [])
+
+    def test_client(self):
+        """Daemon client loading a JSON spec doesn't import the file caches"""
+        modules = DEFERRED_MODULES + ("validatehttp.cache",)
+        self.assertEqual(self.get_imported("import validatehttp.client", modules), [])
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+from unittest import TestCase
+from xml.etree import ElementTree
+
+from validatehttp.report import JsonLinesReporter
+from validatehttp.report import JUnitReporter
+from validatehttp.report import PrometheusReporter
+from validatehttp.report import get_reporter
+from validatehttp.spec import ValidationError
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.transport import RequestTiming
+from validatehttp.validate import ValidationFail
+from validatehttp.validate import ValidationPass
+
+
+class TestReporters(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "report")
+        timing = RequestTiming()
+        timing.received = 128
+        passed = ValidationPass(ValidatorSpecRule("http://example.com/"), None, None, host="a")
+        passed.elapsed = 0.02
+        passed.timing = timing
+        error = ValidationError("Response mismatch: status_code", mismatch=(200, 404))
+        failed = ValidationFail(
+            ValidatorSpecRule("http://example.com/<missing>"), None, None, error, host="a"
+        )
+        failed.elapsed = 0.2
+        failed.size = 64
+        self.results = [passed, failed]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_reporter(self, reporter):
+        reporter.start()
+        for result in self.results:
+            reporter.add(result)
+        reporter.add_error("http://example.com/invalid", ValueError("Invalid rule"))
+        reporter.finish()
+        with open(self.path) as handle:
+            return handle.read()
+
+    def test_jsonl(self):
+        """Each result is written as a line of JSON"""
+        reporter = JsonLinesReporter(self.path)
+        reporter.start()
+        reporter.add(self.results[0])
+        # Results are written as they are added
+        with open(self.path) as handle:
+            self.assertEqual(len(handle.readlines()), 1)
+        reporter.finish()
+
+        records = [json.loads(line) for line in self.run_reporter(reporter).splitlines()]
+        self.assertEqual([record["outcome"] for record in records], ["pass", "fail", "invalid"])
+        self.assertEqual(records[0]["bytes"], 128)
+        self.assertEqual(records[0]["elapsed"], 0.02)
+        self.assertEqual(records[0]["attempts"], 1)
+        # Without timings, such as with --async, the body size is reported
+        self.assertEqual(records[1]["bytes"], 64)
+        self.assertEqual(records[1]["error"], "Response mismatch: status_code")
+        self.assertEqual(records[1]["mismatch"], {"expected": 200, "received": 404})
+
+    def test_junit(self):
+        """Results are written as JUnit test cases"""
+        report = ElementTree.fromstring(self.run_reporter(JUnitReporter(self.path)))
+        cases = report.findall("testsuite/testcase")
+        self.assertEqual(len(cases), 3)
+        self.assertEqual(cases[0].get("name"), "http://example.com/")
+        self.assertEqual(cases[0].get("classname"), "a")
+        self.assertEqual(float(cases[1].get("time")), 0.2)
+        failure = cases[1].find("failure")
+        self.assertEqual(failure.get("message"), "Response mismatch: status_code")
+        self.assertEqual(failure.text, "Expected: 200\nReceived: 404")
+        self.assertIsNotNone(cases[2].find("error"))
+
+    def test_prometheus(self):
+        """Result totals are written as metrics"""
+        lines = self.run_reporter(PrometheusReporter(self.path)).splitlines()
+        self.assertIn('validatehttp_results_total{host="a",outcome="pass"} 1', lines)
+        self.assertIn('validatehttp_results_total{host="a",outcome="fail"} 1', lines)
+        self.assertIn('validatehttp_response_bytes_total{host="a"} 192', lines)
+        self.assertIn('validatehttp_response_seconds_bucket{host="a",le="0.025"} 1', lines)
+        self.assertIn('validatehttp_response_seconds_bucket{host="a",le="+Inf"} 2', lines)
+        self.assertIn("validatehttp_invalid_rules 1", lines)
+        self.assertIn("# TYPE validatehttp_results_total counter", lines)
+        self.assertNotIn("# EOF", lines)
+        self.assertEqual(os.listdir(self.tmp_dir), ["report"])
+
+    def test_prometheus_mode(self):
+        """Metrics files are readable by other users, as the umask allows"""
+        umask = os.umask(0o022)
+        try:
+            self.run_reporter(PrometheusReporter(self.path))
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o644)
+
+    def test_openmetrics(self):
+        """OpenMetrics reports name counter families without suffix"""
+        lines = self.run_reporter(get_reporter("openmetrics:" + self.path)).splitlines()
+        self.assertIn("# TYPE validatehttp_results counter", lines)
+        self.assertEqual(lines[-1], "# EOF")
+
+    def test_get_reporter(self):
+        """Reporters are looked up by format name"""
+        self.assertIsInstance(get_reporter("junit:out.xml"), JUnitReporter)
+        self.assertEqual(get_reporter("jsonl:a:b").path, "a:b")
+        self.assertRaises(ValueError, get_reporter, "junit")
+        self.assertRaises(ValueError, get_reporter, "html:out.html")
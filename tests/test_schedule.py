@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import TestCase
+
+from mock import patch
+
+from validatehttp.schedule import RETRY_BACKOFF_MAX
+from validatehttp.schedule import AdaptiveLimit
+from validatehttp.schedule import HedgeDelay
+from validatehttp.schedule import Scheduler
+from validatehttp.schedule import TokenBucket
+from validatehttp.schedule import get_backoff
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.validate import ValidationFail
+from validatehttp.validate import Validator
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(TestCase):
+    def test_reserve(self):
+        """Tokens are reserved at the limit rate"""
+        clock = Clock()
+        bucket = TokenBucket(10, clock=clock)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+        clock.now = 1.0
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+
+    def test_burst(self):
+        """Tokens accumulate up to the burst size"""
+        clock = Clock()
+        bucket = TokenBucket(10, burst=3, clock=clock)
+        clock.now = 10.0
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+
+    @patch("time.sleep")
+    def test_acquire(self, sleep):
+        """Requests wait for their token"""
+        bucket = TokenBucket(10, clock=Clock())
+        bucket.acquire()
+        self.assertFalse(sleep.called)
+        bucket.acquire()
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.1)
+
+
+class TestAdaptiveLimit(TestCase):
+    def test_slow_start(self):
+        """Limit grows by one request per response until congestion"""
+        limit = AdaptiveLimit(8)
+        for _ in range(4):
+            limit.update(0.01, True)
+        self.assertEqual(limit.limit, 5)
+        for _ in range(10):
+            limit.update(0.01, True)
+        self.assertEqual(limit.limit, 8)
+
+    def test_errors(self):
+        """Limit is halved on errors, then grows additively"""
+        limit = AdaptiveLimit(64)
+        for _ in range(15):
+            limit.update(0.01, True)
+        self.assertEqual(limit.limit, 16)
+        limit.update(0.01, False)
+        self.assertEqual(limit.limit, 8)
+        self.assertFalse(limit.slow_start)
+        for _ in range(8):
+            limit.update(0.01, True)
+        self.assertEqual(int(limit.limit), 8)
+        self.assertGreater(limit.limit, 8.9)
+        limit.update(None, False)
+        self.assertLess(limit.limit, 5)
+        for _ in range(10):
+            limit.update(None, False)
+        self.assertEqual(limit.limit, 1)
+
+    def test_hold(self):
+        """Requests in flight during a decrease don't decrease the limit again"""
+        limit = AdaptiveLimit(64)
+        for _ in range(15):
+            limit.update(0.01, True)
+        limit.in_flight = 3
+        limit.update(0.01, False)
+        for _ in range(3):
+            limit.update(0.01, False)
+        self.assertEqual(limit.limit, 8)
+        limit.update(0.01, False)
+        self.assertEqual(limit.limit, 4)
+
+    def test_latency(self):
+        """Limit is halved when latency rises"""
+        limit = AdaptiveLimit(64)
+        for _ in range(15):
+            limit.update(0.01, True)
+        for _ in range(10):
+            limit.update(0.1, True)
+        self.assertLess(limit.limit, 16)
+        # High latency at the lowest limit becomes the new baseline
+        for _ in range(50):
+            limit.update(0.1, True)
+        self.assertGreater(limit.limit, 1)
+
+    def test_acquire(self):
+        """Requests wait for a free slot"""
+        limit = AdaptiveLimit(4)
+        self.assertTrue(limit.try_acquire())
+        self.assertFalse(limit.try_acquire())
+        thread = threading.Thread(target=limit.acquire)
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        limit.release(0.01, True)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(limit.in_flight, 1)
+        self.assertEqual(limit.limit, 2)
+
+
+class TestHedgeDelay(TestCase):
+    def test_percentile(self):
+        """Delay is the latency percentile, once enough latencies are seen"""
+        delay = HedgeDelay(min_samples=20)
+        for n in range(19):
+            delay.add(n / 100.0)
+        self.assertIsNone(delay.get())
+        for n in range(19, 100):
+            delay.add(n / 100.0)
+        self.assertAlmostEqual(delay.get(), 0.94, delta=0.1)
+        delay.reset()
+        self.assertIsNone(delay.get())
+
+    def test_window(self):
+        """Only the latest latencies count"""
+        delay = HedgeDelay(window=50, min_samples=10)
+        for _ in range(50):
+            delay.add(1.0)
+        for _ in range(50):
+            delay.add(0.1)
+        self.assertEqual(delay.get(), 0.1)
+
+
+class TestBackoff(TestCase):
+    def test_backoff(self):
+        """Wait doubles with each attempt, up to the maximum"""
+        self.assertEqual(get_backoff(1, 0.1, rand=lambda: 1.0), 0.1)
+        self.assertEqual(get_backoff(3, 0.1, rand=lambda: 1.0), 0.4)
+        self.assertEqual(get_backoff(20, 0.1, rand=lambda: 1.0), RETRY_BACKOFF_MAX)
+        self.assertEqual(get_backoff(3, 0.1, rand=lambda: 0.5), 0.2)
+
+
+class TestScheduler(TestCase):
+    def test_hosts(self):
+        """Each host has its own limits"""
+        scheduler = Scheduler(max_rps=10, adaptive=True, concurrency=4)
+        (bucket, limit) = scheduler.get_host("a")
+        self.assertEqual(bucket.rate, 10)
+        self.assertEqual(limit.maximum, 4)
+        self.assertIs(scheduler.get_host("a")[1], limit)
+        self.assertIsNot(scheduler.get_host("b")[1], limit)
+        scheduler.acquire("a")
+        scheduler.release("a", 0.01, True)
+        self.assertEqual(scheduler.get_limits(), {"a": 2, "b": 1})
+        self.assertEqual(Scheduler().get_host("a"), (None, None))
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(time.monotonic())
+        self.send_response(503 if self.path.startswith("/error") else 200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestValidatorSchedule(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def run_rules(self, paths, **kwargs):
+        rules = [
+            ValidatorSpecRule("http://example.com{0}".format(path), status_code=200)
+            for path in paths
+        ]
+        validator = Validator(YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, **kwargs)
+        results = list(validator.validate())
+        validator.close()
+        return (validator, results)
+
+    def test_max_rps(self):
+        """Requests are paced to the rate limit"""
+        self.run_rules(["/{0}".format(n) for n in range(6)], max_rps=50, concurrency=4)
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertGreaterEqual(self.server.requests[-1] - self.server.requests[0], 0.09)
+
+    def test_adaptive(self):
+        """Adaptive concurrency grows while healthy and drops on errors"""
+        # Latency on a loaded test machine is too noisy to test growth with
+        with patch("validatehttp.schedule.LATENCY_SLACK", 10):
+            (validator, results) = self.run_rules(
+                ["/{0}".format(n) for n in range(40)], adaptive=True
+            )
+        self.assertEqual(validator.concurrency, 64)
+        self.assertEqual(len(results), 40)
+        healthy = validator.scheduler.get_limits()["127.0.0.1:{0}".format(self.port)]
+        self.assertGreater(healthy, 4)
+        (validator, results) = self.run_rules(
+            ["/{0}".format(n) for n in range(20)] + ["/error/{0}".format(n) for n in range(20)],
+            adaptive=True,
+        )
+        self.assertEqual(len([r for r in results if isinstance(r, ValidationFail)]), 20)
+        limit = validator.scheduler.get_limits()["127.0.0.1:{0}".format(self.port)]
+        self.assertLess(limit, 4)
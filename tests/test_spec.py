@@ -7,12 +7,28 @@ Test validation spec and spec rule creation
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
+import os
+import pickle
+import shutil
+import tempfile
+from datetime import timedelta
 from unittest import TestCase
 
 from mock import mock_open
 from mock import patch
+from requests import Response
 
+from validatehttp.cache import SpecCache
+from validatehttp.spec import ContentMatcher
 from validatehttp.spec import JsonValidatorSpec
+from validatehttp.spec import ValidationError
+from validatehttp.spec import ValidationTimeout
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.spec import iter_json_object
+from validatehttp.spec import iter_text
+from validatehttp.spec import iter_yaml_mapping
 from validatehttp.validate import Validator
 
 
@@ -47,11 +63,8 @@ class TestSpec(TestCase):
     @patch("validatehttp.spec.open", create=True)
     def test_yaml_not_loaded(self, mock):
         """YAML is not loaded"""
-        import sys
-
         mock_open(mock, read_data="foo: status_code: 200")
         with patch.dict("sys.modules", yaml=None):
-            del sys.modules["yaml"]
             self.assertRaises(NameError, Validator.load, "rtd.yaml")
 
     @patch("os.path.exists", lambda n: True)
@@ -136,3 +149,312 @@ class TestSpec(TestCase):
         assert req.method == "get"
         assert "x-foo" in req.headers
         assert req.headers["x-foo"] == 42
+
+
+class TestContentMatcher(TestCase):
+    def setUp(self):
+        self.resp = Response()
+        self.resp.status_code = 200
+        self.resp.encoding = "utf-8"
+        self.resp._content = b"<html><script>var build = 1234;</script></html>"
+
+    def test_literal_content(self):
+        """Literal content assertions"""
+        rule = ValidatorSpecRule(
+            "http://example.com", content={"present": ["script", "build"], "absent": ["meta"]}
+        )
+        self.assertTrue(rule.matches(self.resp))
+        rule = ValidatorSpecRule("http://example.com", content={"present": ["meta"]})
+        self.assertRaisesRegex(ValidationError, r"content absent: meta", rule.matches, self.resp)
+        rule = ValidatorSpecRule("http://example.com", content={"absent": ["script"]})
+        self.assertRaisesRegex(ValidationError, r"content present: script", rule.matches, self.resp)
+
+    def test_regex_content(self):
+        """Regular expression content assertions"""
+        rule = ValidatorSpecRule(
+            "http://example.com",
+            content={"present": [{"regex": r"build = \d+;"}], "absent": [{"regex": r"<meta\b"}]},
+        )
+        self.assertTrue(rule.matches(self.resp))
+        rule = ValidatorSpecRule(
+            "http://example.com", content={"absent": [{"regex": r"build = \d+;"}]}
+        )
+        self.assertRaisesRegex(ValidationError, r"content present: /build", rule.matches, self.resp)
+
+    def test_invalid_regex(self):
+        """Invalid regular expression is an invalid rule"""
+        self.assertRaises(
+            ValueError,
+            ValidatorSpecRule,
+            "http://example.com",
+            content={"present": [{"regex": "(unbalanced"}]},
+        )
+
+    def test_stream_boundary(self):
+        """Streamed content straddling chunk boundaries is found"""
+        matcher = ContentMatcher({"present": ["script", {"regex": r"build = \d+"}]})
+        matcher.match_stream(iter(["<html><scr", "ipt>var bu", "ild = 1234;"]))
+        matcher = ContentMatcher({"absent": ["script"]})
+        self.assertRaisesRegex(
+            ValidationError,
+            r"content present: script",
+            matcher.match_stream,
+            iter(["<html><scr", "ipt>"]),
+        )
+        matcher = ContentMatcher({"present": ["meta"]})
+        self.assertRaisesRegex(
+            ValidationError,
+            r"content absent: meta",
+            matcher.match_stream,
+            iter(["<html><me", "ipt>"]),
+        )
+
+    def test_stream_early_exit(self):
+        """Streaming stops once all present content is found"""
+        chunks = iter(["<html>", "<script>", "</html>"])
+        matcher = ContentMatcher({"present": ["script"]})
+        matcher.match_stream(chunks)
+        self.assertEqual(list(chunks), ["</html>"])
+
+        chunks = iter(["<html>", "<script>", "<meta>", "</html>"])
+        matcher = ContentMatcher({"absent": ["meta"]})
+        self.assertRaises(ValidationError, matcher.match_stream, chunks)
+        self.assertEqual(list(chunks), ["</html>"])
+
+    def test_stream_response(self):
+        """Match streamed response body"""
+        resp = Response()
+        resp.status_code = 200
+        resp.raw = io.BytesIO("<html>ünïcode <script></html>".encode("utf-8"))
+        rule = ValidatorSpecRule(
+            "http://example.com", status_code=200, content={"present": ["ünïcode", "script"]}
+        )
+        self.assertTrue(rule.matches(resp, stream=True))
+        self.assertFalse(resp._content)
+
+    def test_stream_unknown_charset(self):
+        """Streamed response bodies with an unknown charset are decoded as UTF-8"""
+        resp = Response()
+        resp.status_code = 200
+        resp.encoding = "bogus"
+        resp.raw = io.BytesIO("ünïcode".encode("utf-8"))
+        self.assertEqual("".join(iter_text(resp)), "ünïcode")
+
+
+class TestCompiledRule(TestCase):
+    def test_request_not_mutated(self):
+        """Requests against a host don't leak into the rule request params"""
+        rule = ValidatorSpecRule("http://example.com/foo", request={"headers": {"x-foo": "42"}})
+        rule.get_request(host="0.0.0.0", port=8000)
+        self.assertEqual(rule.request, {"headers": {"x-foo": "42"}, "method": "get"})
+        req = rule.get_request()
+        self.assertEqual(req.url, "http://example.com/foo")
+        self.assertNotIn("Host", req.headers)
+
+    def test_prepare(self):
+        """Prepared requests are built once per host and port, and copied"""
+        rule = ValidatorSpecRule("http://example.com/foo")
+        compiled = rule.compile()
+        self.assertIs(rule.compile(), compiled)
+        first = compiled.prepare("0.0.0.0", 8000)
+        first.method = "HEAD"
+        first.headers["x-foo"] = "42"
+        second = compiled.prepare("0.0.0.0", 8000)
+        self.assertEqual(second.url, "http://0.0.0.0:8000/foo")
+        self.assertEqual(second.method, "GET")
+        self.assertEqual(second.headers["Host"], "example.com")
+        self.assertNotIn("x-foo", second.headers)
+        self.assertEqual(compiled.prepare().url, "http://example.com/foo")
+        self.assertEqual(len(compiled.templates), 2)
+
+    def test_max_elapsed_ms(self):
+        """Response time is asserted in milliseconds"""
+        rule = ValidatorSpecRule("http://example.com", max_elapsed_ms="100")
+        self.assertFalse(rule.needs_body)
+        resp = Response()
+        resp.elapsed = timedelta(milliseconds=50)
+        self.assertTrue(rule.matches(resp))
+        resp.elapsed = timedelta(milliseconds=250)
+        with self.assertRaises(ValidationError) as context:
+            rule.matches(resp)
+        self.assertEqual(str(context.exception), "Response too slow: 250ms")
+        self.assertEqual(context.exception.mismatch, (100, 250))
+
+    def test_timeout(self):
+        """Rules can set their own timeout"""
+        self.assertIsNone(ValidatorSpecRule("http://example.com").timeout)
+        rule = ValidatorSpecRule("http://example.com", timeout="2.5", status_code=200)
+        self.assertEqual(rule.timeout, 2.5)
+        self.assertNotIn("timeout", rule.response)
+        self.assertEqual(pickle.loads(pickle.dumps(rule)).timeout, 2.5)
+        self.assertRaises(ValueError, ValidatorSpecRule, "http://example.com", timeout="soon")
+        error = pickle.loads(pickle.dumps(ValidationTimeout(2.5)))
+        self.assertEqual(str(error), "Request timed out after 2.5s")
+        self.assertEqual(error.timeout, 2.5)
+
+    def test_matchers(self):
+        """Response assertions are compiled to matchers"""
+        rule = ValidatorSpecRule("http://example.com", status_code=200, headers={"x-test": "foo"})
+        compiled = rule.compile()
+        self.assertEqual(len(compiled.matchers), 2)
+        self.assertFalse(hasattr(compiled, "__dict__"))
+        resp = Response()
+        resp.status_code = 200
+        resp.headers["x-test"] = "foo"
+        self.assertTrue(compiled.matches(resp))
+        resp.headers["x-test"] = "bar"
+        self.assertRaisesRegex(ValidationError, r"header mismatch: x-test", compiled.matches, resp)
+
+
+class TestSpecCache(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.path, "cache")
+        self.spec_file = os.path.join(self.path, "spec.yaml")
+        self.write_spec("http://example.com/:\n  status_code: 200\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write_spec(self, data):
+        with open(self.spec_file, "w") as handle:
+            handle.write(data)
+
+    def test_cached_load(self):
+        """Unchanged spec files are loaded from the cache"""
+        spec = YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+        self.assertEqual([rule.uri for rule in spec.get_rules()], ["http://example.com/"])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        with patch.object(YamlValidatorSpec, "parse") as parse:
+            spec = YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+            self.assertFalse(parse.called)
+        rule = list(spec.get_rules())[0]
+        self.assertEqual(rule.response["status_code"], 200)
+
+    def test_changed_spec(self):
+        """Changed spec files are parsed again"""
+        YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+        self.write_spec("http://example.com/foo:\n  status_code: 404\n")
+        spec = YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+        self.assertEqual([rule.uri for rule in spec.get_rules()], ["http://example.com/foo"])
+
+    def test_corrupt_cache(self):
+        """Corrupt cache files are ignored"""
+        cache = SpecCache(self.cache_dir)
+        YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+        with open(cache.get_path(self.spec_file), "wb") as handle:
+            handle.write(b"\x00garbage")
+        spec = YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+        self.assertEqual(len(list(spec.get_rules())), 1)
+
+    def test_uncacheable_spec(self):
+        """Specs with values marshal can't store are not cached"""
+        self.write_spec("http://example.com/:\n  date: 2020-01-01\n")
+        spec = YamlValidatorSpec.load(self.spec_file, cache_dir=self.cache_dir)
+        self.assertEqual(len(list(spec.get_rules())), 1)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+class TestIncrementalSpec(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write_spec(self, name, data):
+        spec_file = os.path.join(self.path, name)
+        with open(spec_file, "w") as handle:
+            handle.write(data)
+        return spec_file
+
+    def test_iter_json_object(self):
+        """JSON objects are parsed incrementally, across chunk boundaries"""
+        data = '{"http://a": {"status_code": 200}, "http://b" :12345 ,\n "http://c": [1, "}"]}'
+        for chunk_size in (1, 3, 1024):
+            entries = list(iter_json_object(io.StringIO(data), chunk_size=chunk_size))
+            self.assertEqual(
+                entries,
+                [("http://a", {"status_code": 200}), ("http://b", 12345), ("http://c", [1, "}"])],
+            )
+        self.assertEqual(list(iter_json_object(io.StringIO(" {} "))), [])
+        for invalid in ("", "[]", '{"a": 1', '{"a": 1,}', '{"a" 1}'):
+            self.assertRaises(ValueError, list, iter_json_object(io.StringIO(invalid)))
+
+    def test_iter_json_object_early(self):
+        """First JSON entries are yielded before the whole document is read"""
+        handle = io.StringIO('{"http://a": {"status_code": 200}, ' + " " * 100000 + "}")
+        entries = iter_json_object(handle, chunk_size=64)
+        self.assertEqual(next(entries)[0], "http://a")
+        self.assertLess(handle.tell(), 1024)
+
+    def test_iter_yaml_mapping(self):
+        """YAML mappings are parsed incrementally"""
+        data = "http://a: &rule\n  status_code: 200\nhttp://b: *rule\nhttp://c:\n"
+        entries = list(iter_yaml_mapping(io.StringIO(data)))
+        self.assertEqual(
+            entries,
+            [
+                ("http://a", {"status_code": 200}),
+                ("http://b", {"status_code": 200}),
+                ("http://c", None),
+            ],
+        )
+        self.assertEqual(list(iter_yaml_mapping(io.StringIO(""))), [])
+        self.assertRaises(ValueError, list, iter_yaml_mapping(io.StringIO("- foo\n")))
+        self.assertRaises(ValueError, list, iter_yaml_mapping(io.StringIO("foo: status_code: tr")))
+
+    def test_lazy_load(self):
+        """Lazy specs read rules while iterating, and report invalid rules"""
+        spec_file = self.write_spec(
+            "spec.yaml",
+            "http://a:\n  status_code: 200\nhttp://b:\nhttp://c:\n  content: {present: [{regex: '('}]}\n",
+        )
+        spec = YamlValidatorSpec.load(spec_file, lazy=True)
+        self.assertIsNone(spec.rules)
+        rules = list(spec.get_rules())
+        self.assertEqual([rule.uri for rule in rules], ["http://a"])
+        self.assertEqual([uri for uri, _ in spec.errors], ["http://b", "http://c"])
+        # Errors are reset on each pass over the spec file
+        list(spec.get_rules())
+        self.assertEqual(len(spec.errors), 2)
+
+    def test_load_errors(self):
+        """Invalid rules are reported when loading a spec"""
+        spec_file = self.write_spec(
+            "spec.json", '{"http://a": {"status_code": 200}, "http://b": 1}'
+        )
+        spec = JsonValidatorSpec.load(spec_file)
+        self.assertEqual(len(spec.rules), 1)
+        self.assertEqual(spec.errors, [("http://b", "Rule is not a mapping")])
+
+    def test_json_lines(self):
+        """JSON Lines specs have one rule per line"""
+        spec_file = self.write_spec(
+            "spec.jsonl",
+            '{"uri": "http://a", "status_code": 200}\n\n'
+            '{"status_code": 200}\n'
+            "not json\n"
+            '{"uri": "http://b", "request": {"method": "head"}}\n',
+        )
+        for lazy in (False, True):
+            validator = Validator.load(spec_file, lazy=lazy)
+            rules = list(validator.spec.get_rules())
+            self.assertEqual([rule.uri for rule in rules], ["http://a", "http://b"])
+            self.assertEqual(rules[1].request["method"], "head")
+            self.assertEqual(
+                validator.spec.errors,
+                [("line 3", "Rule has no uri"), ("line 4", "Invalid JSON")],
+            )
+
+    def test_lazy_load_without_libyaml(self):
+        """Lazy YAML specs load with the pure Python YAML loader"""
+        import yaml
+
+        spec_file = self.write_spec(
+            "spec.yaml", "http://a: &rule\n  status_code: 200\nhttp://b: *rule\n"
+        )
+        with patch.dict(yaml.__dict__):
+            yaml.__dict__.pop("CSafeLoader", None)
+            rules = list(YamlValidatorSpec.load(spec_file, lazy=True).get_rules())
+        self.assertEqual([rule.uri for rule in rules], ["http://a", "http://b"])
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import pickle
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import TestCase
+
+from mock import patch
+from requests import Request
+from requests import Session
+
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.transport import RequestTiming
+from validatehttp.transport import Resolver
+from validatehttp.transport import TimingAdapter
+from validatehttp.transport import finish_timing
+from validatehttp.transport import parse_resolve
+from validatehttp.validate import ValidationPass
+from validatehttp.validate import Validator
+
+
+class BodyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.hosts.append(self.headers.get("Host"))
+        self.send_response(200)
+        self.send_header("Content-Length", "32")
+        self.end_headers()
+        self.wfile.write(b"x" * 32)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRequestTiming(TestCase):
+    def test_str(self):
+        """Timing summary is in milliseconds, with missing phases marked"""
+        timing = RequestTiming()
+        timing.send = 0.0012
+        timing.wait = 0.25
+        timing.received = 10
+        self.assertEqual(
+            str(timing),
+            "dns -, connect -, tls -, send 1.2ms, wait 250.0ms, receive -, "
+            "10 bytes, reused connection",
+        )
+
+    def test_pickle(self):
+        """Timing records can be pickled"""
+        timing = RequestTiming()
+        timing.dns = 0.1
+        timing.reused = False
+        copy = pickle.loads(pickle.dumps(timing))
+        self.assertEqual(copy.as_dict(), timing.as_dict())
+        self.assertFalse(copy.as_dict()["reused"])
+
+
+class TestTimingAdapter(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), BodyHandler)
+        self.server.hosts = []
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.url = "http://localhost:{0}/".format(self.server.server_address[1])
+        self.session = Session()
+        self.session.mount("http://", TimingAdapter())
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_timing(self):
+        """New connections record name resolution and connect times"""
+        resp = self.session.get(self.url)
+        finish_timing(resp)
+        timing = resp.timing
+        self.assertFalse(timing.reused)
+        for phase in ("dns", "connect", "send", "wait", "receive"):
+            self.assertGreaterEqual(getattr(timing, phase), 0, phase)
+        self.assertIsNone(timing.tls)
+        self.assertEqual(timing.received, 32)
+
+    def test_reused(self):
+        """Reused connections have no connect phases"""
+        self.session.get(self.url)
+        resp = self.session.get(self.url)
+        finish_timing(resp)
+        self.assertTrue(resp.timing.reused)
+        self.assertIsNone(resp.timing.dns)
+        self.assertIsNone(resp.timing.connect)
+        self.assertIsNotNone(resp.timing.wait)
+
+    def test_stream(self):
+        """Streamed response body timing is recorded once the body is read"""
+        resp = self.session.get(self.url, stream=True)
+        self.assertIsNone(resp.timing.receive)
+        self.assertEqual(len(resp.raw.read()), 32)
+        finish_timing(resp)
+        self.assertIsNotNone(resp.timing.receive)
+        self.assertEqual(resp.timing.received, 32)
+
+    def test_validator(self):
+        """Validation results carry the request timing"""
+        validator = Validator(YamlValidatorSpec([ValidatorSpecRule(self.url)]), stream=True)
+        (result,) = list(validator.validate())
+        self.assertIsInstance(result, ValidationPass)
+        self.assertFalse(result.timing.reused)
+        self.assertEqual(result.timing.received, 32)
+        self.assertIsNotNone(result.timing.receive)
+
+    def test_pinned(self):
+        """Pinned host names connect to the pinned address, and keep their URL"""
+        port = self.server.server_address[1]
+        url = "http://pinned.invalid:{0}/".format(port)
+        validator = Validator(
+            YamlValidatorSpec([ValidatorSpecRule(url)]),
+            resolve={("pinned.invalid", port): ["127.0.0.1"]},
+        )
+        (result,) = list(validator.validate())
+        validator.close()
+        self.assertIsInstance(result, ValidationPass)
+        self.assertEqual(self.server.hosts, ["pinned.invalid:{0}".format(port)])
+
+    def test_resolve_cache(self):
+        """New connections to the same host reuse the resolved addresses"""
+        resolver = Resolver()
+        session = Session()
+        session.mount("http://", TimingAdapter(resolver=resolver))
+        with patch("validatehttp.transport.resolve", return_value=["127.0.0.1"]) as resolve:
+            for _ in range(3):
+                session.get(self.url, headers={"Connection": "close"})
+        session.close()
+        self.assertEqual(resolve.call_count, 1)
+
+
+class TestResolver(TestCase):
+    def test_parse_resolve(self):
+        """Pinned addresses are given as host:port:addr[,addr]"""
+        self.assertEqual(
+            parse_resolve("example.com:443:10.0.0.1,[::1]"),
+            (("example.com", 443), ["10.0.0.1", "::1"]),
+        )
+        for value in ("example.com", "example.com:http:10.0.0.1", "example.com:443:", ":443:1"):
+            with self.assertRaises(ValueError):
+                parse_resolve(value)
+
+    def test_pinned(self):
+        """Pinned host names aren't resolved"""
+        resolver = Resolver({("Example.com", "443"): ["10.0.0.1"]})
+        with patch("validatehttp.transport.resolve") as resolve:
+            self.assertEqual(resolver.resolve("example.COM", 443), ["10.0.0.1"])
+            resolver.resolve("example.com", 80)
+        resolve.assert_called_once_with("example.com", 80)
+
+    def test_cache(self):
+        """Resolved addresses are cached until they expire"""
+        now = [0.0]
+        resolver = Resolver(ttl=10, clock=lambda: now[0])
+        with patch("validatehttp.transport.resolve", return_value=["10.0.0.1"]) as resolve:
+            resolver.resolve("example.com", 80)
+            now[0] = 9.0
+            resolver.resolve("example.com", 80)
+            self.assertEqual(resolve.call_count, 1)
+            now[0] = 10.0
+            resolver.resolve("example.com", 80)
+            self.assertEqual(resolve.call_count, 2)
+
+    def test_failure(self):
+        """Failed lookups aren't cached"""
+        resolver = Resolver()
+        with patch("validatehttp.transport.resolve", side_effect=socket.gaierror) as resolve:
+            for _ in range(2):
+                with self.assertRaises(socket.gaierror):
+                    resolver.resolve("example.invalid", 80)
+        self.assertEqual(resolve.call_count, 2)
+
+    def test_server_name(self):
+        """HTTPS requests to a host address check TLS against the Host header"""
+        adapter = TimingAdapter()
+        req = Request("GET", "https://10.0.0.1/", headers={"Host": "example.com"}).prepare()
+        (_, pool_kwargs) = adapter.build_connection_pool_key_attributes(req, True)
+        self.assertEqual(pool_kwargs["server_hostname"], "example.com")
+        self.assertEqual(pool_kwargs["assert_hostname"], "example.com")
+        (_, pool_kwargs) = adapter.build_connection_pool_key_attributes(req, False)
+        self.assertNotIn("assert_hostname", pool_kwargs)
+        req = Request("GET", "https://example.com/").prepare()
+        (_, pool_kwargs) = adapter.build_connection_pool_key_attributes(req, True)
+        self.assertNotIn("server_hostname", pool_kwargs)
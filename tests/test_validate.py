@@ -3,19 +3,39 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from unittest import TestCase
 
 from mock import mock_open
 from mock import patch
 from requests import Response
+from requests.exceptions import ChunkedEncodingError
 from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
+from requests.exceptions import ReadTimeout
 from requests.exceptions import SSLError
 
+from validatehttp.spec import ValidationError
+from validatehttp.spec import ValidationTimeout
 from validatehttp.spec import ValidatorSpecRule
 from validatehttp.spec import YamlValidatorSpec
+from validatehttp.validate import MISMATCH_LIMIT
 from validatehttp.validate import ValidationFail
 from validatehttp.validate import ValidationPass
 from validatehttp.validate import Validator
+from validatehttp.validate import get_percentiles
+from validatehttp.validate import in_shard
+from validatehttp.validate import is_retryable
+from validatehttp.validate import parse_host
+from validatehttp.validate import parse_shard
 
 
 class TestValidator(TestCase):
@@ -124,3 +144,683 @@ class TestValidatorValidation(TestCase):
         mock.side_effect = _raise
         results = list(self.validator.validate())
         self.assertRuleMatches(results[0], passing=False, error=r"SSL")
+
+
+class TestValidatorConcurrency(TestCase):
+    def setUp(self):
+        self.rules = [
+            ValidatorSpecRule("http://example.com/{0}".format(n), status_code=200) for n in range(8)
+        ]
+
+    def _send(self, prepared, **kwargs):
+        """Respond slower to earlier rules, so completion order is reversed"""
+        index = int(prepared.url.rsplit("/", 1)[-1])
+        time.sleep((8 - index) * 0.01)
+        resp = Response()
+        resp.status_code = 200
+        return resp
+
+    @patch("validatehttp.validate.Session.send")
+    def test_ordered_results(self, mock):
+        """Concurrent results are yielded in spec order"""
+        mock.side_effect = self._send
+        validator = Validator(YamlValidatorSpec(self.rules), concurrency=4)
+        results = list(validator.validate())
+        validator.close()
+        self.assertEqual([result.rule for result in results], self.rules)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+
+    @patch("validatehttp.validate.Session.send")
+    def test_unordered_results(self, mock):
+        """Unordered results are yielded as requests complete"""
+        mock.side_effect = self._send
+        validator = Validator(YamlValidatorSpec(self.rules), concurrency=8, ordered=False)
+        results = list(validator.validate())
+        validator.close()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(set(result.rule for result in results), set(self.rules))
+        self.assertNotEqual([result.rule for result in results], self.rules)
+
+    @patch("validatehttp.validate.Session.send")
+    def test_sessions_reused(self, mock):
+        """Sessions are pooled and reused between runs"""
+        mock.side_effect = self._send
+        validator = Validator(YamlValidatorSpec(self.rules), concurrency=2)
+        list(validator.validate())
+        list(validator.validate())
+        self.assertLessEqual(validator._sessions.qsize(), 2)
+        validator.close()
+
+
+class TestValidatorHosts(TestCase):
+    def test_parse_host(self):
+        """Split host addresses into host and port"""
+        self.assertEqual(parse_host("10.0.0.1"), ("10.0.0.1", None))
+        self.assertEqual(parse_host("10.0.0.1", 80), ("10.0.0.1", 80))
+        self.assertEqual(parse_host("10.0.0.1:8080", 80), ("10.0.0.1", "8080"))
+        self.assertEqual(parse_host("[::1]:8080"), ("::1", "8080"))
+        self.assertEqual(parse_host("[::1]", 80), ("::1", 80))
+
+    @patch("validatehttp.validate.Session.send")
+    def test_multiple_hosts(self, mock):
+        """Every rule is run against every host"""
+        urls = []
+
+        def _send(prepared, **kwargs):
+            urls.append(prepared.url)
+            resp = Response()
+            resp.status_code = 500 if "10.0.0.2" in prepared.url else 200
+            return resp
+
+        mock.side_effect = _send
+        rules = [
+            ValidatorSpecRule("http://example.com/foo", status_code=200),
+            ValidatorSpecRule("http://example.com/bar", status_code=200),
+        ]
+        validator = Validator(
+            YamlValidatorSpec(rules), port=8000, hosts=["10.0.0.1", "10.0.0.2:8080"]
+        )
+        self.assertEqual(validator.concurrency, 2)
+        results = list(validator.validate())
+        validator.close()
+        self.assertEqual(
+            sorted(urls),
+            [
+                "http://10.0.0.1:8000/bar",
+                "http://10.0.0.1:8000/foo",
+                "http://10.0.0.2:8080/bar",
+                "http://10.0.0.2:8080/foo",
+            ],
+        )
+        for result in results:
+            if result.host == "10.0.0.1":
+                self.assertIsInstance(result, ValidationPass)
+            else:
+                self.assertIsInstance(result, ValidationFail)
+        self.assertEqual(rules[0].request["headers"], {})
+
+
+class TestValidatorStream(TestCase):
+    class Body(io.BytesIO):
+        closed_early = False
+
+        def close(self):
+            self.closed_early = self.tell() < len(self.getvalue())
+            super(TestValidatorStream.Body, self).close()
+
+    @patch("validatehttp.validate.Session.send")
+    def test_stream_release(self, mock):
+        """Streamed responses are closed without reading the whole body"""
+        body = self.Body(b"<html><script>" + b"x" * 1024 * 1024)
+        mock.return_value = Response()
+        mock.return_value.status_code = 200
+        mock.return_value.raw = body
+        rules = [ValidatorSpecRule("http://example.com", content={"present": ["script"]})]
+        validator = Validator(YamlValidatorSpec(rules), stream=True)
+        results = list(validator.validate())
+        self.assertIsInstance(results[0], ValidationPass)
+        self.assertEqual(mock.call_args[1]["stream"], True)
+        self.assertTrue(body.closed_early)
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path, self.client_address))
+        body = b"x" * (1024 * 1024 if self.path == "/big" else 16)
+        self.send_response(200)
+        if self.path == "/bogus-charset":
+            self.send_header("Content-Type", "text/plain; charset=bogus")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class TestValidatorHeaderOnly(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def run_rules(self, rules, **kwargs):
+        validator = Validator(YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, **kwargs)
+        results = list(validator.validate())
+        validator.close()
+        return results
+
+    def test_needs_body(self):
+        """Rules are classified by whether they test the response body"""
+        self.assertFalse(ValidatorSpecRule("http://example.com", status_code=200).needs_body)
+        self.assertFalse(
+            ValidatorSpecRule("http://example.com", status_code=301, headers={"a": "b"}).needs_body
+        )
+        self.assertTrue(
+            ValidatorSpecRule("http://example.com", content={"present": ["a"]}).needs_body
+        )
+        self.assertTrue(ValidatorSpecRule("http://example.com", text="foo").needs_body)
+
+    def test_header_only_keep_alive(self):
+        """Header only rules keep small response connections alive"""
+        rules = [ValidatorSpecRule("http://example.com/small", status_code=200)] * 3
+        results = self.run_rules(rules, keep_responses=True)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+            self.assertFalse(result.response._content)
+        clients = set(client for _, _, client in self.server.requests)
+        self.assertEqual(len(clients), 1)
+
+    def test_header_only_large_body(self):
+        """Header only rules don't download large response bodies"""
+        rules = [ValidatorSpecRule("http://example.com/big", status_code=200)] * 2
+        results = self.run_rules(rules, keep_responses=True)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+            self.assertFalse(result.response._content)
+
+    def test_stream_unknown_charset(self):
+        """Streamed responses with an unknown charset are still matched"""
+        rules = [
+            ValidatorSpecRule(
+                "http://example.com/bogus-charset", status_code=200, content={"present": ["xx"]}
+            )
+        ] * 2
+        for concurrency in (1, 4):
+            results = self.run_rules(rules, stream=True, concurrency=concurrency, dedupe=False)
+            self.assertEqual(len(results), 2)
+            for result in results:
+                self.assertIsInstance(result, ValidationPass)
+
+    def test_compact_results(self):
+        """Results keep the response outcome, without the response"""
+        rules = [
+            ValidatorSpecRule("http://example.com/small", status_code=200, text="x" * 16),
+            ValidatorSpecRule("http://example.com/big", status_code=404),
+        ]
+        (passed, failed) = self.run_rules(rules, dedupe=False)
+        self.assertIsInstance(passed, ValidationPass)
+        self.assertIsNone(passed.response)
+        self.assertIsNone(passed.request)
+        self.assertEqual(passed.status, 200)
+        self.assertEqual(passed.size, 16)
+        self.assertIsNotNone(passed.elapsed)
+        self.assertIsInstance(failed, ValidationFail)
+        self.assertEqual(failed.status, 200)
+        self.assertEqual(failed.mismatch(), (404, 200))
+        self.assertFalse(hasattr(passed, "__dict__"))
+
+    def test_compact_errors(self):
+        """Errors of compact results don't keep the response body"""
+        rules = [ValidatorSpecRule("http://example.com/big", text="x")]
+        (failed,) = self.run_rules(rules)
+        self.assertIsNone(failed.error.__traceback__)
+        (expected, received) = failed.mismatch()
+        self.assertEqual(expected, "x")
+        self.assertEqual(len(received), MISMATCH_LIMIT + 3)
+        (failed,) = self.run_rules(rules, keep_responses=True)
+        self.assertEqual(len(failed.mismatch()[1]), 1024 * 1024)
+
+    def test_head(self):
+        """Header only rules send HEAD requests when enabled"""
+        rules = [
+            ValidatorSpecRule("http://example.com/big", status_code=200),
+            ValidatorSpecRule("http://example.com/small", content={"present": ["xxx"]}),
+        ]
+        results = self.run_rules(rules, head=True)
+        for result in results:
+            self.assertIsInstance(result, ValidationPass)
+        self.assertEqual(
+            [(method, path) for method, path, _ in self.server.requests],
+            [("HEAD", "/big"), ("GET", "/small")],
+        )
+        clients = set(client for _, _, client in self.server.requests)
+        self.assertEqual(len(clients), 1)
+
+
+class TestValidatorShard(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+        self.rules = [
+            ValidatorSpecRule("http://example.com/{0}".format(n), status_code=200 if n % 5 else 404)
+            for n in range(40)
+        ]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_parse_shard(self):
+        """Parse shard numbers"""
+        self.assertEqual(parse_shard("1/1"), (1, 1))
+        self.assertEqual(parse_shard("2/4"), (2, 4))
+        for value in ("0/4", "5/4", "1", "a/b", "1/2/3"):
+            self.assertRaises(ValueError, parse_shard, value)
+
+    def test_shards(self):
+        """Every rule runs in exactly one shard"""
+        uris = []
+        for index in range(1, 4):
+            validator = Validator(YamlValidatorSpec(self.rules), shard=(index, 3))
+            shard_uris = [rule.uri for rules, _, _ in validator.get_jobs() for rule in rules]
+            self.assertTrue(shard_uris)
+            uris.extend(shard_uris)
+        self.assertEqual(sorted(uris), sorted(rule.uri for rule in self.rules))
+        self.assertTrue(in_shard("http://example.com/1", 1, 1))
+
+    def test_pickle_result(self):
+        """Results are pickled without responses, keeping mismatches"""
+        resp = Response()
+        error = ValidationError("Response mismatch: status_code", mismatch=(200, 404))
+        result = ValidationFail(
+            rule=self.rules[0], request=None, response=resp, error=error, host="a"
+        )
+        result = pickle.loads(pickle.dumps(result))
+        self.assertIsNone(result.response)
+        self.assertEqual(result.host, "a")
+        self.assertEqual(result.rule.uri, self.rules[0].uri)
+        self.assertEqual(result.mismatch(), (200, 404))
+        resp.status_code = 404
+        self.assertTrue(result.rule.compile().matches(resp))
+
+    def test_processes(self):
+        """Worker processes results are merged"""
+        validator = Validator(
+            YamlValidatorSpec(self.rules), host="127.0.0.1", port=self.port, processes=3
+        )
+        results = list(validator.validate())
+        self.assertEqual(
+            sorted(result.rule.uri for result in results),
+            sorted(rule.uri for rule in self.rules),
+        )
+        failures = [result for result in results if isinstance(result, ValidationFail)]
+        self.assertEqual(len(failures), 8)
+        self.assertEqual(failures[0].mismatch(), (404, 200))
+        self.assertEqual(len(self.server.requests), 40)
+
+    def test_processes_shard(self):
+        """Worker processes split the shard of the validator"""
+        validator = Validator(
+            YamlValidatorSpec(self.rules),
+            host="127.0.0.1",
+            port=self.port,
+            shard=(2, 3),
+            processes=2,
+        )
+        expected = Validator(YamlValidatorSpec(self.rules), shard=(2, 3))
+        self.assertEqual(
+            sorted(result.rule.uri for result in validator.validate()),
+            sorted(rule.uri for rules, _, _ in expected.get_jobs() for rule in rules),
+        )
+
+
+class TestValidatorDedupe(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), LocalHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+        self.path = tempfile.mkdtemp()
+        self.spec_file = os.path.join(self.path, "spec.jsonl")
+        with open(self.spec_file, "w") as handle:
+            handle.write(
+                '{"uri": "http://example.com/a", "status_code": 200}\n'
+                '{"uri": "http://example.com/b", "status_code": 200}\n'
+                '{"uri": "http://example.com/a", "content": {"present": ["xxx"]}}\n'
+                '{"uri": "http://example.com/a", "request": {"method": "GET"}, "status_code": 404}\n'
+                '{"uri": "http://example.com/a", "request": {"headers": {"a": "b"}}}\n'
+            )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.path)
+
+    def run_spec(self, lazy=False, **kwargs):
+        validator = Validator.load(
+            self.spec_file, host="127.0.0.1", port=self.port, lazy=lazy, **kwargs
+        )
+        results = list(validator.validate())
+        validator.close()
+        return results
+
+    def test_request_key(self):
+        """Rules sending the same request have the same key"""
+        rule = ValidatorSpecRule("http://example.com/a", request={"method": "get"})
+        self.assertEqual(
+            rule.request_key(),
+            ValidatorSpecRule("http://example.com/a", status_code=200).request_key(),
+        )
+        self.assertNotEqual(
+            rule.request_key(),
+            ValidatorSpecRule("http://example.com/a", request={"method": "head"}).request_key(),
+        )
+
+    def test_dedupe(self):
+        """Rules sending the same request share a response"""
+        for concurrency in (1, 4):
+            self.server.requests = []
+            results = self.run_spec(concurrency=concurrency)
+            self.assertEqual(
+                [(result.rule.uri, result.shared) for result in results],
+                [
+                    ("http://example.com/a", False),
+                    ("http://example.com/a", True),
+                    ("http://example.com/a", True),
+                    ("http://example.com/b", False),
+                    ("http://example.com/a", False),
+                ],
+            )
+            self.assertEqual(
+                [isinstance(result, ValidationPass) for result in results],
+                [True, True, False, True, True],
+            )
+            self.assertEqual(len(self.server.requests), 3)
+
+    def test_no_dedupe(self):
+        """Every rule sends a request without dedupe"""
+        results = self.run_spec(dedupe=False)
+        self.assertEqual(len(results), 5)
+        self.assertFalse(any(result.shared for result in results))
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_response_cache(self):
+        """Cached responses are reused by later rules"""
+        results = self.run_spec(lazy=True)
+        self.assertEqual(len(self.server.requests), 5)
+        self.server.requests = []
+        results = self.run_spec(lazy=True, cache_responses=True)
+        self.assertEqual([result.shared for result in results], [False, False, True, True, False])
+        self.assertEqual(
+            [isinstance(result, ValidationPass) for result in results],
+            [True, True, True, False, True],
+        )
+        self.assertEqual(len(self.server.requests), 3)
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/slow/") or self.path == "/slow":
+            time.sleep(0.3)
+        self.send_response(200)
+        self.send_header("Content-Length", "16")
+        self.end_headers()
+        self.wfile.flush()
+        if self.path == "/slow-body":
+            time.sleep(0.3)
+        self.wfile.write(b"x" * 16)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestValidatorTimeout(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def run_rules(self, rules, **kwargs):
+        validator = Validator(YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, **kwargs)
+        results = list(validator.validate())
+        validator.close()
+        return results
+
+    def test_timeout(self):
+        """Timed out requests fail with a timeout error"""
+        rules = [
+            ValidatorSpecRule("http://example.com/slow", status_code=200),
+            ValidatorSpecRule("http://example.com/slow", timeout=1, status_code=200),
+            ValidatorSpecRule("http://example.com/fast", status_code=200),
+        ]
+        results = self.run_rules(rules, timeout=0.1, dedupe=False)
+        self.assertIsInstance(results[0], ValidationFail)
+        self.assertIsInstance(results[0].error, ValidationTimeout)
+        self.assertEqual(str(results[0].error), "Request timed out after 0.1s")
+        self.assertIsNone(results[0].elapsed)
+        self.assertIsInstance(results[1], ValidationPass)
+        self.assertGreater(results[1].elapsed, 0.2)
+        self.assertIsInstance(results[2], ValidationPass)
+
+    def test_body_timeout(self):
+        """Timeouts reading the response body fail with a timeout error"""
+        rule = ValidatorSpecRule("http://example.com/slow-body", content={"present": ["x"]})
+        for stream in (False, True):
+            results = self.run_rules([rule], timeout=0.1, stream=stream)
+            self.assertIsInstance(results[0].error, ValidationTimeout)
+
+    def test_group_timeout(self):
+        """Rules sharing a request wait for the longest timeout"""
+        validator = Validator(YamlValidatorSpec([]), timeout=1)
+        rules = [
+            ValidatorSpecRule("http://example.com/", timeout=2),
+            ValidatorSpecRule("http://example.com/"),
+        ]
+        self.assertEqual(validator.get_timeout(rules), 2)
+        self.assertEqual(validator.get_timeout(rules[1:]), 1)
+        validator.timeout = None
+        self.assertIsNone(validator.get_timeout(rules))
+
+    def test_max_failures(self):
+        """Validation stops after the maximum number of failures"""
+        rules = [
+            ValidatorSpecRule("http://example.com/{0}".format(n), status_code=404)
+            for n in range(20)
+        ]
+        for concurrency in (1, 4):
+            validator = Validator(
+                YamlValidatorSpec(rules),
+                host="127.0.0.1",
+                port=self.port,
+                concurrency=concurrency,
+                max_failures=3,
+            )
+            results = list(validator.validate())
+            validator.close()
+            self.assertEqual(len(results), 3)
+            self.assertEqual(validator.stopped, "max_failures")
+            self.assertEqual(validator.failures, 3)
+
+    def test_deadline(self):
+        """No requests are sent after the deadline, requests in flight are cut short"""
+        rules = [
+            ValidatorSpecRule("http://example.com/slow/{0}".format(n), status_code=200)
+            for n in range(10)
+        ]
+        for concurrency in (1, 2):
+            validator = Validator(
+                YamlValidatorSpec(rules),
+                host="127.0.0.1",
+                port=self.port,
+                concurrency=concurrency,
+                deadline=0.5,
+            )
+            start = time.monotonic()
+            results = list(validator.validate())
+            validator.close()
+            self.assertLess(time.monotonic() - start, 1.0)
+            self.assertLess(len(results), 5)
+            self.assertIsInstance(results[0], ValidationPass)
+            self.assertIsInstance(results[-1].error, ValidationTimeout)
+            self.assertEqual(validator.stopped, "deadline")
+
+    def test_deadline_timeout(self):
+        """Request timeouts are capped to the time left before the deadline"""
+        validator = Validator(YamlValidatorSpec([]), timeout=10, deadline=2)
+        rules = [ValidatorSpecRule("http://example.com/")]
+        self.assertEqual(validator.get_timeout(rules), 10)
+        validator.start_run()
+        self.assertLessEqual(validator.get_timeout(rules), 2)
+
+    def test_percentiles(self):
+        """Percentiles are nearest rank"""
+        self.assertIsNone(get_percentiles([]))
+        self.assertEqual(get_percentiles([3]), [3, 3, 3])
+        values = list(range(100, 0, -1))
+        self.assertEqual(get_percentiles(values), [50, 95, 99])
+        self.assertEqual(get_percentiles(values, (0, 100)), [1, 100])
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """Drops the first connection to each path starting with /flaky, truncates
+    the first response to /truncated, and responds late to the first request
+    to /slow"""
+
+    protocol_version = "HTTP/1.1"
+    # Write each response at once, instead of waiting on delayed ACKs
+    wbufsize = -1
+
+    def do_GET(self):
+        with self.server.lock:
+            count = self.server.counts.get(self.path, 0)
+            self.server.counts[self.path] = count + 1
+        if self.path.startswith("/flaky") and count == 0:
+            self.close_connection = True
+            return
+        if self.path == "/slow" and count == 0:
+            time.sleep(1)
+        self.send_response(200)
+        if self.path == "/truncated" and count == 0:
+            self.send_header("Content-Length", "100")
+            self.end_headers()
+            self.wfile.write(b"ok")
+            self.close_connection = True
+            return
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class TestValidatorRetries(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+        self.server.daemon_threads = True
+        self.server.counts = {}
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def run_rules(self, rules, **kwargs):
+        validator = Validator(YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, **kwargs)
+        results = list(validator.validate())
+        validator.close()
+        return results
+
+    def test_retry(self):
+        """Dropped connections are retried, and results count the attempts"""
+        rules = [ValidatorSpecRule("http://example.com/flaky", status_code=200)]
+        (result,) = self.run_rules(rules, retries=2, retry_backoff=0.01)
+        self.assertIsInstance(result, ValidationPass)
+        self.assertEqual(result.attempts, 2)
+
+    def test_no_retry(self):
+        """Without retries, dropped connections fail"""
+        rules = [ValidatorSpecRule("http://example.com/flaky", status_code=200)]
+        (result,) = self.run_rules(rules)
+        self.assertIsInstance(result, ValidationFail)
+        self.assertEqual(result.attempts, 1)
+
+    def test_no_retry_post(self):
+        """Requests that aren't idempotent aren't retried"""
+        rules = [
+            ValidatorSpecRule(
+                "http://example.com/flaky-post", request={"method": "post"}, status_code=200
+            )
+        ]
+        (result,) = self.run_rules(rules, retries=2, retry_backoff=0.01)
+        self.assertIsInstance(result, ValidationFail)
+        self.assertEqual(result.attempts, 1)
+
+    def test_retry_truncated(self):
+        """Responses cut short before the end of their body are retried"""
+        rules = [
+            ValidatorSpecRule(
+                "http://example.com/truncated", status_code=200, content={"present": ["ok"]}
+            )
+        ]
+        (result,) = self.run_rules(rules, retries=2, retry_backoff=0.01)
+        self.assertIsInstance(result, ValidationPass)
+        self.assertEqual(result.attempts, 2)
+
+    def test_truncated(self):
+        """Without retries, responses cut short fail their rule"""
+        rules = [
+            ValidatorSpecRule(
+                "http://example.com/truncated", status_code=200, content={"present": ["ok"]}
+            ),
+            ValidatorSpecRule("http://example.com/ok", status_code=200),
+        ]
+        results = self.run_rules(rules)
+        self.assertIsInstance(results[0], ValidationFail)
+        self.assertIsInstance(results[0].error, ChunkedEncodingError)
+        self.assertIsInstance(results[1], ValidationPass)
+
+    def test_hedge(self):
+        """Requests slower than the run's 95th percentile are sent again"""
+        rules = [
+            ValidatorSpecRule("http://example.com/{0}".format(n), status_code=200)
+            for n in range(30)
+        ]
+        rules.append(ValidatorSpecRule("http://example.com/slow", status_code=200))
+        validator = Validator(
+            YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, hedge=True
+        )
+        start = time.monotonic()
+        results = list(validator.validate())
+        self.assertLess(time.monotonic() - start, 0.8)
+        validator.close()
+        self.assertTrue(all(isinstance(result, ValidationPass) for result in results))
+        self.assertEqual(results[-1].attempts, 2)
+        self.assertEqual(self.server.counts["/slow"], 2)
+        self.assertEqual(set(result.attempts for result in results[:20]), set([1]))
+
+    def test_is_retryable(self):
+        """Only connection errors of idempotent requests are retried"""
+        self.assertTrue(is_retryable(ConnectionError(), "GET"))
+        self.assertTrue(is_retryable(ChunkedEncodingError(), "GET"))
+        self.assertFalse(is_retryable(ChunkedEncodingError(), "POST"))
+        self.assertTrue(is_retryable(ConnectTimeout(), "POST"))
+        self.assertFalse(is_retryable(ConnectionError(), "POST"))
+        self.assertFalse(is_retryable(ReadTimeout(), "GET"))
+        self.assertFalse(is_retryable(SSLError(), "GET"))
+        self.assertFalse(is_retryable(ValueError(), "GET"))
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import TestCase
+from unittest import skipIf
+
+from mock import Mock
+
+from validatehttp.spec import ValidatorSpecRule
+from validatehttp.spec import YamlValidatorSpec
+from validatehttp.validate import ValidationPass
+from validatehttp.validate import Validator
+from validatehttp.watch import SpecWatcher
+
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+if aiohttp is not None:
+    from validatehttp.aio import AsyncValidator
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        etag = '"{0}"'.format(self.path)
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSpecWatcher(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.spec_file = os.path.join(self.tmp_dir, "spec.json")
+        self.write_spec({"http://example.com/a": {}, "http://example.com/b": {}})
+        self.validator = Validator.load(self.spec_file)
+        self.cli = Mock(validator=self.validator)
+        self.cli.run.side_effect = lambda: [rule.uri for rule in self.validator.spec.rules]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_spec(self, rules):
+        with open(self.spec_file, "w") as handle:
+            json.dump(rules, handle)
+
+    def test_update(self):
+        """Only added and changed rules are validated"""
+        watcher = SpecWatcher(self.cli, self.spec_file)
+        watcher.diff(self.validator.spec)
+        self.write_spec(
+            {
+                "http://example.com/a": {},
+                "http://example.com/b": {"status_code": 404},
+                "http://example.com/c": {},
+            }
+        )
+        self.assertEqual(watcher.update(), ["http://example.com/b", "http://example.com/c"])
+        self.write_spec({"http://example.com/a": {}})
+        self.assertEqual(watcher.update(), [])
+        self.assertEqual(watcher.diff(Validator.load_spec(self.spec_file)), ([], 1, 0))
+
+    def test_revalidate(self):
+        """Unchanged rules are validated again with revalidation"""
+        watcher = SpecWatcher(self.cli, self.spec_file, revalidate=True)
+        watcher.diff(self.validator.spec)
+        self.write_spec({"http://example.com/c": {}, "http://example.com/a": {}})
+        (rules, unchanged, removed) = watcher.diff(Validator.load_spec(self.spec_file))
+        self.assertEqual(
+            [rule.uri for rule in rules], ["http://example.com/c", "http://example.com/a"]
+        )
+        self.assertEqual((unchanged, removed), (1, 1))
+
+    def test_invalid_spec(self):
+        """Spec files that can't be loaded are skipped"""
+        watcher = SpecWatcher(self.cli, self.spec_file)
+        with open(self.spec_file, "w") as handle:
+            handle.write("{")
+        self.assertIsNone(watcher.update())
+        self.assertFalse(self.cli.run.called)
+
+
+class TestRevalidate(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ETagHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_revalidate(self):
+        """Results are reused when the response is not modified"""
+        self.assert_revalidates(Validator, lambda validator: list(validator.validate()))
+
+    @skipIf(aiohttp is None, "aiohttp is not installed")
+    def test_revalidate_async(self):
+        """Results are reused when the response is not modified, with asyncio"""
+
+        async def collect(validator):
+            return [result async for result in validator.validate()]
+
+        self.assert_revalidates(AsyncValidator, lambda validator: asyncio.run(collect(validator)))
+
+    def assert_revalidates(self, validator_class, collect):
+        rules = [
+            ValidatorSpecRule("http://example.com/a", status_code=200, text="ok"),
+            ValidatorSpecRule("http://example.com/b", status_code=200),
+        ]
+        validator = validator_class(
+            YamlValidatorSpec(rules), host="127.0.0.1", port=self.port, revalidate=True
+        )
+        results = collect(validator)
+        self.assertFalse(any(result.revalidated for result in results))
+
+        # Reloaded rules are revalidated, changed rules are not
+        validator.spec = YamlValidatorSpec(
+            [
+                ValidatorSpecRule("http://example.com/a", status_code=200, text="ok"),
+                ValidatorSpecRule("http://example.com/b", status_code=201),
+            ]
+        )
+        results = collect(validator)
+        validator.close()
+        self.assertIsInstance(results[0], ValidationPass)
+        self.assertTrue(results[0].revalidated)
+        self.assertEqual(results[0].status, 200)
+        self.assertFalse(results[1].revalidated)
+        self.assertEqual(results[1].mismatch(), (201, 200))
+        self.assertEqual(
+            self.server.requests[2:],
+            [("/a", '"/a"'), ("/b", None)],
+        )
@@ -0,0 +1,564 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run validation rules on an asyncio event loop
+
+This module mirrors :py:mod:`validatehttp.validate`, but performs requests
+with aiohttp, so that a single process can keep thousands of requests in
+flight. Responses are converted to :py:cls:`requests.Response` objects, so
+spec rules are matched exactly as they are with the threaded validator.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import asyncio
+import socket
+import time
+from collections import deque
+from datetime import timedelta
+
+from requests import Response
+from requests.compat import urlsplit
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .schedule import get_backoff
+from .spec import ValidationError
+from .spec import ValidationTimeout
+from .transport import RESOLVE_TTL
+from .transport import RequestTiming
+from .validate import DRAIN_LIMIT
+from .validate import IDEMPOTENT_METHODS
+from .validate import SAFE_METHODS
+from .validate import ValidationFail
+from .validate import ValidationPass
+from .validate import Validator
+from .validate import set_attempts
+
+
+class AsyncValidator(Validator):
+    """Create object to run validation on an event loop
+
+    Iterate over results with ``async for result in validator.validate()``.
+
+    :param spec: Validation spec instance
+    :type spec: ValidatorSpec
+    :param host: Host address to perform requests against
+    :param port: Host port to perform requests against
+    :param concurrency: Maximum number of requests in flight at once
+    :param ordered: Yield results in spec order, instead of completion order
+    :param hosts: List of host addresses to run every rule against
+    """
+
+    def __init__(self, spec, host=None, port=None, verify=True, debug=False, **kwargs):
+        if aiohttp is None:
+            raise NameError("Async support is missing")
+        kwargs["concurrency"] = kwargs.get("concurrency") or 100
+        super(AsyncValidator, self).__init__(spec, host, port, verify, debug, **kwargs)
+
+    def __repr__(self):
+        """String representation of validator instance"""
+        return "<AsyncValidator spec={spec}>".format(**self.__dict__)
+
+    async def validate(self):
+        """Run validation using HTTP requests against validation host
+
+        This is an asynchronous generator, yielding either a
+        :py:cls:`ValidationPass` or :py:cls:`ValidationFail` response for each
+        rule in the spec. The number of requests in flight is capped by a
+        semaphore sized to the validator concurrency.
+        """
+        self.start_run()
+        try:
+            if self.processes > 1:
+                # Worker processes run their own event loops, this one only waits
+                results = self.fork()
+                for result in results:
+                    yield result
+                    if self.add_result(result):
+                        results.close()
+                        return
+                return
+            resolver = PinnedResolver(self.resolver.pinned)
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=0,
+                resolver=resolver,
+                ttl_dns_cache=RESOLVE_TTL,
+            )
+            try:
+                async with aiohttp.ClientSession(
+                    connector=connector, trace_configs=[timing_trace()]
+                ) as session:
+                    results = self._run(session)
+                    async for result in results:
+                        yield result
+                        if self.add_result(result):
+                            # Closing the results cancels requests not yet sent
+                            await results.aclose()
+                            return
+            finally:
+                await resolver.close()
+        finally:
+            self.finish_run()
+
+    async def _run(self, session):
+        """Run checks over session, with a bounded number of pending rules"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # Notified as requests complete, for requests waiting on the scheduler
+        self._slots = asyncio.Condition()
+        window = self.concurrency * 2
+        pending = deque()
+        try:
+            for rules, host, port in self.get_jobs():
+                pending.append(
+                    asyncio.ensure_future(self._bounded(semaphore, session, rules, host, port))
+                )
+                if len(pending) >= window:
+                    async for results in self._collect(pending):
+                        for result in results:
+                            yield result
+            while pending:
+                async for results in self._collect(pending):
+                    for result in results:
+                        yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def check(self, session, rule, host=None, port=None):
+        """Perform request for a single rule and return the validation result
+
+        :param session: Client session to send the request over
+        :type session: aiohttp.ClientSession
+        :param rule: Spec rule to request and validate
+        :type rule: ValidatorSpecRule
+        :param host: Host address to perform request against
+        :param port: Host port to perform request against
+        """
+        return (await self.check_group(session, [rule], host, port))[0]
+
+    async def check_group(self, session, rules, host=None, port=None):
+        """Perform one request for a group of rules and return their results
+
+        :param session: Client session to send the request over
+        :type session: aiohttp.ClientSession
+        :param rules: Spec rules sending the same request
+        :type rules: list
+        :param host: Host address to perform request against
+        :param port: Host port to perform request against
+        """
+        if self.get_remaining() == 0:
+            # Queued before the deadline passed
+            return []
+        compiled = [rule.compile() for rule in rules]
+        needs_body = any(compiled_rule.needs_body for compiled_rule in compiled)
+        prepared = compiled[0].prepare(host, port)
+        timeout = self.get_timeout(rules)
+        cache_key = None
+        resp = None
+        if self.response_cache is not None:
+            cache_key = (rules[0].request_key(), host, port)
+            resp = self.response_cache.get(cache_key)
+        if self.head and not needs_body and prepared.method == "GET" and cache_key is None:
+            prepared.method = "HEAD"
+        revalidate = self.get_revalidation(rules, host, port)
+        if revalidate is not None:
+            prepared.headers["If-None-Match"] = revalidate[0]
+        if self.debug:
+            self.debug_print(prepared)
+        shared = resp is not None
+        attempts = 1
+        if resp is None:
+            # Rules without body assertions only wait for the response
+            # headers, cached responses are read in full
+            read_body = needs_body or cache_key is not None
+            (resp, error, attempts) = await self.fetch(session, prepared, timeout, read_body)
+            if resp is None:
+                # No response yet, or the response body timed out
+                if isinstance(error, asyncio.TimeoutError):
+                    error = ValidationTimeout(timeout)
+                return set_attempts(
+                    [
+                        ValidationFail(
+                            rule=rule,
+                            request=prepared,
+                            response=None,
+                            error=error,
+                            host=host,
+                            shared=n > 0,
+                            keep=self.keep_responses,
+                        )
+                        for (n, rule) in enumerate(rules)
+                    ],
+                    attempts,
+                )
+            if cache_key is not None:
+                self.response_cache[cache_key] = resp
+        if self.debug:
+            self.debug_print(resp)
+        if revalidate is not None and resp.status_code == 304:
+            return set_attempts(
+                [
+                    result.revalidate(resp, shared or n > 0)
+                    for (n, result) in enumerate(revalidate[1])
+                ],
+                attempts,
+            )
+        results = []
+        for n, (rule, compiled_rule) in enumerate(zip(rules, compiled)):
+            try:
+                if compiled_rule.matches(resp):
+                    results.append(
+                        ValidationPass(
+                            rule=rule,
+                            request=prepared,
+                            response=resp,
+                            host=host,
+                            shared=shared or n > 0,
+                            keep=self.keep_responses,
+                        )
+                    )
+            except ValidationError as exc:
+                # Response received, validation error
+                results.append(
+                    ValidationFail(
+                        rule=rule,
+                        request=prepared,
+                        response=resp,
+                        error=exc,
+                        host=host,
+                        shared=shared or n > 0,
+                        keep=self.keep_responses,
+                    )
+                )
+        set_attempts(results, attempts)
+        if self.etags is not None and resp.headers.get("ETag"):
+            self.etags[(rules[0].request_key(), host, port)] = (resp.headers["ETag"], results)
+        return results
+
+    async def fetch(self, session, prepared, timeout=None, read_body=True):
+        """Send request, retrying connection errors and hedging slow requests
+
+        See :py:meth:`Validator.fetch`.
+
+        :returns: Tuple of the response, or None if every attempt failed, the
+            error of the last attempt, and the number of requests sent
+        """
+        attempts = 0
+        retry = 0
+        while True:
+            (resp, error, sent) = await self.send_hedged(session, prepared, timeout, read_body)
+            attempts += sent
+            if (
+                resp is not None
+                or retry >= self.retries
+                or not is_retryable(error, prepared.method)
+            ):
+                return (resp, error, attempts)
+            retry += 1
+            delay = get_backoff(retry, self.retry_backoff)
+            remaining = self.get_remaining()
+            if remaining is not None:
+                if delay >= remaining:
+                    return (resp, error, attempts)
+                timeout = min(timeout or remaining, remaining - delay)
+            await asyncio.sleep(delay)
+
+    async def send_hedged(self, session, prepared, timeout=None, read_body=True):
+        """Send request, and a duplicate request if the response is slow
+
+        The first response wins, and the other request is cancelled.
+
+        :returns: Tuple of the response, or None if the request failed, the
+            error, and the number of requests sent
+        """
+        delay = None
+        if self.hedge_delay is not None and prepared.method in SAFE_METHODS:
+            delay = self.hedge_delay.get()
+        start = time.monotonic()
+        if delay is None:
+            try:
+                resp = await self.send(session, prepared, timeout, read_body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                # Connection errors, and malformed or truncated responses
+                return (None, exc, 1)
+            if self.hedge_delay is not None:
+                self.hedge_delay.add(time.monotonic() - start)
+            return (resp, None, 1)
+        tasks = [asyncio.ensure_future(self.send(session, prepared, timeout, read_body))]
+        winner = None
+        pending = set(tasks)
+        try:
+            (done, _) = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                hedge = self.send(session, prepared.copy(), timeout, read_body)
+                tasks.append(asyncio.ensure_future(hedge))
+                pending.add(tasks[-1])
+            while pending and winner is None:
+                (done, pending) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and task.exception() is None and winner is None:
+                        winner = task
+        finally:
+            for task in pending:
+                task.cancel()
+        if winner is None:
+            error = tasks[0].exception()
+            if not isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+                raise error
+            return (None, error, len(tasks))
+        self.hedge_delay.add(time.monotonic() - start)
+        return (winner.result(), None, len(tasks))
+
+    async def send(self, session, prepared, timeout=None, read_body=True):
+        """Send request over session, paced by the scheduler
+
+        :param session: Client session to send the request over
+        :type session: aiohttp.ClientSession
+        :param prepared: Request to send
+        :type prepared: requests.PreparedRequest
+        :param timeout: Seconds to wait for the server to connect and respond
+        :param read_body: Read the response body. Otherwise, small or empty
+            bodies are still read, to keep the connection alive, and the
+            connection is closed instead of downloading larger bodies, as
+            with :py:func:`~validatehttp.validate.release_response`.
+        :returns: Response, with the body already read, or without a body
+        :rtype: Response
+        """
+        netloc = None
+        if self.scheduler is not None:
+            netloc = urlsplit(prepared.url).netloc
+            await self._acquire(netloc)
+        resp = None
+        timing = RequestTiming()
+        kwargs = {}
+        if prepared.url.startswith("https://") and "Host" in prepared.headers:
+            # Sent to a host address, check TLS against the host name
+            kwargs["server_hostname"] = prepared.headers["Host"]
+        try:
+            start = time.monotonic()
+            async with session.request(
+                prepared.method,
+                prepared.url,
+                headers=dict(prepared.headers),
+                data=prepared.body,
+                allow_redirects=False,
+                ssl=None if self.verify else False,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout),
+                trace_request_ctx=timing,
+                **kwargs,
+            ) as aresp:
+                # Time to response headers, as with requests
+                now = time.monotonic()
+                elapsed = timedelta(seconds=now - start)
+                timing.wait = now - (timing._mark or start)
+                timing._mark = now
+                body = None
+                if read_body or is_drainable(aresp, prepared.method):
+                    body = await aresp.read()
+                timing.finish(len(body or b""))
+            resp = build_response(prepared, aresp, body, elapsed)
+            resp.timing = timing
+            return resp
+        finally:
+            if netloc is not None:
+                await self._release(netloc, resp)
+
+    async def _acquire(self, netloc):
+        """Wait until the scheduler allows a request to host"""
+        (bucket, limit) = self.scheduler.get_host(netloc)
+        if limit is not None:
+            async with self._slots:
+                await self._slots.wait_for(limit.try_acquire)
+        if bucket is not None:
+            delay = bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def _release(self, netloc, resp):
+        """Record the outcome of a request to host with the scheduler"""
+        if resp is None:
+            self.scheduler.release(netloc, ok=False)
+        else:
+            self.scheduler.release(netloc, resp.elapsed.total_seconds(), resp.status_code < 500)
+        async with self._slots:
+            self._slots.notify_all()
+
+    async def _bounded(self, semaphore, session, rules, host, port):
+        async with semaphore:
+            return await self.check_group(session, rules, host, port)
+
+    async def _collect(self, pending):
+        """Wait for pending checks and pop finished result lists off the queue"""
+        if self.ordered:
+            yield await pending.popleft()
+            return
+        (done, _) = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            pending.remove(task)
+            yield task.result()
+
+
+def is_drainable(aresp, method, drain_limit=DRAIN_LIMIT):
+    """Test whether an unneeded response body is small enough to read
+
+    :param aresp: Response from aiohttp, before the body is read
+    :param method: Request method
+    :param drain_limit: Largest body size, in bytes, to read
+    """
+    length = aresp.headers.get("Content-Length", "")
+    return (
+        method == "HEAD"
+        or aresp.status in (204, 304)
+        or (length.isdigit() and int(length) <= drain_limit)
+    )
+
+
+def build_response(prepared, aresp, body, elapsed):
+    """Convert aiohttp response to a :py:cls:`requests.Response`
+
+    :param prepared: Request that was sent
+    :type prepared: requests.PreparedRequest
+    :param aresp: Response from aiohttp, with body already read
+    :param body: Raw response body, or None if the body wasn't read
+    :param elapsed: Time taken from sending the request to receiving the
+        response headers
+    """
+    resp = Response()
+    resp.status_code = aresp.status
+    resp.reason = aresp.reason
+    resp.headers = CaseInsensitiveDict(
+        (key, ", ".join(aresp.headers.getall(key))) for key in aresp.headers.keys()
+    )
+    resp.encoding = get_encoding_from_headers(resp.headers)
+    resp.url = str(aresp.url)
+    resp.request = prepared
+    resp.elapsed = elapsed
+    resp._content = body
+    return resp
+
+
+class PinnedResolver(object):
+    """aiohttp resolver, connecting pinned host names to their pinned addresses
+
+    Other host names are resolved by the default aiohttp resolver, and cached
+    by the connector.
+
+    :param pinned: Mapping of lower case host name and port to a list of
+        addresses, see :py:cls:`~validatehttp.transport.Resolver`
+    """
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.resolver = aiohttp.DefaultResolver()
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addresses = self.pinned.get((host.lower(), int(port)))
+        if addresses is None:
+            return await self.resolver.resolve(host, port, family)
+        return [
+            {
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": socket.AF_INET6 if ":" in address else socket.AF_INET,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST,
+            }
+            for address in addresses
+        ]
+
+    async def close(self):
+        await self.resolver.close()
+
+
+def is_retryable(error, method):
+    """Test whether a request can be retried after an error
+
+    As with :py:func:`~validatehttp.validate.is_retryable`, requests that
+    timed out connecting are retried whatever their method, idempotent
+    requests are retried after other connection errors, or malformed or
+    truncated responses, and no requests are retried after other timeouts or
+    TLS errors.
+
+    :param error: Request error
+    :param method: Request method
+    """
+    connect_timeout = getattr(aiohttp, "ConnectionTimeoutError", None)
+    if connect_timeout is not None and isinstance(error, connect_timeout):
+        return True
+    if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientSSLError)):
+        return False
+    return isinstance(error, aiohttp.ClientError) and method in IDEMPOTENT_METHODS
+
+
+def timing_trace():
+    """Return aiohttp trace config, recording request phases
+
+    Phases are recorded on the :py:cls:`RequestTiming` record passed to each
+    request as ``trace_request_ctx``. aiohttp doesn't report TLS handshakes
+    separately, they are included in the connect phase. Bytes received are
+    counted after content decoding.
+    """
+
+    async def mark(session, context, params):
+        context.trace_request_ctx._mark = time.monotonic()
+
+    async def dns_start(session, context, params):
+        context.dns_start = time.monotonic()
+
+    async def dns_end(session, context, params):
+        context.trace_request_ctx.dns = time.monotonic() - context.dns_start
+
+    async def connect_start(session, context, params):
+        context.trace_request_ctx.reused = False
+        context.connect_start = time.monotonic()
+
+    async def connect_end(session, context, params):
+        timing = context.trace_request_ctx
+        now = time.monotonic()
+        timing.connect = now - context.connect_start - (timing.dns or 0)
+        timing._mark = now
+
+    async def headers_sent(session, context, params):
+        timing = context.trace_request_ctx
+        now = time.monotonic()
+        timing.send = now - timing._mark
+        timing._mark = now
+
+    trace = aiohttp.TraceConfig()
+    # Time spent waiting for a free connection isn't part of any phase
+    trace.on_request_start.append(mark)
+    trace.on_connection_queued_end.append(mark)
+    trace.on_connection_reuseconn.append(mark)
+    trace.on_connection_create_start.append(connect_start)
+    trace.on_dns_resolvehost_start.append(dns_start)
+    trace.on_dns_resolvehost_end.append(dns_end)
+    trace.on_connection_create_end.append(connect_end)
+    trace.on_request_headers_sent.append(headers_sent)
+    return trace
+
+
+def iterate(results):
+    """Iterate over asynchronous validation results from synchronous code
+
+    :param results: Asynchronous generator from :py:meth:`AsyncValidator.validate`
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
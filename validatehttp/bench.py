@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+
+"""
+Replay spec rules as a load test
+
+:py:cls:`LoadBench` sends the requests of the spec rules over and over, for a
+duration or a number of iterations over the spec, at a fixed concurrency or
+request rate, and still matches every response against its rule. Only totals
+and a :py:cls:`LatencyHistogram` are kept, so memory use doesn't grow with the
+length of the run.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import sys
+import threading
+import time
+from collections import Counter
+
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ConnectionError
+from requests.exceptions import ContentDecodingError
+
+
+try:
+    from requests.packages import urllib3
+except ImportError:
+    import urllib3
+
+from .spec import ValidationError
+from .transport import finish_timing
+from .transport import parse_resolve
+from .validate import DEFAULT_TIMEOUT
+from .validate import SEND_ERRORS
+from .validate import Validator
+from .validate import load_hosts
+from .validate import release_response
+
+
+# Bits of precision of each histogram bucket, buckets are at most 1/64th, or
+# about 1.6%, wide
+HISTOGRAM_PRECISION = 7
+
+# Percentiles printed in the latency summary
+BENCH_PERCENTILES = (50, 75, 90, 99, 99.9, 99.99, 100)
+
+# Seconds to run for, when neither a duration nor iterations are given
+DEFAULT_DURATION = 10
+
+
+class LatencyHistogram(object):
+    """Latency histogram with constant relative precision, in the style of HdrHistogram
+
+    Latencies are counted in microsecond buckets. Below ``2 **
+    HISTOGRAM_PRECISION`` microseconds, each bucket is a single microsecond,
+    above, bucket width doubles with each doubling of the latency, so that
+    every bucket is narrower than ``2 ** -(HISTOGRAM_PRECISION - 1)`` of its
+    latency. Memory use only depends on the range of latencies recorded, not
+    on the number of latencies.
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        """Count a latency, in seconds"""
+        value = max(int(seconds * 1000000), 0)
+        self.counts[get_bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the latencies of another histogram to this histogram"""
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def get_mean(self):
+        """Return mean latency, in seconds, or None if there are no latencies"""
+        if not self.count:
+            return None
+        return self.total / float(self.count) / 1000000
+
+    def get_percentile(self, percent):
+        """Return latency at a percentile, in seconds, or None if there are no latencies
+
+        As with HdrHistogram, this is the highest latency of the bucket
+        holding the percentile, capped to the highest latency recorded.
+        """
+        if not self.count:
+            return None
+        rank = max(int(percent * self.count / 100.0 + 0.5), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(get_bucket_range(bucket)[1], self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def iter_distribution(self):
+        """Yield the latency at the top of each bucket, in seconds, with its
+        cumulative fraction of the latencies and cumulative count
+        """
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            value = min(get_bucket_range(bucket)[1], self.max)
+            yield (value / 1000000.0, seen / float(self.count), seen)
+
+    def write_distribution(self, handle):
+        """Write the percentile distribution in HdrHistogram text format
+
+        The output can be plotted with the HdrHistogram plotter. Latencies are
+        written in milliseconds.
+        """
+        handle.write(
+            "{0:>12} {1:>14} {2:>10} {3:>14}\n\n".format(
+                "Value", "Percentile", "TotalCount", "1/(1-Percentile)"
+            )
+        )
+        for value, fraction, seen in self.iter_distribution():
+            inverse = "inf" if fraction >= 1 else "{0:.2f}".format(1 / (1 - fraction))
+            handle.write(
+                "{0:12.3f} {1:14.12f} {2:10d} {3:>14}\n".format(
+                    value * 1000, fraction, seen, inverse
+                )
+            )
+        mean = self.get_mean() or 0
+        handle.write(
+            "#[Mean    = {0:12.3f}, Max            = {1:12.3f}]\n".format(
+                mean * 1000, (self.max or 0) / 1000.0
+            )
+        )
+        handle.write(
+            "#[Buckets = {0:12d}, Total count    = {1:12d}]\n".format(len(self.counts), self.count)
+        )
+
+
+def get_bucket(value):
+    """Return histogram bucket of a latency, in microseconds"""
+    shift = value.bit_length() - HISTOGRAM_PRECISION
+    if shift <= 0:
+        return value
+    half = 1 << (HISTOGRAM_PRECISION - 1)
+    return shift * half + (value >> shift)
+
+
+def get_bucket_range(bucket):
+    """Return lowest and highest latency of a histogram bucket, in microseconds"""
+    size = 1 << HISTOGRAM_PRECISION
+    if bucket < size:
+        return (bucket, bucket)
+    half = size >> 1
+    shift = bucket // half - 1
+    mantissa = bucket - shift * half
+    return (mantissa << shift, ((mantissa + 1) << shift) - 1)
+
+
+class BenchStats(object):
+    """Totals of a load test, or of one of its workers"""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.passes = 0
+        self.mismatches = 0
+        self.errors = 0
+        self.bytes = 0
+        # Failures by rule URI, bounded by the number of rules
+        self.failed_rules = Counter()
+
+    def merge(self, other):
+        """Add the totals of another worker to these totals"""
+        self.latency.merge(other.latency)
+        self.requests += other.requests
+        self.passes += other.passes
+        self.mismatches += other.mismatches
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.failed_rules.update(other.failed_rules)
+
+
+class LoadBench(object):
+    """Send the requests of spec rules repeatedly, matching every response
+
+    Rules are sent in spec order, against each target host of the validator,
+    starting over at the end of the spec, until the duration has passed or
+    the spec has been sent ``iterations`` times. Each response is matched
+    against its rule, as in a validation run, but only counted, no result is
+    kept.
+
+    Without a rate, each of ``concurrency`` workers sends its next request as
+    soon as its last response is matched. With a rate, requests are due at
+    fixed intervals, and latency is measured from the time each request was
+    due, not from the time it was sent, so that a server slowing down shows as
+    higher latency rather than as fewer requests.
+
+    :param validator: Validator holding the spec, targets, concurrency and
+        timeout to send requests with
+    :type validator: Validator
+    :param duration: Seconds to run for
+    :param iterations: Number of times to send the whole spec
+    :param rate: Requests per second to send, over all workers
+    """
+
+    def __init__(self, validator, duration=None, iterations=None, rate=None):
+        self.validator = validator
+        if duration is None and iterations is None:
+            duration = DEFAULT_DURATION
+        self.duration = duration
+        self.iterations = iterations
+        self.rate = rate
+        self.jobs = []
+        self.elapsed = None
+        self._lock = threading.Lock()
+        self._sent = 0
+        self._start = None
+        self._end = None
+
+    def get_jobs(self):
+        """Return rules of the spec, compiled, paired with each target host and port"""
+        return [
+            (rule, rule.compile(), host, port)
+            for rule in self.validator.spec.get_rules()
+            for host, port in self.validator.targets
+        ]
+
+    def run(self):
+        """Run the load test, and return its totals
+
+        :rtype: BenchStats
+        """
+        if not self.validator.verify and hasattr(urllib3, "disable_warnings"):
+            urllib3.disable_warnings()
+        self.jobs = self.get_jobs()
+        stats = BenchStats()
+        if not self.jobs:
+            self.elapsed = 0.0
+            return stats
+        self._sent = 0
+        self._start = time.monotonic()
+        self._end = None
+        if self.duration is not None:
+            self._end = self._start + self.duration
+        workers = []
+        for _ in range(self.validator.concurrency):
+            worker_stats = BenchStats()
+            thread = threading.Thread(target=self._run_worker, args=(worker_stats,))
+            thread.daemon = True
+            thread.start()
+            workers.append((thread, worker_stats))
+        for thread, worker_stats in workers:
+            thread.join()
+            stats.merge(worker_stats)
+        self.elapsed = time.monotonic() - self._start
+        return stats
+
+    def get_next(self):
+        """Return the next job and the time it is due, or None once the test is over"""
+        with self._lock:
+            count = self._sent
+            if self.iterations is not None and count >= self.iterations * len(self.jobs):
+                return None
+            if self.rate:
+                due = self._start + count / float(self.rate)
+            else:
+                due = time.monotonic()
+            if self._end is not None and due >= self._end:
+                return None
+            self._sent += 1
+        return (self.jobs[count % len(self.jobs)], due)
+
+    def _run_worker(self, stats):
+        """Send requests until the test is over, adding their outcomes to stats"""
+        session = self.validator.get_session()
+        try:
+            while True:
+                job = self.get_next()
+                if job is None:
+                    return
+                (job, due) = job
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.send(session, job, due, stats)
+        finally:
+            self.validator.put_session(session)
+
+    def send(self, session, job, due, stats):
+        """Send the request of a rule, match the response, and count the outcome"""
+        (rule, compiled, host, port) = job
+        validator = self.validator
+        timeout = validator.get_timeout([rule])
+        stream = not compiled.needs_body or validator.stream
+        stats.requests += 1
+        try:
+            resp = validator.send(session, compiled.prepare(host, port), stream, timeout)
+        except SEND_ERRORS:
+            stats.errors += 1
+            stats.failed_rules[rule.uri] += 1
+            stats.latency.record(time.monotonic() - due)
+            return
+        try:
+            if compiled.matches(resp, stream=stream):
+                stats.passes += 1
+        except ValidationError:
+            stats.mismatches += 1
+            stats.failed_rules[rule.uri] += 1
+        except (ConnectionError, ChunkedEncodingError, ContentDecodingError, LookupError):
+            stats.errors += 1
+            stats.failed_rules[rule.uri] += 1
+        finally:
+            if stream:
+                release_response(resp)
+            finish_timing(resp)
+            stats.latency.record(time.monotonic() - due)
+            timing = getattr(resp, "timing", None)
+            if timing is not None:
+                stats.bytes += timing.received or 0
+
+    def report(self, stats, out=None):
+        """Print throughput, latency percentiles and failure rates of a load test"""
+        out = out or sys.stdout
+        elapsed = self.elapsed or 0.0
+        rate = stats.requests / elapsed if elapsed else 0.0
+        print(
+            "{0} requests in {1:.2f}s, {2:.1f} requests/s, {3} bytes received".format(
+                stats.requests, elapsed, rate, stats.bytes
+            ),
+            file=out,
+        )
+        if stats.latency.count:
+            print("", file=out)
+            print("Latency:", file=out)
+            print(
+                "    {0:>8} {1:10.2f}ms".format("mean", stats.latency.get_mean() * 1000), file=out
+            )
+            for percent in BENCH_PERCENTILES:
+                print(
+                    "    {0:>8} {1:10.2f}ms".format(
+                        "p{0:g}".format(percent), stats.latency.get_percentile(percent) * 1000
+                    ),
+                    file=out,
+                )
+        print("", file=out)
+        for name, count in (
+            ("Passed", stats.passes),
+            ("Mismatches", stats.mismatches),
+            ("Errors", stats.errors),
+        ):
+            share = 100.0 * count / stats.requests if stats.requests else 0.0
+            print("{0:<11} {1:8d} ({2:.2f}%)".format(name + ":", count, share), file=out)
+        if stats.failed_rules:
+            print("", file=out)
+            print("Most failed rules:", file=out)
+            for uri, count in stats.failed_rules.most_common(5):
+                print("    {0:8d} {1}".format(count, uri), file=out)
+
+    @classmethod
+    def cli(cls, argv=None):
+        """Set up load test command line interface, process arguments"""
+        parser = argparse.ArgumentParser(
+            prog="validatehttp bench",
+            description="validatehttp bench - replay spec rules as a load test",
+        )
+        parser.add_argument(
+            "-f",
+            "--file",
+            dest="specfile",
+            action="store",
+            help="HTTP spec file to parse",
+            required=True,
+        )
+        parser.add_argument(
+            "-H",
+            "--host",
+            dest="hosts",
+            action="append",
+            help="Host address to test against, can be repeated to test several hosts",
+        )
+        parser.add_argument(
+            "--hosts-file",
+            dest="hosts_file",
+            action="store",
+            help="File listing host addresses to test against, one per line",
+        )
+        parser.add_argument(
+            "-p", "--port", dest="port", action="store", help="Host port to test against"
+        )
+        parser.add_argument(
+            "--resolve",
+            dest="resolve",
+            action="append",
+            type=parse_resolve,
+            help="Connect to addresses instead of resolving a host name and port, "
+            "given as host:port:addr[,addr]. Can be repeated",
+        )
+        parser.add_argument(
+            "-V",
+            "--no-verify",
+            dest="verify",
+            action="store_false",
+            help="Don't verify SSL connections",
+        )
+        parser.add_argument(
+            "-j",
+            "--concurrency",
+            dest="concurrency",
+            action="store",
+            type=int,
+            default=1,
+            help="Number of requests to keep in flight",
+        )
+        parser.add_argument(
+            "-r",
+            "--rate",
+            dest="rate",
+            action="store",
+            type=float,
+            help="Requests per second to send, instead of sending as fast as responses arrive",
+        )
+        parser.add_argument(
+            "-T",
+            "--duration",
+            dest="duration",
+            action="store",
+            type=float,
+            help="Seconds to run for, defaults to {0}s".format(DEFAULT_DURATION),
+        )
+        parser.add_argument(
+            "-n",
+            "--iterations",
+            dest="iterations",
+            action="store",
+            type=int,
+            help="Number of times to send the whole spec",
+        )
+        parser.add_argument(
+            "--stream",
+            dest="stream",
+            action="store_true",
+            help="Match response content chunk by chunk, without reading whole bodies",
+        )
+        parser.add_argument(
+            "--cache-dir",
+            dest="cache_dir",
+            action="store",
+            help="Directory to cache parsed spec files in",
+        )
+        parser.add_argument(
+            "-t",
+            "--timeout",
+            dest="timeout",
+            action="store",
+            type=float,
+            default=DEFAULT_TIMEOUT,
+            help="Seconds to wait for each response, 0 to wait indefinitely",
+        )
+        parser.add_argument(
+            "--histogram",
+            dest="histogram_file",
+            action="store",
+            help="File to write the latency distribution to, in HdrHistogram text format",
+        )
+        args = parser.parse_args(argv)
+        hosts = args.hosts or []
+        if args.hosts_file:
+            hosts.extend(load_hosts(args.hosts_file))
+
+        validator = Validator.load(
+            args.specfile,
+            port=args.port,
+            hosts=hosts,
+            verify=args.verify,
+            concurrency=args.concurrency,
+            stream=args.stream,
+            cache_dir=args.cache_dir,
+            timeout=args.timeout or None,
+            resolve=dict(args.resolve or []),
+        )
+        self = cls(validator, duration=args.duration, iterations=args.iterations, rate=args.rate)
+        try:
+            stats = self.run()
+        finally:
+            validator.close()
+        self.report(stats)
+        if args.histogram_file:
+            with open(args.histogram_file, "w") as handle:
+                stats.latency.write_distribution(handle)
+        if stats.mismatches or stats.errors or not stats.requests:
+            return 1
+        return 0
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local file caches
+
+:py:cls:`SpecCache` stores parsed spec files in :py:mod:`marshal` format, so
+that large YAML specs are only parsed when the spec file changes.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import marshal
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Bump when the cached spec format changes
+SPEC_CACHE_VERSION = 1
+
+# Bump when the result cache file format changes
+RESULT_CACHE_VERSION = 1
+
+# Seconds to reuse check results for
+RESULT_CACHE_TTL = 60
+
+# Seconds between attempts to take a lock, with a timeout
+LOCK_INTERVAL = 0.05
+
+
+class SpecCache(object):
+    """Cache of parsed spec files
+
+    Cache entries are keyed by the spec file path, and are only used while the
+    spec file size, modification time and content hash still match.
+
+    :param cache_dir: Directory to store cache files in
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_path(self, spec_file):
+        """Cache file path for spec file"""
+        key = hashlib.sha1(os.path.abspath(spec_file).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{0}.spec".format(key))
+
+    @staticmethod
+    def get_header(spec_file, content):
+        """Cache entry header, identifying spec file contents"""
+        stat = os.stat(spec_file)
+        return {
+            "version": SPEC_CACHE_VERSION,
+            "python": list(sys.version_info[:2]),
+            "path": os.path.abspath(spec_file),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "hash": hashlib.sha256(content).hexdigest(),
+        }
+
+    def get(self, spec_file, content):
+        """Return parsed spec entries from cache, or None if there is no valid entry
+
+        :param spec_file: Spec file path
+        :param content: Spec file contents, as bytes
+        """
+        try:
+            with open(self.get_path(spec_file), "rb") as handle:
+                # Loading from bytes is much faster than from the file handle
+                (header, items) = marshal.loads(handle.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if header != self.get_header(spec_file, content):
+            return None
+        return items
+
+    def set(self, spec_file, content, entries):
+        """Store parsed spec entries in cache
+
+        The cache file is replaced atomically. Specs containing values that
+        can't be stored, such as YAML timestamps, are not cached.
+
+        :param spec_file: Spec file path
+        :param content: Spec file contents, as bytes
+        :param entries: List of URI and rule parameter pairs
+        """
+        try:
+            data = marshal.dumps((self.get_header(spec_file, content), list(entries)))
+        except (ValueError, AttributeError):
+            return
+        try:
+            with atomic_write(self.get_path(spec_file), binary=True) as handle:
+                handle.write(data)
+        except (IOError, OSError):
+            pass
+
+
+class ResultCache(object):
+    """Cache of check results, shared by checks through a local file
+
+    Results are keyed by :py:meth:`get_key`, and reused until they are
+    :py:attr:`ttl` seconds old. A check holds an exclusive lock for its key
+    while it runs, so that an identical check arriving meanwhile waits for the
+    result, instead of validating the spec again.
+
+    The cache file is replaced with :py:func:`atomic_write` under an exclusive
+    lock, and results are merged with the file as it is at the time of
+    writing. Without :py:mod:`fcntl`, checks don't wait for each other, but
+    results are still shared.
+
+    :param path: Cache file path
+    :param ttl: Seconds to reuse results for
+    """
+
+    def __init__(self, path, ttl=RESULT_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(content, options):
+        """Return key identifying a check
+
+        :param content: Spec file contents, as bytes
+        :param options: Check options changing the outcome of the check, such
+            as the hosts, port, timeouts and limits, serializable as JSON
+        """
+        params = json.dumps(options, sort_keys=True, default=repr).encode("utf-8")
+        key = hashlib.sha256(content)
+        key.update(b"\0" + params)
+        return key.hexdigest()
+
+    def read(self):
+        """Return results from the cache file, empty if there is no valid file"""
+        try:
+            with open(self.path) as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != RESULT_CACHE_VERSION:
+            return {}
+        return data.get("results", {})
+
+    def get(self, key):
+        """Return cached result for key, or None if there is no fresh result"""
+        entry = self.read().get(key)
+        if entry is None or entry.get("time", 0) <= time.time() - self.ttl:
+            return None
+        return entry.get("result")
+
+    def set(self, key, result):
+        """Store result for key, dropping expired results
+
+        :param key: Check key, see :py:meth:`get_key`
+        :param result: Check result, serializable as JSON
+        """
+        now = time.time()
+        with locked_file(self.path + ".lock"):
+            results = self.read()
+            results[key] = {"time": now, "result": result}
+            results = dict(
+                (other, entry)
+                for (other, entry) in results.items()
+                if entry.get("time", 0) > now - self.ttl
+            )
+            with atomic_write(self.path) as handle:
+                json.dump({"version": RESULT_CACHE_VERSION, "results": results}, handle)
+
+    def get_lock_path(self, key):
+        """Lock file path, held while a check with this key runs"""
+        return "{0}.{1}.lock".format(self.path, key[:16])
+
+    def get_or_run(self, key, run, timeout=None):
+        """Return cached result for key, or run the check and store its result
+
+        If an identical check is in progress, wait for it to finish, and
+        return its result.
+
+        :param key: Check key, see :py:meth:`get_key`
+        :param run: Function running the check, and returning its result
+        :param timeout: Seconds to wait for a check in progress, or None to
+            wait until it finishes
+        :returns: Check result, or None if the check in progress didn't
+            finish in time
+        """
+        result = self.get(key)
+        if result is not None:
+            return result
+        with locked_file(self.get_lock_path(key), timeout) as locked:
+            if not locked:
+                return None
+            # The check in progress finished while waiting
+            result = self.get(key)
+            if result is None:
+                result = run()
+                self.set(key, result)
+        return result
+
+
+def get_file_mode():
+    """Return mode of new files, as the umask allows"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+@contextmanager
+def atomic_write(path, binary=False, mode=None):
+    """Write a file atomically, replacing it once it is written
+
+    The file is written to a temporary file in the same directory, creating
+    the directory if needed, which is removed if writing fails. Readers see
+    either the old or the new file, never a partly written file.
+
+    :param path: File path
+    :param binary: Open the file in binary mode, instead of text mode
+    :param mode: File mode, or None to keep the private mode of temporary
+        files, see :py:func:`get_file_mode`
+    :returns: Context manager, yielding the open temporary file
+    """
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as handle:
+            if mode is not None:
+                os.fchmod(handle.fileno(), mode)
+            yield handle
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def locked_file(lock_path, timeout=None):
+    """Hold an exclusive lock on a lock file
+
+    Lock files are separate from the files they guard, as those are replaced
+    by :py:func:`atomic_write`, and are kept, as removing a lock file while
+    another process waits on it would let a third process take a lock on a
+    new file. Without :py:mod:`fcntl`, no lock is taken.
+
+    :param lock_path: Lock file path
+    :param timeout: Seconds to wait for the lock, or None to wait as long as
+        it is held
+    :returns: Context manager, yielding whether the lock was taken
+    """
+    if fcntl is None:
+        yield True
+        return
+    directory = os.path.dirname(os.path.abspath(lock_path))
+    os.makedirs(directory, exist_ok=True)
+    with open(lock_path, "a") as handle:
+        if timeout is None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        else:
+            end = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError):
+                    if time.monotonic() >= end:
+                        yield False
+                        return
+                    time.sleep(LOCK_INTERVAL)
+        try:
+            yield True
+        finally:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
@@ -6,37 +6,100 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import inspect
+import sys
 from collections import Counter
 
-from termcolor import cprint
-
+from .report import REPORTERS
+from .report import JsonLinesReporter
+from .report import get_reporter
+from .transport import parse_resolve
+from .validate import DEFAULT_TIMEOUT
+from .validate import RETRY_BACKOFF
 from .validate import ValidationFail
 from .validate import ValidationPass
 from .validate import Validator
+from .validate import get_percentiles
+from .validate import load_hosts
+from .validate import parse_shard
+
+
+def cprint(text, color=None, attrs=None):
+    """Print text in color, if output is a terminal
+
+    Colors are left out of redirected output, and termcolor is only imported
+    for terminal output.
+    """
+    isatty = getattr(sys.stdout, "isatty", None)
+    if isatty is None or not isatty():
+        print(text)
+        return
+    import termcolor
+
+    termcolor.cprint(text, color, attrs=attrs)
 
 
 class ValidatorCLI(object):
     """validatehttp - HTTP response validator"""
 
-    def __init__(self, validator, verbose=False, debug=False):
+    def __init__(self, validator, verbose=False, debug=False, reporters=None):
         self.validator = validator
         self.verbose = verbose
         self.debug = debug
+        self.reporters = reporters or []
 
     def run(self):
         """Run validator with CLI output"""
-        count = Counter(results=0, passes=0, failures=0)
+        count = Counter(results=0, passes=0, failures=0, saved=0, retried=0, recovered=0)
+        latencies = []
+        host_counts = {}
+        multihost = len(self.validator.targets) > 1
+
+        for reporter in self.reporters:
+            reporter.start()
 
-        for result in self.validator.validate():
+        results = self.validator.validate()
+        if inspect.isasyncgen(results):
+            from .aio import iterate
+
+            results = iterate(results)
+        for result in results:
+            for reporter in self.reporters:
+                reporter.add(result)
+            host_count = host_counts.setdefault(
+                result.host, Counter(results=0, passes=0, failures=0)
+            )
+            uri = result.rule.uri
+            if multihost:
+                uri = "{0} [{1}]".format(uri, result.host)
+            if result.revalidated:
+                uri = "{0} (not modified)".format(uri)
+            if result.attempts > 1:
+                uri = "{0} ({1} attempts)".format(uri, result.attempts)
             count["results"] += 1
+            host_count["results"] += 1
+            if result.shared:
+                count["saved"] += 1
+            elif result.elapsed is not None:
+                latencies.append(result.elapsed)
+            if result.attempts > 1 and not result.shared:
+                count["retried"] += 1
+                if isinstance(result, ValidationPass):
+                    count["recovered"] += 1
             if isinstance(result, ValidationPass):
                 count["passes"] += 1
-                header = "✓ Pass: {0}".format(result.rule.uri)
+                host_count["passes"] += 1
+                header = "✓ Pass: {0}".format(uri)
                 cprint(header, "green", attrs=["bold"])
+                if self.verbose and result.timing is not None:
+                    print((" " * 4) + str(result.timing))
             elif isinstance(result, ValidationFail):
                 count["failures"] += 1
-                header = "✗ Fail: {0}".format(result.rule.uri)
+                host_count["failures"] += 1
+                header = "✗ Fail: {0}".format(uri)
                 cprint(header, "red", attrs=["bold"])
+                if self.verbose and result.timing is not None:
+                    print((" " * 4) + str(result.timing))
 
                 if self.verbose:
                     extra = (" " * 4) + str(result.error)
@@ -55,6 +118,43 @@ class ValidatorCLI(object):
                     if extra:
                         cprint(extra, "red", attrs=["bold"])
 
+        for uri, error in getattr(self.validator.spec, "errors", []):
+            for reporter in self.reporters:
+                reporter.add_error(uri, error)
+            cprint("! Invalid rule: {0}: {1}".format(uri, error), "yellow", attrs=["bold"])
+
+        for reporter in self.reporters:
+            reporter.finish()
+
+        if multihost:
+            print("")
+            for host, host_count in host_counts.items():
+                msg = "{host}: {passes}/{results} passed ({failures} failures)".format(
+                    host=host, **host_count
+                )
+                cprint(msg, "green" if host_count["failures"] == 0 else "red")
+
+        percentiles = get_percentiles(latencies)
+        if percentiles is not None:
+            print("")
+            print(
+                "Latency: p50 {0:.0f}ms, p95 {1:.0f}ms, p99 {2:.0f}ms".format(
+                    *[value * 1000 for value in percentiles]
+                )
+            )
+
+        if count["saved"]:
+            print("")
+            print("{saved} requests saved by sharing responses between rules".format(**count))
+
+        if count["retried"]:
+            print("")
+            print(
+                "{retried} requests were retried or hedged, {recovered} of them passed".format(
+                    **count
+                )
+            )
+
         msg = "{passes}/{results} passed ({failures} failures)".format(**count)
         if count["passes"] == count["results"]:
             msg = " ".join(["Passed!", msg])
@@ -68,14 +168,41 @@ class ValidatorCLI(object):
     @classmethod
     def cli(cls):
         """Set up command line interface, process arguments"""
+        argv = sys.argv[1:]
+        if argv[:1] == ["bench"]:
+            from .bench import LoadBench
+
+            return LoadBench.cli(argv[1:])
+
         # Build up command interface
-        parser = argparse.ArgumentParser(description=cls.__doc__)
+        parser = argparse.ArgumentParser(
+            description=cls.__doc__,
+            epilog="Run validatehttp bench -h for load test options",
+        )
         parser.add_argument(
-            "-H", "--host", dest="host", action="store", help="Host address to test against"
+            "-H",
+            "--host",
+            dest="hosts",
+            action="append",
+            help="Host address to test against, can be repeated to test several hosts",
+        )
+        parser.add_argument(
+            "--hosts-file",
+            dest="hosts_file",
+            action="store",
+            help="File listing host addresses to test against, one per line",
         )
         parser.add_argument(
             "-p", "--port", dest="port", action="store", help="Host port to test against"
         )
+        parser.add_argument(
+            "--resolve",
+            dest="resolve",
+            action="append",
+            type=parse_resolve,
+            help="Connect to addresses instead of resolving a host name and port, "
+            "given as host:port:addr[,addr]. Can be repeated",
+        )
         parser.add_argument(
             "-f",
             "--file",
@@ -94,13 +221,211 @@ class ValidatorCLI(object):
             action="store_false",
             help="Don't verify SSL connections",
         )
+        parser.add_argument(
+            "-j",
+            "--concurrency",
+            dest="concurrency",
+            action="store",
+            type=int,
+            help="Number of requests to run concurrently",
+        )
+        parser.add_argument(
+            "--async",
+            dest="use_async",
+            action="store_true",
+            help="Run requests on an asyncio event loop",
+        )
+        parser.add_argument(
+            "--unordered",
+            dest="ordered",
+            action="store_false",
+            help="Report results as requests complete, instead of in spec order",
+        )
+        parser.add_argument(
+            "--stream",
+            dest="stream",
+            action="store_true",
+            help="Match response content chunk by chunk, without reading whole bodies",
+        )
+        parser.add_argument(
+            "--head",
+            dest="head",
+            action="store_true",
+            help="Send HEAD requests for rules that only test status and headers",
+        )
+        parser.add_argument(
+            "--cache-dir",
+            dest="cache_dir",
+            action="store",
+            help="Directory to cache parsed spec files in",
+        )
+        parser.add_argument(
+            "--lazy",
+            dest="lazy",
+            action="store_true",
+            help="Parse the spec file incrementally while validating, for very large specs",
+        )
+        parser.add_argument(
+            "--shard",
+            dest="shard",
+            action="store",
+            type=parse_shard,
+            help="Only run rules in shard i of n, given as i/n",
+        )
+        parser.add_argument(
+            "--processes",
+            dest="processes",
+            action="store",
+            type=int,
+            help="Number of worker processes to split rules across",
+        )
+        parser.add_argument(
+            "--no-dedupe",
+            dest="dedupe",
+            action="store_false",
+            help="Send a request for every rule, even if other rules send the same request",
+        )
+        parser.add_argument(
+            "--response-cache",
+            dest="cache_responses",
+            action="store_true",
+            help="Reuse responses for later rules sending the same request",
+        )
+        parser.add_argument(
+            "-t",
+            "--timeout",
+            dest="timeout",
+            action="store",
+            type=float,
+            default=DEFAULT_TIMEOUT,
+            help="Seconds to wait for each response, 0 to wait indefinitely",
+        )
+        parser.add_argument(
+            "--timings",
+            dest="timings_file",
+            action="store",
+            help="File to write request phase timings to, as JSON lines",
+        )
+        parser.add_argument(
+            "--report",
+            dest="reporters",
+            action="append",
+            type=get_reporter,
+            help="Write results to a file as they complete, given as format:path. "
+            "Formats are {0}. Can be repeated".format(", ".join(sorted(REPORTERS))),
+        )
+        parser.add_argument(
+            "--history",
+            dest="history_file",
+            action="store",
+            help="File to keep the outcome and latency of each rule in, between runs",
+        )
+        parser.add_argument(
+            "--order",
+            dest="order",
+            action="store",
+            choices=["spec", "history"],
+            default="spec",
+            help="Run rules in spec order, or failing and slowest rules first, by run history",
+        )
+        parser.add_argument(
+            "--watch",
+            dest="watch",
+            action="store_true",
+            help="Watch the spec file, and validate added and changed rules on each change",
+        )
+        parser.add_argument(
+            "--revalidate",
+            dest="revalidate",
+            action="store_true",
+            help="With --watch, also validate unchanged rules, with conditional requests",
+        )
+        parser.add_argument(
+            "--max-rps",
+            dest="max_rps",
+            action="store",
+            type=float,
+            help="Highest rate of requests per second to each host",
+        )
+        parser.add_argument(
+            "--retries",
+            dest="retries",
+            action="store",
+            type=int,
+            default=0,
+            help="Number of times to retry requests that fail to connect or lose their connection",
+        )
+        parser.add_argument(
+            "--retry-backoff",
+            dest="retry_backoff",
+            action="store",
+            type=float,
+            default=RETRY_BACKOFF,
+            help="Seconds to wait before the first retry, doubling with each retry",
+        )
+        parser.add_argument(
+            "--hedge",
+            dest="hedge",
+            action="store_true",
+            help="Send a duplicate of requests slower than the 95th percentile so far",
+        )
+        parser.add_argument(
+            "--adaptive",
+            dest="adaptive",
+            action="store_true",
+            help="Adjust concurrency to each host to its latency and error rate",
+        )
         parser.add_argument("-d", "--debug", dest="debug", action="store_true", help="Debug output")
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
+        hosts = args.hosts or []
+        if args.hosts_file:
+            hosts.extend(load_hosts(args.hosts_file))
 
         # Create validator interface from specfile, run the cli process and
         # fancy output
-        validator = Validator.load(
-            args.specfile, host=args.host, port=args.port, verify=args.verify, debug=args.debug
+        validator_class = Validator
+        if args.use_async:
+            from .aio import AsyncValidator as validator_class
+        validator = validator_class.load(
+            args.specfile,
+            port=args.port,
+            hosts=hosts,
+            verify=args.verify,
+            debug=args.debug,
+            concurrency=args.concurrency,
+            ordered=args.ordered,
+            stream=args.stream,
+            head=args.head,
+            cache_dir=args.cache_dir,
+            lazy=args.lazy and not args.watch,
+            shard=args.shard,
+            processes=args.processes,
+            dedupe=args.dedupe,
+            cache_responses=args.cache_responses,
+            timeout=args.timeout or None,
+            max_rps=args.max_rps,
+            adaptive=args.adaptive,
+            history_file=args.history_file,
+            order=args.order,
+            revalidate=args.revalidate,
+            resolve=dict(args.resolve or []),
+            retries=args.retries,
+            retry_backoff=args.retry_backoff,
+            hedge=args.hedge,
         )
-        self = cls(validator, verbose=args.verbose, debug=args.debug)
+        reporters = args.reporters or []
+        if args.timings_file:
+            reporters.append(JsonLinesReporter(args.timings_file))
+        self = cls(validator, verbose=args.verbose, debug=args.debug, reporters=reporters)
+        if args.watch:
+            from .watch import SpecWatcher
+
+            watcher = SpecWatcher(
+                self, args.specfile, cache_dir=args.cache_dir, revalidate=args.revalidate
+            )
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                pass
+            return 0
         return self.run()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Thin Nagios plugin client for the resident check daemon
+
+This accepts the same arguments as ``check_validatehttp``, but passes the check
+over a Unix socket to :py:mod:`validatehttp.daemon`, and prints the plugin
+output and exits with the status code that the daemon returns. The daemon
+keeps parsed specs in memory, so ``-C`` is accepted but unused. Only the
+standard library is imported here, so that the client starts quickly.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os.path
+import socket
+import sys
+
+
+# Runtime directory of the check daemon socket, without $XDG_RUNTIME_DIR
+RUNTIME_DIR = "/run/validatehttp"
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or RUNTIME_DIR, "check_validatehttp.sock"
+)
+
+UNKNOWN = 3
+
+
+class CheckClient(object):
+    """Nagios plugin client, running checks on the validatehttp check daemon"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, params):
+        """Send check parameters to daemon, and return status code and output
+
+        :param params: Check parameters, named after the plugin arguments
+        :returns: Tuple of Nagios status code and plugin output
+        """
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.settimeout(self.timeout)
+            conn.connect(self.socket_path)
+            conn.sendall(json.dumps(params).encode("utf-8") + b"\n")
+            handle = conn.makefile("rb")
+            response = json.loads(handle.readline().decode("utf-8"))
+            handle.close()
+        finally:
+            conn.close()
+        return (response["code"], response["output"])
+
+    @classmethod
+    def cli(cls):
+        """Set up command line interface, process arguments"""
+        parser = argparse.ArgumentParser(description=cls.__doc__)
+        parser.add_argument("-f", "--file", dest="file", required=True, help="Spec file to parse")
+        parser.add_argument("-H", "--host", dest="host", help="Target Host")
+        parser.add_argument("-p", "--port", dest="port", help="Host HTTP port")
+        parser.add_argument(
+            "-V", "--no-verify", dest="verify", action="store_false", help="No HTTPS verification"
+        )
+        parser.add_argument(
+            "-j", "--concurrency", dest="concurrency", help="Number of concurrent requests"
+        )
+        parser.add_argument(
+            "-F", "--hosts-file", dest="hosts_file", help="File listing hosts to check"
+        )
+        parser.add_argument(
+            "-m",
+            "--max-failures",
+            dest="max_failures",
+            help="Stop checking after this many failures",
+        )
+        parser.add_argument("-D", "--deadline", dest="deadline", help="Seconds to check for")
+        parser.add_argument(
+            "-y", "--history-file", dest="history_file", help="File to keep rule history in"
+        )
+        parser.add_argument(
+            "-R", "--retries", dest="retries", help="Number of times to retry failed connections"
+        )
+        parser.add_argument(
+            "-e", "--hedge", dest="hedge", action="store_true", help="Hedge slow requests"
+        )
+        parser.add_argument(
+            "-k", "--result-cache", dest="result_cache", help="File to share results in"
+        )
+        parser.add_argument(
+            "-K", "--result-ttl", dest="result_ttl", help="Seconds to reuse shared results for"
+        )
+        parser.add_argument(
+            "-C",
+            "--cache-dir",
+            dest="cache_dir",
+            help="Unused, the daemon keeps parsed specs in memory",
+        )
+        parser.add_argument(
+            "-t", "--timeout", dest="timeout", help="Seconds to wait for each response"
+        )
+        parser.add_argument(
+            "--socket-timeout",
+            dest="socket_timeout",
+            type=float,
+            help="Seconds to wait for the daemon",
+        )
+        parser.add_argument(
+            "-S",
+            "--socket",
+            dest="socket_path",
+            default=DEFAULT_SOCKET,
+            help="Check daemon socket path",
+        )
+        args = parser.parse_args()
+
+        params = {
+            "file": os.path.abspath(args.file),
+            "host": args.host,
+            "port": args.port,
+            "no-verify": args.verify,
+            "concurrency": args.concurrency,
+            "timeout": args.timeout,
+            "hosts-file": None,
+            "max-failures": args.max_failures,
+            "deadline": args.deadline,
+            "retries": args.retries,
+            "hedge": args.hedge,
+            "result-ttl": args.result_ttl,
+        }
+        if args.hosts_file is not None:
+            params["hosts-file"] = os.path.abspath(args.hosts_file)
+        params["history-file"] = None
+        if args.history_file is not None:
+            params["history-file"] = os.path.abspath(args.history_file)
+        params["result-cache"] = None
+        if args.result_cache is not None:
+            params["result-cache"] = os.path.abspath(args.result_cache)
+
+        self = cls(args.socket_path, timeout=args.socket_timeout)
+        try:
+            (code, output) = self.request(params)
+        except (IOError, OSError, ValueError, KeyError) as exc:
+            (code, output) = (UNKNOWN, "UNKNOWN: Check daemon unavailable: {0}".format(exc))
+        print(output)
+        sys.exit(code)
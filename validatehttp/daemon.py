@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resident check daemon for the Nagios plugin
+
+The daemon keeps parsed specs and validators, along with their warm connection
+pools, in memory between checks, and serves checks from
+:py:mod:`validatehttp.client` over a Unix socket. Specs are reloaded when the
+spec file modification time changes.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import errno
+import json
+import os
+import socketserver
+import stat
+import threading
+
+from .client import DEFAULT_SOCKET
+from .client import UNKNOWN
+from .nagios import CheckURLSpecPlugin
+from .validate import Validator
+
+
+# Socket file mode, allowing checks from the daemon user and group only
+SOCKET_MODE = 0o660
+
+# Directory of spec files and hosts files checks may read, without --spec-dir
+DEFAULT_SPEC_DIR = "/etc/validatehttp"
+
+# Directory of history files and result caches checks may write, without
+# --state-dir
+DEFAULT_STATE_DIR = "/var/lib/validatehttp"
+
+# Check parameters accepted from clients, and their value types
+CHECK_PARAMS = {
+    "file": str,
+    "hosts-file": str,
+    "history-file": str,
+    "result-cache": str,
+    "host": str,
+    "port": int,
+    "no-verify": bool,
+    "concurrency": int,
+    "timeout": float,
+    "max-failures": int,
+    "deadline": float,
+    "retries": int,
+    "hedge": bool,
+    "result-ttl": float,
+}
+
+# Path parameters read by checks, which must be under a spec directory
+SPEC_PATH_PARAMS = ("file", "hosts-file")
+
+# Path parameters written by checks, which must be under the state directory
+STATE_PATH_PARAMS = ("history-file", "result-cache")
+
+
+class CheckHandler(socketserver.StreamRequestHandler):
+    """Handle a single check request, one JSON object per line"""
+
+    def handle(self):
+        try:
+            params = json.loads(self.rfile.readline().decode("utf-8"))
+        except ValueError:
+            return
+        (code, output) = self.server.check(params)
+        response = json.dumps({"code": code, "output": output})
+        self.wfile.write(response.encode("utf-8") + b"\n")
+
+
+class CheckDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """validatehttp check daemon, serving Nagios checks over a Unix socket"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path=DEFAULT_SOCKET,
+        socket_mode=SOCKET_MODE,
+        spec_dirs=(DEFAULT_SPEC_DIR,),
+        state_dir=DEFAULT_STATE_DIR,
+    ):
+        self.socket_mode = socket_mode
+        self.spec_dirs = [os.path.realpath(path) for path in spec_dirs]
+        self.state_dir = os.path.realpath(state_dir)
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), mode=0o750, exist_ok=True)
+        # Replace stale socket from a previous daemon, but not a socket or
+        # file of another user, which might be waiting for checks
+        try:
+            info = os.lstat(socket_path)
+        except OSError:
+            info = None
+        if info is not None:
+            if not stat.S_ISSOCK(info.st_mode) or info.st_uid != os.getuid():
+                raise OSError(
+                    errno.EADDRINUSE, "Socket path is taken by another file or user", socket_path
+                )
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path, CheckHandler)
+        self.specs = {}
+        self.validators = {}
+        self.lock = threading.Lock()
+
+    def server_bind(self):
+        """Bind socket, with access limited by :py:attr:`socket_mode`
+
+        The socket is created with a restrictive umask, so it is never open
+        to other users, even before its mode is set.
+        """
+        umask = os.umask(0o777 & ~self.socket_mode)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.server_address, self.socket_mode)
+
+    def get_spec(self, spec_file):
+        """Return parsed spec, reloading the spec if the file has changed"""
+        mtime = os.stat(spec_file).st_mtime_ns
+        with self.lock:
+            (loaded_mtime, spec) = self.specs.get(spec_file, (None, None))
+            if loaded_mtime != mtime:
+                spec = Validator.load_spec(spec_file)
+                self.specs[spec_file] = (mtime, spec)
+        return spec
+
+    def get_validator(self, spec_file, options):
+        """Return validator, lock and current spec for spec file and options
+
+        Validators are kept between checks, so connection pools stay warm.
+        Checks sharing a validator are run one at a time, and the validator
+        spec is only replaced with the current spec while holding the lock,
+        so a reload doesn't swap the spec under a running check.
+        """
+        spec = self.get_spec(spec_file)
+        key = (spec_file, json.dumps(options, sort_keys=True))
+        with self.lock:
+            if key not in self.validators:
+                self.validators[key] = (Validator(spec, **options), threading.Lock())
+        (validator, lock) = self.validators[key]
+        return (validator, lock, spec)
+
+    def get_params(self, params):
+        """Return check parameters from a client, after checking them
+
+        Only :py:data:`CHECK_PARAMS` are accepted, with values of their type,
+        or numbers as strings. Spec files and hosts files must be under a
+        spec directory, and history files and result caches must be under the
+        state directory.
+
+        :param params: Check parameters, named after the plugin arguments
+        :raises ValueError: on invalid parameters
+        """
+        if not isinstance(params, dict):
+            raise ValueError("expected an object")
+        unknown = sorted(set(params) - set(CHECK_PARAMS))
+        if unknown:
+            raise ValueError("unknown parameters {0}".format(", ".join(unknown)))
+        if params.get("file") is None:
+            raise ValueError("file is required")
+        for key, value in params.items():
+            if value is None:
+                continue
+            kind = CHECK_PARAMS[key]
+            if kind in (int, float) and isinstance(value, (str, int, float)):
+                if isinstance(value, bool):
+                    raise ValueError("{0} must be a number".format(key))
+                try:
+                    kind(value)
+                except ValueError:
+                    raise ValueError("{0} must be a number".format(key))
+            elif not isinstance(value, kind):
+                raise ValueError("{0} must be a {1}".format(key, kind.__name__))
+            if key in SPEC_PATH_PARAMS:
+                self.check_path(key, value, self.spec_dirs)
+            elif key in STATE_PATH_PARAMS:
+                self.check_path(key, value, [self.state_dir])
+        return params
+
+    @staticmethod
+    def check_path(key, path, directories):
+        """Check that path is an absolute path under one of the directories
+
+        :raises ValueError: if the path is relative, or outside the
+            directories, after resolving symbolic links
+        """
+        if not os.path.isabs(path):
+            raise ValueError("{0} must be an absolute path".format(key))
+        path = os.path.realpath(path)
+        for directory in directories:
+            if os.path.commonpath([path, directory]) == directory:
+                return
+        raise ValueError("{0} is outside of {1}".format(key, ", ".join(directories)))
+
+    def check(self, params):
+        """Run check and return Nagios status code and plugin output
+
+        :param params: Check parameters, named after the plugin arguments
+        """
+        plugin = CheckURLSpecPlugin()
+        try:
+            params = self.get_params(params)
+        except ValueError as exc:
+            message = "Invalid check parameters: {0}".format(exc)
+            return (UNKNOWN, plugin.get_output(UNKNOWN, message))
+        for key, value in params.items():
+            plugin[key] = value
+
+        def run_check(deadline):
+            (validator, lock, spec) = self.get_validator(plugin["file"], options)
+            with lock:
+                validator.spec = spec
+                # Shortened by the time spent waiting on an identical check
+                validator.deadline = deadline
+                return plugin.check(validator)
+
+        try:
+            options = plugin.get_options()
+            (code, message) = plugin.check_shared(run_check, options)
+        except Exception as exc:  # pylint: disable=broad-except
+            (code, message) = (UNKNOWN, "Check failed: {0}".format(exc))
+        return (code, plugin.get_output(code, message))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for validator, _ in self.validators.values():
+            validator.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+    @classmethod
+    def cli(cls):
+        """Set up command line interface, process arguments"""
+        parser = argparse.ArgumentParser(description=cls.__doc__)
+        parser.add_argument(
+            "-S",
+            "--socket",
+            dest="socket_path",
+            default=DEFAULT_SOCKET,
+            help="Socket path to listen on",
+        )
+        parser.add_argument(
+            "--socket-mode",
+            dest="socket_mode",
+            type=lambda value: int(value, 8),
+            default=SOCKET_MODE,
+            help="Socket file mode, in octal, default {0:o}".format(SOCKET_MODE),
+        )
+        parser.add_argument(
+            "-d",
+            "--spec-dir",
+            dest="spec_dirs",
+            action="append",
+            help="Directory of spec files and hosts files checks may read, can be repeated,"
+            " default {0}".format(DEFAULT_SPEC_DIR),
+        )
+        parser.add_argument(
+            "--state-dir",
+            dest="state_dir",
+            default=DEFAULT_STATE_DIR,
+            help="Directory of history files and result caches checks may write,"
+            " default {0}".format(DEFAULT_STATE_DIR),
+        )
+        args = parser.parse_args()
+
+        self = cls(
+            args.socket_path,
+            socket_mode=args.socket_mode,
+            spec_dirs=args.spec_dirs or [DEFAULT_SPEC_DIR],
+            state_dir=args.state_dir,
+        )
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
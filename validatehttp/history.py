@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run history of spec rules
+
+:py:cls:`RunHistory` keeps the last outcome, flakiness and latency of each
+rule in a local JSON file, so that later runs can send the rules most likely
+to fail, and the slowest rules, first. This shortens the time to the first
+failure, and the total run time when rules run concurrently.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import time
+
+from .cache import atomic_write
+from .cache import locked_file
+
+
+# Bump when the history file format changes
+HISTORY_VERSION = 1
+
+# Weight of each run in the latency and flakiness moving averages
+HISTORY_WEIGHT = 0.3
+
+# Seconds to keep history of rules that are no longer run
+HISTORY_TTL = 30 * 24 * 60 * 60
+
+
+class RunHistory(object):
+    """History of rule outcomes, stored in a local file
+
+    Outcomes of a run are added with :py:meth:`add`, and written with
+    :py:meth:`save`. The history file is replaced atomically, under an
+    exclusive lock, and the outcomes are merged with the file as it is at the
+    time of writing, so that checks sharing the file don't lose each other's
+    outcomes.
+
+    Each rule record holds:
+
+    ``last``
+        Outcome of the last run, ``pass`` or ``fail``
+    ``flaky``
+        Moving average of outcome changes between runs, from 0 for a rule
+        that always has the same outcome to 1 for a rule that changes outcome
+        on every run
+    ``latency``
+        Moving average of the response latency, in seconds
+
+    :param path: History file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rules = None
+        self._outcomes = {}
+
+    def load(self):
+        """Load rule records from the history file, and return them"""
+        self.rules = self.read()
+        return self.rules
+
+    def read(self):
+        """Return rule records from the history file, empty if there is no valid file"""
+        try:
+            with open(self.path) as handle:
+                data = json.load(handle)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get("version") != HISTORY_VERSION:
+            return {}
+        return data.get("rules", {})
+
+    def get(self, rule):
+        """Return history record of rule, or None for a new rule"""
+        if self.rules is None:
+            self.load()
+        return self.rules.get(get_rule_key(rule))
+
+    def get_priority(self, rule):
+        """Return sort key for running rules, most urgent first
+
+        Rules that failed on their last run come first, then new rules, as
+        their latency is unknown, then the other rules, slowest first.
+        """
+        record = self.get(rule)
+        if record is None:
+            return (1, float("-inf"))
+        failed = 0 if record.get("last") == "fail" else 1
+        return (failed, -(record.get("latency") or 0))
+
+    def add(self, rule, failed, elapsed=None):
+        """Add the outcome of a rule to this run's outcomes
+
+        With several hosts, a rule fails on this run if it fails on any host.
+
+        :param rule: Spec rule
+        :param failed: Whether the rule failed
+        :param elapsed: Response latency, in seconds, or None
+        """
+        key = get_rule_key(rule)
+        (any_failed, latencies) = self._outcomes.get(key, (False, []))
+        if elapsed is not None:
+            latencies.append(elapsed)
+        self._outcomes[key] = (any_failed or failed, latencies)
+
+    def save(self):
+        """Merge this run's outcomes into the history file"""
+        if not self._outcomes:
+            return
+        now = time.time()
+        with self.lock():
+            rules = self.read()
+            for key, (failed, latencies) in self._outcomes.items():
+                rules[key] = update_record(rules.get(key), failed, latencies, now)
+            rules = dict(
+                (key, record)
+                for (key, record) in rules.items()
+                if record.get("updated", 0) > now - HISTORY_TTL
+            )
+            with atomic_write(self.path) as handle:
+                json.dump({"version": HISTORY_VERSION, "rules": rules}, handle, sort_keys=True)
+        self.rules = rules
+        self._outcomes = {}
+
+    def lock(self):
+        """Hold an exclusive lock on the history file, while it is updated
+
+        The lock is taken on a separate lock file, see
+        :py:func:`~validatehttp.cache.locked_file`. Without :py:mod:`fcntl`,
+        updates are not locked, but are still atomic.
+        """
+        return locked_file(self.path + ".lock")
+
+
+def update_record(record, failed, latencies, now):
+    """Return rule history record, updated with the outcome of a run
+
+    :param record: Previous rule record, or None for a new rule
+    :param failed: Whether the rule failed on this run
+    :param latencies: Response latencies of the rule on this run, in seconds
+    :param now: Time of the run
+    """
+    outcome = "fail" if failed else "pass"
+    latency = None
+    if latencies:
+        latency = sum(latencies) / len(latencies)
+    if record is None:
+        return {"last": outcome, "flaky": 0.0, "latency": latency, "runs": 1, "updated": now}
+    changed = 1.0 if record.get("last") != outcome else 0.0
+    flaky = record.get("flaky", 0.0)
+    flaky += HISTORY_WEIGHT * (changed - flaky)
+    if latency is None:
+        latency = record.get("latency")
+    elif record.get("latency") is not None:
+        latency = record["latency"] + HISTORY_WEIGHT * (latency - record["latency"])
+    return {
+        "last": outcome,
+        "flaky": flaky,
+        "latency": latency,
+        "runs": record.get("runs", 0) + 1,
+        "updated": now,
+    }
+
+
+def get_rule_key(rule):
+    """Return key identifying a rule in the history file
+
+    The key is the rule URI, followed by a hash of the rule request and
+    response assertions, so that rules for the same URI are told apart.
+    """
+    params = json.dumps(
+        [rule.request, rule.response, rule.timeout], sort_keys=True, default=repr
+    ).encode("utf-8")
+    return "{0}#{1}".format(rule.uri, hashlib.sha1(params).hexdigest()[:8])
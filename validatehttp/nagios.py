@@ -5,11 +5,25 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import time
+from collections import Counter
+
+from pynag.Plugins import UNKNOWN
 from pynag.Plugins import simple as Plugin  # noqa
 
+from .cache import RESULT_CACHE_TTL
+from .cache import ResultCache
+from .validate import DEFAULT_TIMEOUT
 from .validate import ValidationFail
 from .validate import ValidationPass
 from .validate import Validator
+from .validate import get_percentiles
+from .validate import load_hosts
+
+
+# Validator options that don't change the outcome of a check, so that checks
+# differing only in these options share results
+UNSHARED_OPTIONS = ("concurrency", "history_file", "order")
 
 
 class CheckURLSpecPlugin(Plugin):
@@ -26,6 +40,44 @@ class CheckURLSpecPlugin(Plugin):
         self.add_arg(
             "V", "no-verify", "No HTTPS verification", required=False, action="store_false"
         )
+        self.add_arg("j", "concurrency", "Number of concurrent requests", required=False)
+        self.add_arg("F", "hosts-file", "File listing hosts to check, one per line", required=False)
+        self.add_arg("C", "cache-dir", "Directory to cache parsed spec files in", required=False)
+        self.add_arg("m", "max-failures", "Stop checking after this many failures", required=False)
+        self.add_arg(
+            "D", "deadline", "Seconds to check for, keep below the service timeout", required=False
+        )
+        self.add_arg(
+            "y",
+            "history-file",
+            "File to keep rule history in, to check failing and slow rules first",
+            required=False,
+        )
+        self.add_arg(
+            "R",
+            "retries",
+            "Number of times to retry requests that fail to connect or lose their connection",
+            required=False,
+        )
+        self.add_arg(
+            "e",
+            "hedge",
+            "Send a duplicate of requests slower than the 95th percentile so far",
+            required=False,
+            action="store_true",
+        )
+        self.add_arg(
+            "k",
+            "result-cache",
+            "File to share results in between checks of the same spec and host",
+            required=False,
+        )
+        self.add_arg(
+            "K",
+            "result-ttl",
+            "Seconds to reuse shared results for, default {0}".format(RESULT_CACHE_TTL),
+            required=False,
+        )
         self.must_threshold = False
 
     @classmethod
@@ -33,31 +85,189 @@ class CheckURLSpecPlugin(Plugin):
         """Create instance of validator for Nagios output"""
         self = cls()
         self.activate()
-        spec_file = self["file"]
-        host = self["host"]
+        options = self.get_options()
+
+        def run_check(deadline):
+            validator = Validator.load(
+                self["file"], cache_dir=self["cache-dir"], **dict(options, deadline=deadline)
+            )
+            return self.check(validator)
+
+        (code, message) = self.check_shared(run_check, options)
+        self.nagios_exit(code, message)
+
+    def get_options(self):
+        """Validator options from plugin arguments"""
+        hosts = []
+        if self["host"] is not None:
+            hosts = self["host"].split(",")
+        if self["hosts-file"] is not None:
+            hosts.extend(load_hosts(self["hosts-file"]))
         port = None
         if self["port"] is not None:
             port = self["port"]
         verify = self["no-verify"]
         if verify is None:
             verify = True
+        concurrency = None
+        if self["concurrency"] is not None:
+            concurrency = int(self["concurrency"])
+        timeout = DEFAULT_TIMEOUT
+        if self["timeout"] is not None:
+            timeout = float(self["timeout"]) or None
+        max_failures = None
+        if self["max-failures"] is not None:
+            max_failures = int(self["max-failures"])
+        deadline = None
+        if self["deadline"] is not None:
+            deadline = float(self["deadline"])
+        retries = 0
+        if self["retries"] is not None:
+            retries = int(self["retries"])
+        return {
+            "port": port,
+            "verify": verify,
+            "concurrency": concurrency,
+            "hosts": hosts,
+            "timeout": timeout,
+            "max_failures": max_failures,
+            "deadline": deadline,
+            "history_file": self["history-file"],
+            "order": "history" if self["history-file"] else "spec",
+            "retries": retries,
+            "hedge": bool(self["hedge"]),
+        }
+
+    def get_result_cache(self):
+        """Result cache from plugin arguments, or None without a result cache"""
+        if self["result-cache"] is None:
+            return None
+        ttl = RESULT_CACHE_TTL
+        if self["result-ttl"] is not None:
+            ttl = float(self["result-ttl"])
+        return ResultCache(self["result-cache"], ttl=ttl)
+
+    def check_shared(self, run_check, options):
+        """Run check, or reuse the result of an identical check
+
+        With a result cache, checks of the same spec file contents, with the
+        same options, share results. Options that don't change the outcome of
+        a check, :py:data:`UNSHARED_OPTIONS`, don't keep checks from sharing
+        results. A check arriving while an identical check is in progress
+        waits for its result, up to the deadline, and if it has to run the
+        check after all, only runs it for the rest of the deadline.
+
+        :param run_check: Function running the check with a deadline, in
+            seconds or None, returning a tuple of Nagios status code and
+            message, see :py:meth:`check`
+        :param options: Validator options, see :py:meth:`get_options`
+        :returns: Tuple of Nagios status code and message
+        """
+        deadline = options["deadline"]
+        cache = self.get_result_cache()
+        if cache is None:
+            return run_check(deadline)
+        with open(self["file"], "rb") as handle:
+            content = handle.read()
+        key = ResultCache.get_key(
+            content,
+            dict(
+                (name, value) for (name, value) in options.items() if name not in UNSHARED_OPTIONS
+            ),
+        )
+        start = time.monotonic()
+
+        def run():
+            remaining = deadline
+            if remaining is not None:
+                # A zero deadline would be taken as no deadline
+                remaining = max(deadline - (time.monotonic() - start), 0.001)
+            (code, message) = run_check(remaining)
+            return {"code": code, "message": message, "perfdata": self.data["perfdata"]}
+
+        result = cache.get_or_run(key, run, timeout=deadline)
+        if result is None:
+            return (UNKNOWN, "identical check still running at the deadline")
+        self.data["perfdata"] = result["perfdata"]
+        return (result["code"], result["message"])
 
-        # Build, test validator
-        validator = Validator.load(spec_file, host, port, verify=verify)
-        results = list(validator.validate())
-        passed = [result for result in results if isinstance(result, ValidationPass)]
-        failures = [result for result in results if isinstance(result, ValidationFail)]
+    def check(self, validator):
+        """Run validator and add Nagios messages and performance data for the results
 
-        if len(list(failures)) == 0:
-            self.add_message("OK", "{0}/{0} Spec tests passed".format(len(results)))
+        :param validator: Validator to run
+        :type validator: Validator
+        :returns: Tuple of Nagios status code and message
+        """
+        multihost = len(validator.targets) > 1
+        # Results are counted as they complete, only failed rules are kept for
+        # the failure messages
+        count = Counter(results=0, passes=0, failures=0, bytes=0)
+        failures = []
+        latencies = []
+        start = time.monotonic()
+        for result in validator.validate():
+            count["results"] += 1
+            if isinstance(result, ValidationPass):
+                count["passes"] += 1
+            elif isinstance(result, ValidationFail):
+                count["failures"] += 1
+                failures.append((result.rule.uri, result.host))
+            if not result.shared:
+                if result.elapsed is not None:
+                    latencies.append(result.elapsed)
+                count["bytes"] += result.size or 0
+        self.add_check_perfdata(time.monotonic() - start, count, latencies)
+
+        if count["failures"] == 0:
+            self.add_message("OK", "{0}/{0} Spec tests passed".format(count["results"]))
         else:
             self.add_message(
                 "CRITICAL",
-                "Passed {passed}/{count} ({failures} failures)".format(
-                    count=len(results), passed=len(passed), failures=len(failures)
+                "Passed {passes}/{results} ({failures} failures)".format(**count),
+            )
+            if multihost:
+                failed_hosts = Counter(host for (_, host) in failures)
+                for host, host_count in failed_hosts.items():
+                    self.add_message(
+                        "CRITICAL", "host {0} had {1} failures".format(host, host_count)
+                    )
+            for uri, host in failures:
+                if multihost:
+                    self.add_message("CRITICAL", "spec {0} failed on {1}".format(uri, host))
+                else:
+                    self.add_message("CRITICAL", "spec {0} failed".format(uri))
+        if validator.stopped == "max_failures":
+            self.add_message(
+                "CRITICAL", "stopped after {0} failures".format(validator.max_failures)
+            )
+        elif validator.stopped == "deadline":
+            self.add_message(
+                "WARNING",
+                "deadline of {0:g}s reached, {1} results checked".format(
+                    validator.deadline, count["results"]
                 ),
             )
-            for result in failures:
-                self.add_message("CRITICAL", "spec {0} failed".format(result.rule.uri))
-        (code, message) = self.check_messages(joinstr=", ")
-        self.nagios_exit(code, message)
+        if validator.spec.errors:
+            self.add_message("WARNING", "{0} invalid spec rules".format(len(validator.spec.errors)))
+        return self.check_messages(joinstr=", ")
+
+    def add_check_perfdata(self, duration, count, latencies):
+        """Add performance data for a check run
+
+        :param duration: Check duration, in seconds
+        :param count: Counter of results, passes, failures and bytes received
+        :param latencies: Response latencies of results, in seconds
+        """
+        self.add_perfdata("duration", "{0:.3f}".format(duration), uom="s", minimum=0)
+        self.add_perfdata("results", count["results"], minimum=0)
+        self.add_perfdata("failures", count["failures"], minimum=0, maximum=count["results"])
+        self.add_perfdata("bytes", count["bytes"], uom="B", minimum=0)
+        percentiles = get_percentiles(latencies, (95,))
+        if percentiles is not None:
+            self.add_perfdata("latency_p95", "{0:.3f}".format(percentiles[0]), uom="s", minimum=0)
+            self.add_perfdata("latency_max", "{0:.3f}".format(max(latencies)), uom="s", minimum=0)
+
+    def get_output(self, code, message):
+        """Plugin output line, as printed by :py:meth:`nagios_exit`"""
+        code = self.code_string2int(code)
+        return "%s: %s %s" % (self.status_text[code], message, self.perfdata_string())
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""
+Machine readable result reports
+
+Reporters write validation results to a file as :py:meth:`Validator.validate`
+yields them, so that reports of large runs use constant memory and can be
+followed while the run is in progress. :py:func:`get_reporter` looks up a
+reporter by format name.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import time
+
+from .cache import atomic_write
+from .cache import get_file_mode
+from .validate import ValidationFail
+from .validate import ValidationPass
+
+
+# Upper bounds of the response latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Reporter(object):
+    """Base for result reporters
+
+    :param path: File to write the report to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+
+    def start(self):
+        """Open the report file and write the report header"""
+        self.handle = open(self.path, "w")
+
+    def add(self, result):
+        """Write a validation result to the report
+
+        :param result: Validation result
+        :type result: ValidationResult
+        """
+        raise NotImplementedError
+
+    def add_error(self, uri, error):
+        """Write an invalid spec rule to the report
+
+        :param uri: Rule URI
+        :param error: Error raised parsing the rule
+        """
+        pass
+
+    def finish(self):
+        """Write the report footer and close the report file"""
+        self.handle.close()
+        self.handle = None
+
+
+class JsonLinesReporter(Reporter):
+    """Report each result as a line of JSON"""
+
+    def add(self, result):
+        self.handle.write(json.dumps(get_record(result), sort_keys=True, default=str) + "\n")
+        self.handle.flush()
+
+    def add_error(self, uri, error):
+        record = {"uri": uri, "outcome": "invalid", "error": str(error)}
+        self.handle.write(json.dumps(record, sort_keys=True) + "\n")
+        self.handle.flush()
+
+
+class JUnitReporter(Reporter):
+    """Report results as JUnit XML test cases
+
+    Test suite totals aren't known until the run is complete, so they are
+    left out, JUnit consumers count the test cases instead. The XML helpers
+    are imported on first use, as they are slow to import and most runs
+    don't write a JUnit report.
+    """
+
+    def start(self):
+        super(JUnitReporter, self).start()
+        self.handle.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.handle.write('<testsuites>\n<testsuite name="validatehttp">\n')
+        self.handle.flush()
+
+    def add(self, result):
+        from xml.sax.saxutils import escape
+        from xml.sax.saxutils import quoteattr
+
+        record = get_record(result)
+        attrs = 'classname={0} name={1} time="{2:.6f}"'.format(
+            quoteattr(record["host"] or "validatehttp"),
+            quoteattr(record["uri"]),
+            record["elapsed"] or 0,
+        )
+        if record["outcome"] == "pass":
+            self.handle.write("<testcase {0}/>\n".format(attrs))
+        else:
+            body = ""
+            if record["mismatch"] is not None:
+                body = escape(
+                    "Expected: {expected}\nReceived: {received}".format(**record["mismatch"])
+                )
+            self.handle.write(
+                "<testcase {0}><failure message={1}>{2}</failure></testcase>\n".format(
+                    attrs, quoteattr(record["error"] or ""), body
+                )
+            )
+        self.handle.flush()
+
+    def add_error(self, uri, error):
+        from xml.sax.saxutils import quoteattr
+
+        self.handle.write(
+            "<testcase classname={0} name={1}><error message={2}/></testcase>\n".format(
+                quoteattr("validatehttp"), quoteattr(uri), quoteattr(str(error))
+            )
+        )
+        self.handle.flush()
+
+    def finish(self):
+        self.handle.write("</testsuite>\n</testsuites>\n")
+        super(JUnitReporter, self).finish()
+
+
+class PrometheusReporter(Reporter):
+    """Report result totals as Prometheus text format metrics
+
+    Metrics are a snapshot of the whole run, so results are totalled per host
+    as they arrive, and the report file is replaced atomically at the end of
+    the run, as the node exporter textfile collector expects.
+
+    :param openmetrics: Write OpenMetrics text format instead
+    """
+
+    def __init__(self, path, openmetrics=False):
+        super(PrometheusReporter, self).__init__(path)
+        self.openmetrics = openmetrics
+        self.hosts = {}
+        self.invalid = 0
+
+    def start(self):
+        self.hosts = {}
+        self.invalid = 0
+
+    def add(self, result):
+        record = get_record(result)
+        host = self.hosts.get(record["host"])
+        if host is None:
+            host = self.hosts[record["host"]] = {
+                "pass": 0,
+                "fail": 0,
+                "bytes": 0,
+                "buckets": [0] * len(LATENCY_BUCKETS),
+                "count": 0,
+                "sum": 0.0,
+            }
+        host[record["outcome"]] += 1
+        if record["shared"]:
+            return
+        host["bytes"] += record["bytes"] or 0
+        if record["elapsed"] is not None:
+            host["count"] += 1
+            host["sum"] += record["elapsed"]
+            for n, bound in enumerate(LATENCY_BUCKETS):
+                if record["elapsed"] <= bound:
+                    host["buckets"][n] += 1
+
+    def add_error(self, uri, error):
+        self.invalid += 1
+
+    def finish(self):
+        # The textfile collector may run as another user
+        with atomic_write(self.path, mode=get_file_mode()) as handle:
+            handle.write(self.get_metrics())
+
+    def get_metrics(self):
+        """Return metrics text"""
+        lines = []
+
+        def family(name, kind, help_text):
+            # OpenMetrics counter families are named without the _total suffix
+            if self.openmetrics and kind == "counter":
+                name = name[: -len("_total")]
+            lines.append("# HELP {0} {1}".format(name, help_text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+
+        family("validatehttp_results_total", "counter", "Validation results by outcome")
+        for host, totals in sorted(self.hosts.items(), key=lambda item: str(item[0])):
+            for outcome in ("pass", "fail"):
+                lines.append(
+                    "validatehttp_results_total{{{0},outcome={1}}} {2}".format(
+                        get_label("host", host), json.dumps(outcome), totals[outcome]
+                    )
+                )
+        family(
+            "validatehttp_response_bytes_total",
+            "counter",
+            "Response body bytes received",
+        )
+        for host, totals in sorted(self.hosts.items(), key=lambda item: str(item[0])):
+            lines.append(
+                "validatehttp_response_bytes_total{{{0}}} {1}".format(
+                    get_label("host", host), totals["bytes"]
+                )
+            )
+        family(
+            "validatehttp_response_seconds",
+            "histogram",
+            "Time to receive response headers",
+        )
+        for host, totals in sorted(self.hosts.items(), key=lambda item: str(item[0])):
+            label = get_label("host", host)
+            for bound, count in zip(LATENCY_BUCKETS, totals["buckets"]):
+                lines.append(
+                    'validatehttp_response_seconds_bucket{{{0},le="{1}"}} {2}'.format(
+                        label, bound, count
+                    )
+                )
+            lines.append(
+                'validatehttp_response_seconds_bucket{{{0},le="+Inf"}} {1}'.format(
+                    label, totals["count"]
+                )
+            )
+            lines.append(
+                "validatehttp_response_seconds_count{{{0}}} {1}".format(label, totals["count"])
+            )
+            lines.append(
+                "validatehttp_response_seconds_sum{{{0}}} {1!r}".format(label, totals["sum"])
+            )
+        family("validatehttp_invalid_rules", "gauge", "Invalid spec rules")
+        lines.append("validatehttp_invalid_rules {0}".format(self.invalid))
+        family("validatehttp_last_run_seconds", "gauge", "Time the run finished")
+        lines.append("validatehttp_last_run_seconds {0:.3f}".format(time.time()))
+        if self.openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REPORTERS = {
+    "jsonl": JsonLinesReporter,
+    "junit": JUnitReporter,
+    "prometheus": PrometheusReporter,
+    "openmetrics": lambda path: PrometheusReporter(path, openmetrics=True),
+}
+
+
+def get_reporter(value):
+    """Return reporter from a ``format:path`` string
+
+    :raises ValueError: On an unknown report format
+    """
+    try:
+        (name, path) = value.split(":", 1)
+    except ValueError:
+        raise ValueError("Report must be given as format:path")
+    if name not in REPORTERS or not path:
+        raise ValueError(
+            "Unknown report format {0}, expected one of {1}".format(
+                name, ", ".join(sorted(REPORTERS))
+            )
+        )
+    return REPORTERS[name](path)
+
+
+def get_record(result):
+    """Return mapping of report fields for a validation result"""
+    record = {
+        "uri": result.rule.uri,
+        "host": result.host,
+        "outcome": "pass" if isinstance(result, ValidationPass) else "fail",
+        "shared": result.shared,
+        "elapsed": result.elapsed,
+        "bytes": result.size,
+        "error": None,
+        "mismatch": None,
+        "timing": None,
+        "attempts": result.attempts,
+    }
+    if result.timing is not None:
+        if result.timing.received is not None:
+            record["bytes"] = result.timing.received
+        record["timing"] = result.timing.as_dict()
+    if isinstance(result, ValidationFail):
+        record["error"] = str(result.error)
+        mismatch = result.mismatch()
+        if mismatch is not None:
+            record["mismatch"] = {"expected": mismatch[0], "received": mismatch[1]}
+    return record
+
+
+def get_label(name, value):
+    """Return Prometheus label pair, escaped"""
+    value = "" if value is None else str(value)
+    value = value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return '{0}="{1}"'.format(name, value)
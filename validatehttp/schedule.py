@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pace requests to each host
+
+:py:cls:`Scheduler` sits in front of request dispatch, and holds back requests
+to each host with a token bucket rate limit, an adaptive concurrency limit, or
+both, so that validation runs as fast as the host safely allows.
+
+:py:cls:`HedgeDelay` and :py:func:`get_backoff` time the extra requests sent
+for hedged and retried requests.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import math
+import random
+import threading
+import time
+from collections import deque
+
+
+# Highest adaptive concurrency to each host, when no concurrency is given
+ADAPTIVE_CONCURRENCY = 64
+
+# Average latency above this multiple of the lowest average latency counts as
+# congestion
+LATENCY_TOLERANCE = 2.0
+
+# Latency rises smaller than this, in seconds, are jitter, not congestion
+LATENCY_SLACK = 0.01
+
+# Weight of each latency sample in the latency moving average
+LATENCY_WEIGHT = 0.2
+
+# Latest latencies to take the hedging delay from
+HEDGE_WINDOW = 1000
+
+# Latencies to see before hedging requests
+HEDGE_MIN_SAMPLES = 20
+
+# Latencies to add between updates of the hedging delay
+HEDGE_REFRESH = 10
+
+# Longest wait before retrying a request, in seconds
+RETRY_BACKOFF_MAX = 5.0
+
+
+class TokenBucket(object):
+    """Token bucket rate limit
+
+    Tokens are added at ``rate`` tokens per second, up to ``burst`` tokens.
+    Each request takes a token. When the bucket is empty, requests reserve a
+    future token and wait for it, so waiting requests go out in turn at
+    exactly the limit rate.
+
+    :param rate: Highest rate of requests per second
+    :param burst: Highest number of requests sent at once
+    :param clock: Monotonic clock function, in seconds
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, and return the number of seconds to wait before using it"""
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Take a token, waiting until it is available"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class AdaptiveLimit(object):
+    """Concurrency limit adjusted to observed latency and errors
+
+    The limit starts at ``minimum`` and grows by one request for each healthy
+    response until the first sign of congestion, then by one request per
+    round of ``limit`` responses. It is halved on a failed request, a 5xx
+    response, or when the average latency rises above
+    :py:data:`LATENCY_TOLERANCE` times the lowest average latency, plus
+    :py:data:`LATENCY_SLACK`. Requests already in flight when the limit is
+    halved don't halve it again.
+
+    :param maximum: Highest concurrency limit
+    :param minimum: Lowest concurrency limit
+    """
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.limit = float(minimum)
+        self.in_flight = 0
+        self.slow_start = True
+        self.latency = None
+        self.min_latency = None
+        # Number of completions to ignore congestion for, after a decrease
+        self._hold = 0
+        self._cond = threading.Condition()
+
+    def try_acquire(self):
+        """Take a request slot if one is free, returning whether it was taken"""
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        """Take a request slot, waiting until one is free"""
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None, ok=True):
+        """Free a request slot, and adjust the limit to the request outcome
+
+        :param latency: Request latency in seconds, or None if unknown
+        :param ok: Whether the request succeeded, without a server error
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self.update(latency, ok)
+            self._cond.notify_all()
+
+    def update(self, latency, ok):
+        """Adjust the limit to the outcome of a completed request"""
+        congested = not ok
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_WEIGHT * (latency - self.latency)
+            if self.min_latency is None or self.latency < self.min_latency:
+                self.min_latency = self.latency
+            if self.latency > LATENCY_TOLERANCE * self.min_latency + LATENCY_SLACK:
+                congested = True
+                if self.limit <= self.minimum:
+                    # Latency is high even at the lowest limit, the host is
+                    # slower than it was, and this is its new baseline
+                    self.min_latency = self.latency
+        if self._hold > 0:
+            self._hold -= 1
+        elif congested:
+            self.limit = max(self.minimum, self.limit / 2)
+            self.slow_start = False
+            self._hold = self.in_flight
+        if congested:
+            return
+        if self.slow_start:
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class Scheduler(object):
+    """Pace requests to each host
+
+    Each host gets its own rate limit and concurrency limit.
+
+    :param max_rps: Highest rate of requests per second to each host
+    :param adaptive: Adjust the number of requests in flight to each host to
+        the observed latency and error rate
+    :param concurrency: Highest number of requests in flight to each host, in
+        adaptive mode
+    """
+
+    def __init__(self, max_rps=None, adaptive=False, concurrency=ADAPTIVE_CONCURRENCY):
+        self.max_rps = max_rps
+        self.adaptive = adaptive
+        self.concurrency = concurrency
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get_host(self, host):
+        """Return token bucket and adaptive limit for host, either can be None"""
+        with self._lock:
+            limits = self._hosts.get(host)
+            if limits is None:
+                bucket = None
+                if self.max_rps:
+                    bucket = TokenBucket(self.max_rps)
+                limit = None
+                if self.adaptive:
+                    limit = AdaptiveLimit(self.concurrency)
+                limits = self._hosts[host] = (bucket, limit)
+            return limits
+
+    def acquire(self, host):
+        """Wait until a request to host can be sent"""
+        (bucket, limit) = self.get_host(host)
+        # Wait for a free slot before taking a token, so tokens aren't held
+        # by requests that can't be sent yet
+        if limit is not None:
+            limit.acquire()
+        if bucket is not None:
+            bucket.acquire()
+
+    def release(self, host, latency=None, ok=True):
+        """Record the outcome of a request to host
+
+        :param host: Host the request was sent to
+        :param latency: Request latency in seconds, or None if unknown
+        :param ok: Whether the request succeeded, without a server error
+        """
+        (_, limit) = self.get_host(host)
+        if limit is not None:
+            limit.release(latency, ok)
+
+    def get_limits(self):
+        """Return mapping of host to current adaptive concurrency limit"""
+        with self._lock:
+            return dict(
+                (host, int(limit.limit))
+                for (host, (_, limit)) in self._hosts.items()
+                if limit is not None
+            )
+
+
+class HedgeDelay(object):
+    """Time to wait for a response before hedging a request
+
+    The delay is a percentile of the latest latencies of the run, so only the
+    slowest requests are hedged, whatever the latency of the host. There is
+    no delay, and requests aren't hedged, until enough latencies are seen.
+
+    :param percent: Latency percentile to hedge at
+    :param window: Number of latest latencies to take the percentile of
+    :param min_samples: Latencies to see before hedging requests
+    """
+
+    def __init__(self, percent=95, window=HEDGE_WINDOW, min_samples=HEDGE_MIN_SAMPLES):
+        self.percent = percent
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.delay = None
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget the latencies of the last run"""
+        with self._lock:
+            self.latencies.clear()
+            self.delay = None
+            self._added = 0
+
+    def add(self, latency):
+        """Add the latency of a request, in seconds"""
+        with self._lock:
+            self.latencies.append(latency)
+            self._added += 1
+            if len(self.latencies) < self.min_samples:
+                return
+            # Sorting the window on every request would be wasteful, the
+            # percentile moves slowly
+            if self.delay is None or self._added >= HEDGE_REFRESH:
+                self._added = 0
+                values = sorted(self.latencies)
+                rank = int(math.ceil(self.percent * len(values) / 100.0))
+                self.delay = values[max(rank - 1, 0)]
+
+    def get(self):
+        """Return seconds to wait before hedging a request, or None to not hedge"""
+        return self.delay
+
+
+def get_backoff(attempt, backoff, maximum=RETRY_BACKOFF_MAX, rand=random.random):
+    """Return seconds to wait before retrying a request
+
+    The wait doubles with each attempt, up to ``maximum``, with full jitter,
+    so that retries of requests that failed together are spread out.
+
+    :param attempt: Number of attempts made so far
+    :param backoff: Wait before the first retry, before jitter, in seconds
+    :param maximum: Longest wait, in seconds
+    :param rand: Random number function, returning values from 0 to 1
+    """
+    return rand() * min(maximum, backoff * 2 ** (attempt - 1))
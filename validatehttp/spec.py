@@ -5,19 +5,16 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import codecs
+import io
 import json
 import os.path
-import sys
+import re
 
 from requests import Request
 from requests import Response
 
 
-try:
-    import yaml
-except ImportError:
-    pass
-
 try:
     # Python 2.x
     import urlparse
@@ -26,35 +23,126 @@ except ImportError:
     from urllib import parse as urlparse
 
 
+# Bytes read at a time from streamed response bodies
+CHUNK_SIZE = 64 * 1024
+
+# Characters kept between streamed chunks for regular expression assertions
+REGEX_OVERLAP = 1024
+
+# Response attributes that can be tested without reading the response body
+HEADER_ATTRIBUTES = (
+    "status_code",
+    "headers",
+    "reason",
+    "url",
+    "encoding",
+    "ok",
+    "is_redirect",
+    "is_permanent_redirect",
+    "links",
+    "cookies",
+    "elapsed",
+    "history",
+    "max_elapsed_ms",
+)
+
+
 class ValidatorSpecBase(object):
-    """List of validator spec rules"""
+    """List of validator spec rules
+
+    :param rules: List of spec rules, or None to read rules from the spec file
+        incrementally
+    :param spec_file: Spec file path, for specs loaded incrementally
+    """
 
-    def __init__(self, rules):
+    def __init__(self, rules, spec_file=None):
         self.rules = rules
+        self.spec_file = spec_file
+        # Invalid rules, as a list of URI and error message pairs
+        self.errors = []
 
     @classmethod
-    def load(cls, spec_file):
-        """Load from spec file"""
+    def load(cls, spec_file, cache_dir=None, lazy=False):
+        """Load from spec file
+
+        :param spec_file: Spec file path
+        :param cache_dir: Directory to cache parsed spec files in. Later loads
+            of an unchanged spec file skip parsing the spec file.
+        :param lazy: Don't load rules up front, instead parse the spec file
+            incrementally each time rules are iterated over. This keeps memory
+            use flat for very large spec files.
+        """
         if not os.path.exists(spec_file):
             raise IOError("Spec file does not exist")
-        handle = open(spec_file)
-        rules = []
-        spec = cls.parse(handle)
-        for uri, params in spec.items():
-            try:
-                rules.append(ValidatorSpecRule(uri, **params))
-            except (KeyError, TypeError):
-                pass
-        return cls(rules)
+        if lazy:
+            return cls(None, spec_file=spec_file)
+        if cache_dir is None:
+            handle = open(spec_file)
+            entries = cls.parse_entries(handle)
+        else:
+            from .cache import SpecCache
+
+            entries = cls.parse_cached(spec_file, SpecCache(cache_dir))
+        self = cls([])
+        self.rules = list(self.build_rules(entries))
+        return self
 
     @classmethod
     def parse(cls, handle):  # pylint: disable=unused-argument
         raise NotImplementedError()
 
+    @classmethod
+    def parse_entries(cls, handle):
+        """Parse spec file into a list of URI and rule parameter pairs"""
+        return list(cls.parse(handle).items())
+
+    @classmethod
+    def parse_cached(cls, spec_file, cache):
+        """Parse spec file entries, or return the cached entries if unchanged
+
+        :param spec_file: Spec file path
+        :param cache: Parsed spec cache
+        :type cache: SpecCache
+        """
+        with open(spec_file, "rb") as handle:
+            content = handle.read()
+        entries = cache.get(spec_file, content)
+        if entries is None:
+            entries = cls.parse_entries(io.StringIO(content.decode("utf-8")))
+            cache.set(spec_file, content, entries)
+        return entries
+
+    @classmethod
+    def iter_entries(cls, handle):
+        """Yield URI and rule parameter pairs from spec file incrementally"""
+        return iter(cls.parse_entries(handle))
+
+    def build_rules(self, entries):
+        """Yield spec rules from URI and rule parameter pairs
+
+        Invalid rules are skipped, and added to :py:attr:`errors`. Parameters
+        can be an exception instance, for entries that could not be parsed.
+        """
+        for uri, params in entries:
+            try:
+                if isinstance(params, Exception):
+                    raise params
+                if not isinstance(params, dict):
+                    raise TypeError("Rule is not a mapping")
+                yield ValidatorSpecRule(uri, **params)
+            except (KeyError, TypeError, ValueError) as exc:
+                self.errors.append((uri, str(exc)))
+
     def get_rules(self):
         """Yield rules with proper request object"""
-        for rule in self.rules:
-            yield rule
+        if self.rules is not None:
+            for rule in self.rules:
+                yield rule
+            return
+        self.errors = []
+        with open(self.spec_file) as handle:
+            for rule in self.build_rules(self.iter_entries(handle)):
+                yield rule
 
 
 class JsonValidatorSpec(ValidatorSpecBase):
@@ -66,24 +154,203 @@ class JsonValidatorSpec(ValidatorSpecBase):
             raise ValueError("Invalid JSON spec file")
         return spec
 
+    @classmethod
+    def iter_entries(cls, handle):
+        return iter_json_object(handle)
+
+
+class JsonLinesValidatorSpec(ValidatorSpecBase):
+    """JSON Lines spec, with one rule object per line
+
+    Each rule object has a ``uri`` key, along with the rule parameters. Unlike
+    other spec formats, several rules can share the same URI.
+    """
+
+    @classmethod
+    def parse(cls, handle):
+        return dict(cls.iter_entries(handle))
+
+    @classmethod
+    def parse_entries(cls, handle):
+        return list(cls.iter_entries(handle))
+
+    @classmethod
+    def iter_entries(cls, handle):
+        for number, line in enumerate(handle, 1):
+            if not line.strip():
+                continue
+            try:
+                params = json.loads(line)
+                uri = params.pop("uri")
+            except ValueError:
+                yield ("line {0}".format(number), ValueError("Invalid JSON"))
+            except (AttributeError, KeyError):
+                yield ("line {0}".format(number), ValueError("Rule has no uri"))
+            else:
+                yield (uri, params)
+
 
 class YamlValidatorSpec(ValidatorSpecBase):
     @classmethod
     def parse(cls, handle):
-        if "yaml" not in sys.modules:
-            raise NameError("YAML support is missing")
+        yaml = import_yaml()
+        # Use libyaml bindings when available, they are much faster
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
         try:
-            spec = yaml.safe_load(handle.read())
+            spec = yaml.load(handle.read(), Loader=loader)
         except (ValueError, yaml.YAMLError):
             raise ValueError("Invalid YAML spec file")
         return spec
 
+    @classmethod
+    def iter_entries(cls, handle):
+        import_yaml()
+        return iter_yaml_mapping(handle)
+
+
+def import_yaml():
+    """Import YAML support, only loaded for YAML specs to keep start up fast
+
+    :raises NameError: If YAML support is missing
+    """
+    try:
+        import yaml
+    except ImportError:
+        raise NameError("YAML support is missing")
+    return yaml
+
+
+def iter_json_object(handle, chunk_size=CHUNK_SIZE):
+    """Yield key and value pairs of a top level JSON object incrementally
+
+    The file is read a chunk at a time, and only the current entry is kept in
+    memory, so the first entries are available before the whole document is
+    read.
+
+    :param handle: File handle to read JSON document from
+    :param chunk_size: Number of characters to read at a time
+    """
+    decoder = json.JSONDecoder()
+    state = {"buffer": "", "pos": 0, "eof": False}
+
+    def read_more():
+        if state["eof"]:
+            raise ValueError("Invalid JSON spec file")
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            state["eof"] = True
+        state["buffer"] = state["buffer"][state["pos"] :] + chunk
+        state["pos"] = 0
+
+    def next_char():
+        while True:
+            buffer = state["buffer"]
+            pos = state["pos"]
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if state["eof"]:
+                return None
+            read_more()
+
+    def next_value():
+        while True:
+            try:
+                (value, end) = decoder.raw_decode(state["buffer"], state["pos"])
+            except ValueError:
+                read_more()
+                continue
+            # Values at the end of the buffer, like numbers, might be truncated
+            if end == len(state["buffer"]) and not state["eof"]:
+                read_more()
+                continue
+            state["pos"] = end
+            return value
+
+    def expect(chars):
+        char = next_char()
+        if char is None or char not in chars:
+            raise ValueError("Invalid JSON spec file")
+        state["pos"] += 1
+        return char
+
+    expect("{")
+    if next_char() == "}":
+        return
+    while True:
+        if next_char() != '"':
+            raise ValueError("Invalid JSON spec file")
+        key = next_value()
+        expect(":")
+        next_char()
+        value = next_value()
+        yield (key, value)
+        if expect(",}") == "}":
+            return
+
+
+def iter_yaml_mapping(handle):
+    """Yield key and value pairs of a top level YAML mapping incrementally
+
+    Parser events are consumed one mapping entry at a time, so the first
+    entries are available before the whole document is parsed.
+
+    :param handle: File handle to read YAML document from
+    """
+    yaml = import_yaml()
+    loader = _yaml_entry_loader(handle)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise ValueError("Invalid YAML spec file")
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = loader.construct_object(loader.compose_node(None, None), deep=True)
+            value = loader.construct_object(loader.compose_node(None, None), deep=True)
+            # Don't keep constructed objects for entries already yielded
+            loader.constructed_objects = {}
+            yield (key, value)
+    except yaml.YAMLError:
+        raise ValueError("Invalid YAML spec file")
+    finally:
+        loader.dispose()
+
+
+def _yaml_entry_loader(stream):
+    """Return YAML loader composing nodes in Python, from libyaml parser events"""
+    yaml = import_yaml()
+    if not hasattr(yaml, "CSafeLoader"):
+        # The pure Python loader already composes nodes from parser events
+        return yaml.SafeLoader(stream)
+
+    class EntryLoader(yaml.composer.Composer, yaml.CSafeLoader):
+        def __init__(self, stream):
+            yaml.CSafeLoader.__init__(self, stream)
+            self.anchors = {}
+
+    return EntryLoader(stream)
+
 
 class ValidatorSpecRule(object):
-    """Validator spec rule"""
+    """Validator spec rule
 
-    def __init__(self, uri, request=None, **response):
+    :param uri: Request URI
+    :param request: Request parameters
+    :param timeout: Seconds to wait for the server to respond, overriding the
+        validator timeout
+    :param response: Response assertions
+    """
+
+    def __init__(self, uri, request=None, timeout=None, **response):
         self.uri = uri
+        self.timeout = None
+        if timeout is not None:
+            self.timeout = float(timeout)
 
         # Normalize request
         if request is None:
@@ -98,12 +365,51 @@ class ValidatorSpecRule(object):
             response = {}
         if "headers" not in response:
             response["headers"] = {}
+        if "max_elapsed_ms" in response:
+            response["max_elapsed_ms"] = float(response["max_elapsed_ms"])
         self.response = response
+        self.content_matcher = None
+        if "content" in response:
+            self.content_matcher = ContentMatcher(response["content"])
+        # Rules testing only status and headers don't need the response body
+        self.needs_body = any(key not in HEADER_ATTRIBUTES for key in response)
+        self._parsed_url = None
+        self._compiled = None
 
     def __repr__(self):
         """String representation of spec rule"""
         return "<ValidatorSpecRule uri={uri}>".format(**self.__dict__)
 
+    def __getstate__(self):
+        """Pickled rule parameters, the compiled rule is rebuilt on first use"""
+        return {
+            "uri": self.uri,
+            "request": self.request,
+            "timeout": self.timeout,
+            "response": self.response,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(
+            state["uri"], request=state["request"], timeout=state["timeout"], **state["response"]
+        )
+
+    @property
+    def parsed_url(self):
+        """Rule URI, parsed on first use"""
+        if self._parsed_url is None:
+            self._parsed_url = urlparse.urlparse(self.uri)
+        return self._parsed_url
+
+    def request_key(self):
+        """Key identifying the request sent for this rule
+
+        Rules with the same key send identical requests, and can share the
+        response.
+        """
+        request = dict(self.request, method=self.request["method"].upper())
+        return (self.uri, json.dumps(request, sort_keys=True, default=repr))
+
     def get_request(self, host=None, port=None):
         """Creat HTTP request from host/port and request params
 
@@ -111,9 +417,11 @@ class ValidatorSpecRule(object):
         :param port: Host port
         """
         # Replace network location chunk of URI so that we can hit separate
-        # web servers with the same spec file
-        params = self.request
-        parsed_url = urlparse.urlparse(self.uri)
+        # web servers with the same spec file. Params are copied, as the same
+        # rule can be requested against several hosts at once
+        params = dict(self.request)
+        params["headers"] = dict(self.request["headers"])
+        parsed_url = self.parsed_url
         if host is None and port is None:
             params["url"] = self.uri
             return Request(**params)
@@ -130,51 +438,260 @@ class ValidatorSpecRule(object):
         params["headers"]["Host"] = parsed_url.hostname
         return Request(**params)
 
-    def matches(self, resp):
+    def matches(self, resp, stream=False):
         """Test whether HTTP response matches defined rule response
 
         Returns True on a match, otherwise raise :py:cls:`ValueError` on a
-        mismatch.
+        mismatch. Content assertions are tested last, so that the body is only
+        read once all other assertions have passed.
 
         :param resp: HTTP response object from request
         :type resp: Response
+        :param stream: Match content assertions chunk by chunk, from a response
+            sent with ``stream=True``, without reading the whole body into
+            memory. Reading stops as soon as the assertions are decided.
         """
-        if isinstance(resp, Response):
-            params = self.response
-            for key, value in params.items():
-                if key == "headers":
-                    for header, value in params.get("headers").items():
-                        resp_value = resp.headers.get(header)
-                        if resp_value != value:
-                            raise ValidationError(
-                                "Response header mismatch: {0}".format(header),
-                                mismatch=(value, resp_value),
-                            )
-                elif key == "content":
-                    for status, contents in params.get("content").items():
-                        for value in contents:
-                            if status == "present" and value not in resp.text:
-                                raise ValidationError(
-                                    "Response content absent: {0}".format(value),
-                                )
-                            if status == "absent" and value in resp.text:
-                                raise ValidationError(
-                                    "Response content present: {0}".format(value),
-                                )
+        return self.compile().matches(resp, stream=stream)
+
+    def compile(self):
+        """Return compiled rule, for repeated requests and matching
+
+        The compiled rule is built once, and reused on later calls.
 
+        :rtype: CompiledRule
+        """
+        if self._compiled is None:
+            self._compiled = CompiledRule(self)
+        return self._compiled
+
+
+class CompiledRule(object):
+    """Spec rule compiled for repeated requests and matching
+
+    Prepared requests are built once for each host and port, and copied for
+    each request. Response assertions are turned into a list of matcher
+    functions, each raising :py:cls:`ValidationError` on a mismatch.
+
+    :param rule: Spec rule to compile
+    :type rule: ValidatorSpecRule
+    """
+
+    __slots__ = ("rule", "uri", "needs_body", "matchers", "content_matcher", "templates")
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.uri = rule.uri
+        self.needs_body = rule.needs_body
+        self.content_matcher = rule.content_matcher
+        self.templates = {}
+        self.matchers = []
+        for key, value in rule.response.items():
+            if key == "content":
+                continue
+            elif key == "headers":
+                for header, header_value in value.items():
+                    self.matchers.append(_header_matcher(header, header_value))
+            elif key == "max_elapsed_ms":
+                self.matchers.append(_elapsed_matcher(value))
+            else:
+                self.matchers.append(_attribute_matcher(key, value))
+
+    def __repr__(self):
+        """String representation of compiled rule"""
+        return "<CompiledRule uri={0}>".format(self.uri)
+
+    def prepare(self, host=None, port=None):
+        """Return prepared request for host and port
+
+        :param host: Host address
+        :param port: Host port
+        :rtype: requests.PreparedRequest
+        """
+        template = self.templates.get((host, port))
+        if template is None:
+            template = self.rule.get_request(host, port).prepare()
+            self.templates[(host, port)] = template
+        return template.copy()
+
+    def matches(self, resp, stream=False):
+        """Test whether HTTP response matches rule, see :py:meth:`ValidatorSpecRule.matches`"""
+        if isinstance(resp, Response):
+            for matcher in self.matchers:
+                matcher(resp)
+            if self.content_matcher is not None:
+                if stream:
+                    self.content_matcher.match_stream(iter_text(resp))
                 else:
-                    resp_value = getattr(resp, key, None)
-                    if resp_value != value:
-                        raise ValidationError(
-                            "Response mismatch: {0}".format(key),
-                            mismatch=(value, resp_value),
-                        )
+                    # Decode the body once, resp.text decodes on every access
+                    self.content_matcher.match(resp.text)
         return True
 
 
+def _header_matcher(header, value):
+    """Return matcher function for a response header"""
+
+    def matcher(resp):
+        resp_value = resp.headers.get(header)
+        if resp_value != value:
+            raise ValidationError(
+                "Response header mismatch: {0}".format(header),
+                mismatch=(value, resp_value),
+            )
+
+    return matcher
+
+
+def _elapsed_matcher(max_elapsed_ms):
+    """Return matcher function for the time taken to receive response headers"""
+
+    def matcher(resp):
+        elapsed_ms = resp.elapsed.total_seconds() * 1000
+        if elapsed_ms > max_elapsed_ms:
+            raise ValidationError(
+                "Response too slow: {0:.0f}ms".format(elapsed_ms),
+                mismatch=(max_elapsed_ms, elapsed_ms),
+            )
+
+    return matcher
+
+
+def _attribute_matcher(key, value):
+    """Return matcher function for a response attribute"""
+
+    def matcher(resp):
+        resp_value = getattr(resp, key, None)
+        if resp_value != value:
+            raise ValidationError(
+                "Response mismatch: {0}".format(key),
+                mismatch=(value, resp_value),
+            )
+
+    return matcher
+
+
+class ContentMatcher(object):
+    """Content assertions of a spec rule, compiled once for matching
+
+    Assertions are lists of ``present`` and ``absent`` values. Values are
+    literal strings, or mappings with a ``regex`` key to match a regular
+    expression instead.
+
+    :param content: Mapping of assertion type to list of values
+    """
+
+    def __init__(self, content):
+        self.assertions = []
+        # Number of characters kept between streamed chunks, so that values
+        # straddling a chunk boundary are still found
+        self.overlap = 0
+        for status, values in content.items():
+            if status not in ("present", "absent"):
+                continue
+            for value in values:
+                if isinstance(value, dict):
+                    try:
+                        search = re.compile(value["regex"]).search
+                    except re.error:
+                        raise ValueError("Invalid content regex: {0}".format(value["regex"]))
+                    label = "/{0}/".format(value["regex"])
+                    self.overlap = max(self.overlap, REGEX_OVERLAP)
+                else:
+                    search = _literal_search(value)
+                    label = value
+                    self.overlap = max(self.overlap, len(value) - 1)
+                self.assertions.append((status == "present", label, search))
+
+    def match(self, text):
+        """Test all assertions against decoded response body
+
+        Raises :py:cls:`ValidationError` on the first failing assertion.
+
+        :param text: Decoded response body
+        """
+        for present, label, search in self.assertions:
+            found = search(text)
+            if present and not found:
+                raise ValidationError("Response content absent: {0}".format(label))
+            if not present and found:
+                raise ValidationError("Response content present: {0}".format(label))
+
+    def match_stream(self, chunks):
+        """Test all assertions against decoded response body chunks
+
+        Chunks are consumed until every ``present`` assertion is found and no
+        ``absent`` assertions remain, or until an ``absent`` assertion is
+        found, which raises :py:cls:`ValidationError` immediately. Regular
+        expression matches are only found across chunk boundaries if they are
+        shorter than :py:data:`REGEX_OVERLAP`.
+
+        :param chunks: Iterable of decoded response body chunks
+        """
+        pending = [(label, search) for present, label, search in self.assertions if present]
+        absent = [(label, search) for present, label, search in self.assertions if not present]
+        tail = ""
+        for chunk in chunks:
+            text = tail + chunk
+            for label, search in absent:
+                if search(text):
+                    raise ValidationError("Response content present: {0}".format(label))
+            pending = [(label, search) for label, search in pending if not search(text)]
+            if not pending and not absent:
+                return
+            tail = text[-self.overlap :] if self.overlap else ""
+        if pending:
+            (label, _) = pending[0]
+            raise ValidationError("Response content absent: {0}".format(label))
+
+
+def iter_text(resp, chunk_size=CHUNK_SIZE):
+    """Decode streamed response body chunk by chunk
+
+    Unlike :py:attr:`Response.text`, the encoding is not detected from the body
+    when the response has no charset, UTF-8 is assumed instead. As with
+    :py:attr:`Response.text`, an unknown charset also falls back to UTF-8.
+
+    :param resp: HTTP response object from request, sent with ``stream=True``
+    :type resp: Response
+    :param chunk_size: Number of bytes to read at a time
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in resp.iter_content(chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def _literal_search(value):
+    """Return search function for a literal string"""
+    return lambda text: value in text
+
+
 class ValidationError(ValueError):
     """Validation error with extra data about validation failure"""
 
     def __init__(self, *args, **kwargs):
         self.mismatch = kwargs.pop("mismatch", None)
         super(ValidationError, self).__init__(*args, **kwargs)
+
+
+class ValidationTimeout(ValidationError):
+    """Validation error for a request that timed out
+
+    :param timeout: Request timeout, in seconds
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        msg = "Request timed out"
+        if timeout is not None:
+            msg = "Request timed out after {0:g}s".format(timeout)
+        super(ValidationTimeout, self).__init__(msg)
+
+    def __reduce__(self):
+        return (self.__class__, (self.timeout,))
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumented HTTP transport
+
+:py:cls:`TimingAdapter` is a requests transport adapter using urllib3
+connections that record how long each phase of a request takes: name
+resolution, TCP connect, TLS handshake, sending the request, waiting for the
+response headers and receiving the response body. The timings are attached to
+each response as a :py:cls:`RequestTiming` record.
+
+Host names are resolved by a :py:cls:`Resolver`, which caches addresses, and
+can pin host names to given addresses. Requests keep their URL, so the TLS
+server name and certificate checks are those of the host name, and connection
+pools are kept per host name.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+
+try:
+    from requests.packages.urllib3.connection import HTTPConnection
+    from requests.packages.urllib3.connection import HTTPSConnection
+    from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+    from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError
+except ImportError:
+    from urllib3.connection import HTTPConnection
+    from urllib3.connection import HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool
+    from urllib3.connectionpool import HTTPSConnectionPool
+    from urllib3.exceptions import ConnectTimeoutError
+
+
+# Request phases, in order
+PHASES = ("dns", "connect", "tls", "send", "wait", "receive")
+
+# Seconds to cache the resolved addresses of a host name
+RESOLVE_TTL = 60
+
+
+class RequestTiming(object):
+    """Timing of each phase of a request, in seconds
+
+    Phases that didn't happen, such as connecting on a reused connection, are
+    None.
+
+    :ivar dns: Host name resolution
+    :ivar connect: TCP connect
+    :ivar tls: TLS handshake
+    :ivar send: Sending the request
+    :ivar wait: Waiting for the response headers, after sending the request
+    :ivar receive: Receiving the response body, after the headers. For streamed
+        responses, this includes matching the body as it is received.
+    :ivar received: Response body bytes received, before decoding
+    :ivar reused: Whether the request was sent over a reused connection
+    """
+
+    __slots__ = PHASES + ("received", "reused", "_mark")
+
+    def __init__(self):
+        for phase in PHASES:
+            setattr(self, phase, None)
+        self.received = None
+        self.reused = True
+        self._mark = None
+
+    def __repr__(self):
+        """String representation of timing record"""
+        return "<RequestTiming {0}>".format(self)
+
+    def __str__(self):
+        """Timing summary, in milliseconds"""
+        parts = [
+            "{0} {1}".format(phase, "-" if value is None else "{0:.1f}ms".format(value * 1000))
+            for (phase, value) in ((phase, getattr(self, phase)) for phase in PHASES)
+        ]
+        if self.received is not None:
+            parts.append("{0} bytes".format(self.received))
+        if self.reused:
+            parts.append("reused connection")
+        return ", ".join(parts)
+
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def as_dict(self):
+        """Return timing record as a mapping, for serializing"""
+        timing = dict((phase, getattr(self, phase)) for phase in PHASES)
+        timing["received"] = self.received
+        timing["reused"] = self.reused
+        return timing
+
+    def finish(self, received=None):
+        """Record the end of the response body
+
+        :param received: Response body bytes received
+        """
+        if self._mark is not None:
+            self.receive = time.monotonic() - self._mark
+            self._mark = None
+        self.received = received
+
+
+def finish_timing(resp):
+    """Record the end of the response body on the timing record of a response
+
+    Responses without a timing record, or already finished, are left as is.
+
+    :param resp: HTTP response object
+    :type resp: Response
+    """
+    timing = getattr(resp, "timing", None)
+    if timing is None or timing.receive is not None:
+        return
+    received = None
+    if hasattr(resp.raw, "tell"):
+        received = resp.raw.tell()
+    timing.finish(received)
+
+
+class TimingConnectionMixin(object):
+    """Record phase timings on a urllib3 connection
+
+    Name resolution is split out of connecting, by resolving the host first
+    and connecting to each resolved address in turn, as urllib3 does.
+    """
+
+    tls = False
+    timing = None
+    # Resolver of the adapter the connection belongs to
+    resolver = None
+    # Timings of the latest connect, consumed by the next request
+    _connect_timing = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        start = time.monotonic()
+        try:
+            if self.resolver is not None:
+                addresses = self.resolver.resolve(host, self.port)
+            else:
+                addresses = resolve(host, self.port)
+        except socket.gaierror:
+            # Let urllib3 raise its own name resolution error
+            return super(TimingConnectionMixin, self)._new_conn()
+        resolved = time.monotonic()
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    sock = super(TimingConnectionMixin, self)._new_conn()
+                    break
+                except ConnectTimeoutError as exc:
+                    error = exc
+            else:
+                raise error
+        finally:
+            self._dns_host = host
+        connected = time.monotonic()
+        self._connect_timing = {
+            "dns": resolved - start,
+            "connect": connected - resolved,
+            "tls": None,
+            "end": connected,
+        }
+        return sock
+
+    def connect(self):
+        super(TimingConnectionMixin, self).connect()
+        if self.tls and self._connect_timing is not None:
+            end = time.monotonic()
+            self._connect_timing["tls"] = end - self._connect_timing["end"]
+            self._connect_timing["end"] = end
+
+    def request(self, *args, **kwargs):
+        timing = self.timing = RequestTiming()
+        start = time.monotonic()
+        super(TimingConnectionMixin, self).request(*args, **kwargs)
+        sent = time.monotonic()
+        connect_timing = self._connect_timing
+        self._connect_timing = None
+        if connect_timing is not None:
+            timing.reused = False
+            timing.dns = connect_timing["dns"]
+            timing.connect = connect_timing["connect"]
+            timing.tls = connect_timing["tls"]
+            # Plain connections connect while sending the request
+            start = max(start, connect_timing["end"])
+        timing.send = sent - start
+        timing._mark = sent
+
+    def getresponse(self, *args, **kwargs):
+        response = super(TimingConnectionMixin, self).getresponse(*args, **kwargs)
+        timing = self.timing
+        self.timing = None
+        if timing is not None:
+            now = time.monotonic()
+            timing.wait = now - timing._mark
+            timing._mark = now
+        response.timing = timing
+        return response
+
+
+class TimingHTTPConnection(TimingConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimingHTTPSConnection(TimingConnectionMixin, HTTPSConnection):
+    tls = True
+
+
+class TimingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimingHTTPConnection
+
+
+class TimingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimingHTTPSConnection
+
+
+class TimingAdapter(HTTPAdapter):
+    """Transport adapter recording request phase timings
+
+    Responses have a ``timing`` attribute, holding a :py:cls:`RequestTiming`
+    record. The response body timing is only recorded once
+    :py:func:`finish_timing` is called, after the body is read.
+
+    HTTPS requests sent to a host address, with the host name in the ``Host``
+    header, use the host name for the TLS server name and certificate checks.
+
+    :param resolver: Resolver for host names, shared between adapters. Without
+        a resolver, host names are resolved on every new connection.
+    :type resolver: Resolver
+    """
+
+    def __init__(self, resolver=None, **kwargs):
+        # Set before the pool manager is created by the base adapter
+        self.resolver = resolver
+        super(TimingAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": get_pool_class(TimingHTTPConnectionPool, self.resolver),
+            "https": get_pool_class(TimingHTTPSConnectionPool, self.resolver),
+        }
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        (host_params, pool_kwargs) = super(
+            TimingAdapter, self
+        ).build_connection_pool_key_attributes(request, verify, cert)
+        server_name = request.headers.get("Host")
+        if host_params["scheme"] == "https" and server_name and server_name != host_params["host"]:
+            pool_kwargs["server_hostname"] = server_name
+            if verify:
+                pool_kwargs["assert_hostname"] = server_name
+        return (host_params, pool_kwargs)
+
+    def build_response(self, req, resp):
+        response = super(TimingAdapter, self).build_response(req, resp)
+        response.timing = getattr(resp, "timing", None)
+        return response
+
+
+def get_pool_class(pool_class, resolver):
+    """Return connection pool class with connections resolving host names with resolver"""
+    if resolver is None:
+        return pool_class
+    connection_class = type(
+        pool_class.ConnectionCls.__name__, (pool_class.ConnectionCls,), {"resolver": resolver}
+    )
+    return type(pool_class.__name__, (pool_class,), {"ConnectionCls": connection_class})
+
+
+class Resolver(object):
+    """Host name resolver, with pinned addresses and a cache
+
+    Pinned host names and ports always resolve to the given addresses, as
+    with curl's ``--resolve``. Other host names are resolved with
+    :py:func:`resolve`, and the addresses are kept for ``ttl`` seconds, so
+    that new connections to the same host don't wait on name resolution.
+    Failed lookups are not cached.
+
+    :param pinned: Mapping of host name and port to a list of addresses
+    :param ttl: Seconds to keep resolved addresses, 0 to resolve every time
+    :param clock: Monotonic clock function, in seconds
+    """
+
+    def __init__(self, pinned=None, ttl=RESOLVE_TTL, clock=time.monotonic):
+        self.pinned = dict(
+            ((host.lower(), int(port)), list(addresses))
+            for ((host, port), addresses) in (pinned or {}).items()
+        )
+        self.ttl = ttl
+        self.clock = clock
+        self.cache = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """Return addresses to connect to for host name and port
+
+        :raises socket.gaierror: If the host name can't be resolved
+        """
+        key = (host.lower(), int(port))
+        addresses = self.pinned.get(key)
+        if addresses is not None:
+            return addresses
+        if not self.ttl:
+            return resolve(host, port)
+        now = self.clock()
+        with self._lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        addresses = resolve(host, port)
+        with self._lock:
+            self.cache[key] = (now + self.ttl, addresses)
+        return addresses
+
+
+def parse_resolve(value):
+    """Parse pinned host address in curl's ``host:port:addr[,addr]`` form
+
+    IPv6 addresses can be given in brackets.
+
+    :returns: Tuple of host name and port, and list of addresses
+    """
+    try:
+        (host, port, addresses) = value.split(":", 2)
+        port = int(port)
+    except ValueError:
+        raise ValueError("Invalid resolve entry: {0}".format(value))
+    addresses = [address.strip().strip("[]") for address in addresses.split(",")]
+    if not host or not all(addresses):
+        raise ValueError("Invalid resolve entry: {0}".format(value))
+    return ((host, port), addresses)
+
+
+def resolve(host, port):
+    """Resolve host name to a list of addresses, without duplicates"""
+    addresses = []
+    for _, _, _, _, sockaddr in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        if sockaddr[0] not in addresses:
+            addresses.append(sockaddr[0])
+    return addresses
@@ -10,12 +10,26 @@ comparing the given responses to rulesets loaded by the rule spec.
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import copy
+import functools
+import inspect
+import math
 import os.path
-import pprint
+import pickle
+import time
+import zlib
+from collections import OrderedDict
+from collections import deque
+from queue import LifoQueue
 
 from requests import Session
+from requests.compat import urlsplit
+from requests.exceptions import ChunkedEncodingError
 from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
+from requests.exceptions import ContentDecodingError
 from requests.exceptions import SSLError
+from requests.exceptions import Timeout
 
 
 try:
@@ -23,9 +37,40 @@ try:
 except ImportError:
     import urllib3
 
+from .schedule import ADAPTIVE_CONCURRENCY
+from .schedule import HedgeDelay
+from .schedule import Scheduler
+from .schedule import get_backoff
+from .spec import JsonLinesValidatorSpec
 from .spec import JsonValidatorSpec
 from .spec import ValidationError
+from .spec import ValidationTimeout
 from .spec import YamlValidatorSpec
+from .transport import Resolver
+from .transport import TimingAdapter
+from .transport import finish_timing
+
+
+# Largest unread response body, in bytes, to discard to keep a connection alive
+DRAIN_LIMIT = 64 * 1024
+
+# Seconds to wait for the server to respond, for rules without a timeout
+DEFAULT_TIMEOUT = 30
+
+# Longest mismatch value kept on compact results, in characters
+MISMATCH_LIMIT = 1024
+
+# Seconds to wait before the first retry of a request, before jitter
+RETRY_BACKOFF = 0.1
+
+# Methods that can be sent again after a connection error
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"])
+
+# Methods that can be sent twice at once, for hedging
+SAFE_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# Errors sending a request, or reading a response body that isn't streamed
+SEND_ERRORS = (ConnectionError, ChunkedEncodingError, ContentDecodingError, SSLError, Timeout)
 
 
 class Validator(object):
@@ -35,14 +80,141 @@ class Validator(object):
     :type spec: ValidatorSpec
     :param host: Host address to perform requests against
     :param port: Host port to perform requests against
+    :param concurrency: Number of requests to keep in flight at once, defaults
+        to one request per host
+    :param ordered: Yield results in spec order, instead of completion order
+    :param hosts: List of host addresses, optionally in ``host:port`` form, to
+        run every rule against. This overrides ``host``.
+    :param stream: Stream response bodies, matching content chunk by chunk
+        instead of reading whole bodies into memory
+    :param head: Send ``HEAD`` instead of ``GET`` requests for rules that only
+        test the response status and headers
+    :param shard: Only run rules in this shard, as a tuple of shard number,
+        starting at 1, and number of shards
+    :param processes: Number of worker processes to fork, each running a
+        shard of the rules
+    :param dedupe: Group rules sending the same request, and send the request
+        once for the whole group
+    :param cache_responses: Keep responses for the duration of a run, and
+        reuse them for later rules sending the same request. Cached responses
+        are always read in full.
+    :param timeout: Seconds to wait for the server to connect and respond, for
+        rules without a timeout of their own, or None to wait indefinitely
+    :param max_rps: Highest rate of requests per second to each host
+    :param adaptive: Adjust the number of requests in flight to each host to
+        the observed latency and error rate, up to ``concurrency``. The
+        default concurrency in adaptive mode is
+        :py:data:`~validatehttp.schedule.ADAPTIVE_CONCURRENCY` per host.
+    :param keep_responses: Keep request and response objects on results. By
+        default, results only keep the response status, timings and size, and
+        responses are freed as soon as they are matched. Always set in debug
+        mode.
+    :param max_failures: Stop validating after this many failed results
+    :param deadline: Seconds to validate for. Once the deadline passes, no new
+        requests are sent, and requests in flight are given the remaining
+        time to complete.
+    :param history_file: File to keep the run history of each rule in, see
+        :py:cls:`~validatehttp.history.RunHistory`
+    :param order: Order to run rules in, either ``spec`` for spec order, or
+        ``history`` to run rules that failed on their last run first, then
+        the slowest rules, using the run history. Rules of lazily loaded
+        specs are always run in spec order.
+    :param revalidate: Keep the entity tag of each response, and send
+        conditional requests when the same rules are run again, reusing the
+        earlier results if the response was not modified
+    :param resolve: Mapping of host name and port to a list of addresses to
+        connect to, instead of resolving the host name. Requests keep their
+        URL, so the TLS server name and certificate checks are those of the
+        host name. Other host names are resolved once, and the addresses are
+        cached, see :py:cls:`~validatehttp.transport.Resolver`.
+    :param retries: Number of times to retry requests that fail to connect, or
+        lose their connection before a response, see :py:func:`is_retryable`
+    :param retry_backoff: Seconds to wait before the first retry, doubling
+        with each retry, see :py:func:`~validatehttp.schedule.get_backoff`
+    :param hedge: Send a duplicate of requests that take longer than the 95th
+        percentile latency of the run so far, and use whichever response
+        arrives first. Only ``GET``, ``HEAD`` and ``OPTIONS`` requests are
+        hedged.
     """
 
-    def __init__(self, spec, host=None, port=None, verify=True, debug=False):
+    def __init__(
+        self,
+        spec,
+        host=None,
+        port=None,
+        verify=True,
+        debug=False,
+        concurrency=None,
+        ordered=True,
+        hosts=None,
+        stream=False,
+        head=False,
+        shard=None,
+        processes=None,
+        dedupe=True,
+        cache_responses=False,
+        timeout=DEFAULT_TIMEOUT,
+        max_rps=None,
+        adaptive=False,
+        keep_responses=False,
+        max_failures=None,
+        deadline=None,
+        history_file=None,
+        order="spec",
+        revalidate=False,
+        resolve=None,
+        retries=0,
+        retry_backoff=RETRY_BACKOFF,
+        hedge=False,
+    ):
         self.spec = spec
         self.host = host
         self.port = port
         self.verify = verify
         self.debug = debug
+        if hosts:
+            self.targets = [parse_host(value, port) for value in hosts]
+        else:
+            self.targets = [(host, port)]
+        if adaptive and not concurrency:
+            concurrency = ADAPTIVE_CONCURRENCY * len(self.targets)
+        self.concurrency = max(int(concurrency or len(self.targets)), 1)
+        self.ordered = ordered
+        self.stream = stream
+        self.head = head
+        self.shard = shard
+        self.processes = max(int(processes or 1), 1)
+        self.dedupe = dedupe
+        self.response_cache = {} if cache_responses else None
+        self.timeout = timeout
+        self.keep_responses = keep_responses or debug
+        self.max_failures = max_failures
+        self.deadline = deadline
+        # Reason the last run stopped early, and its failure count
+        self.stopped = None
+        self.failures = 0
+        self._deadline_at = None
+        self.history = None
+        if history_file:
+            from .history import RunHistory
+
+            self.history = RunHistory(history_file)
+        self.order = order
+        self._record_history = True
+        # Entity tags of responses, by request key, host and port, with the
+        # results of the rules matched against them
+        self.etags = {} if revalidate else None
+        # Shared by the sessions of all workers
+        self.resolver = Resolver(resolve)
+        self.retries = max(int(retries or 0), 0)
+        self.retry_backoff = retry_backoff
+        self.hedge_delay = HedgeDelay() if hedge else None
+        self._hedge_executor = None
+        self.scheduler = None
+        if max_rps or adaptive:
+            self.scheduler = Scheduler(max_rps, adaptive, self.concurrency)
+        self._sessions = LifoQueue()
+        self._executor = None
 
     def __repr__(self):
         """String representation of validator instance"""
@@ -50,17 +222,30 @@ class Validator(object):
 
     @classmethod
     def load(cls, spec_file, *args, **kwargs):
-        """Load spec from file and return an validator instance"""
+        """Load spec from file and return an validator instance
+
+        :param cache_dir: Directory to cache parsed spec files in
+        :param lazy: Parse spec file incrementally, while validating
+        """
+        spec = cls.load_spec(
+            spec_file, cache_dir=kwargs.pop("cache_dir", None), lazy=kwargs.pop("lazy", False)
+        )
+        return cls(spec, *args, **kwargs)
+
+    @staticmethod
+    def load_spec(spec_file, cache_dir=None, lazy=False):
+        """Load spec from file, using the spec class for the file type"""
         (_, fileext) = os.path.splitext(spec_file)
         spec_class = None
         if fileext.lower() == ".json":
             spec_class = JsonValidatorSpec
+        elif fileext.lower() == ".jsonl":
+            spec_class = JsonLinesValidatorSpec
         elif fileext.lower() == ".yaml":
             spec_class = YamlValidatorSpec
         else:
             raise ValueError("Unsupported file type")
-        spec = spec_class.load(spec_file)
-        return cls(spec, *args, **kwargs)
+        return spec_class.load(spec_file, cache_dir=cache_dir, lazy=lazy)
 
     def validate(self):
         """Run validation using HTTP requests against validation host
@@ -69,48 +254,858 @@ class Validator(object):
         for each rule. Request response is verified to match the spec respsonse
         rule.  This will yield either a :py:cls:`ValidationPass` or
         :py:cls:`ValidationFail` response.
+
+        With a concurrency above 1, requests are dispatched on a bounded
+        thread pool, and results are yielded in spec order or, if the
+        validator is not ordered, as soon as each request completes. With
+        multiple hosts, each rule is run against every host before moving on
+        to the next rule. With several processes, see :py:meth:`fork`.
+
+        Results of rules that didn't send a request of their own, as they
+        shared the response of another rule, are marked as ``shared``.
+
+        Validation stops early after :py:attr:`max_failures` failed results, or
+        once :py:attr:`deadline` passes, setting :py:attr:`stopped` to
+        ``"max_failures"`` or ``"deadline"``.
         """
-        session = Session()
         if not self.verify and hasattr(urllib3, "disable_warnings"):
             urllib3.disable_warnings()
-        for rule in self.spec.get_rules():
-            req = rule.get_request(self.host, self.port)
+        self.start_run()
+        if self.response_cache is not None:
+            self.response_cache.clear()
+        try:
+            if self.hedge_delay is not None and self.processes == 1:
+                # Created before requests are dispatched to worker threads
+                self.get_hedge_executor()
+            if self.processes > 1:
+                results = self.fork()
+            elif self.concurrency == 1:
+                results = (
+                    result
+                    for rules, host, port in self.get_jobs()
+                    for result in self.check_group(rules, host, port)
+                )
+            else:
+                results = self._dispatch(self.get_jobs())
+            for result in results:
+                yield result
+                if self.add_result(result):
+                    # Closing the results cancels requests not yet sent
+                    results.close()
+                    return
+        finally:
+            self.finish_run()
+            if self.response_cache is not None:
+                self.response_cache.clear()
+
+    def start_run(self):
+        """Reset early stop state, at the start of a run"""
+        self.stopped = None
+        self.failures = 0
+        self._deadline_at = None
+        if self.deadline:
+            self._deadline_at = time.monotonic() + self.deadline
+        if self.history is not None:
+            self.history.load()
+        if self.hedge_delay is not None:
+            self.hedge_delay.reset()
+
+    def finish_run(self):
+        """Save the run history, at the end of a run"""
+        self._deadline_at = None
+        if self.history is not None and self._record_history:
+            self.history.save()
+
+    def add_result(self, result):
+        """Count a result towards :py:attr:`max_failures`, and add it to the run history
+
+        :returns: True if validation should stop
+        """
+        if self.history is not None and self._record_history:
+            self.history.add(result.rule, isinstance(result, ValidationFail), result.elapsed)
+        if isinstance(result, ValidationFail):
+            self.failures += 1
+            if self.max_failures and self.failures >= self.max_failures:
+                self.stopped = "max_failures"
+                return True
+        return False
+
+    def is_stopped(self):
+        """Return whether no new requests should be sent"""
+        if self.stopped is None and self.get_remaining() == 0:
+            self.stopped = "deadline"
+        return self.stopped is not None
+
+    def get_remaining(self):
+        """Return seconds left until the deadline, or None without a deadline"""
+        if self._deadline_at is None:
+            return None
+        return max(self._deadline_at - time.monotonic(), 0)
+
+    def get_jobs(self):
+        """Yield groups of spec rules in the shard, paired with each target host and port
+
+        With :py:attr:`dedupe` set, rules sending the same request are grouped
+        together, in the position of the first rule of the group. Rules of
+        lazily loaded specs are not grouped, as the whole spec is never held in
+        memory. Groups are sorted by the run history in ``history`` order.
+        """
+        rules = (
+            rule
+            for rule in self.spec.get_rules()
+            if self.shard is None or in_shard(rule.uri, *self.shard)
+        )
+        if self.dedupe and self.spec.rules is not None:
+            groups = OrderedDict()
+            for rule in rules:
+                groups.setdefault(rule.request_key(), []).append(rule)
+            rules_groups = groups.values()
+        else:
+            rules_groups = ([rule] for rule in rules)
+        if self.order == "history" and self.history is not None and self.spec.rules is not None:
+            history = self.history
+            rules_groups = sorted(
+                rules_groups, key=lambda group: min(history.get_priority(rule) for rule in group)
+            )
+        for group in rules_groups:
+            for host, port in self.targets:
+                if self.is_stopped():
+                    return
+                yield (group, host, port)
+
+    def check(self, rule, host=None, port=None):
+        """Perform request for a single rule and return the validation result
+
+        :param rule: Spec rule to request and validate
+        :type rule: ValidatorSpecRule
+        :param host: Host address to perform request against
+        :param port: Host port to perform request against
+        """
+        return self.check_group([rule], host, port)[0]
+
+    def check_group(self, rules, host=None, port=None):
+        """Perform one request for a group of rules and return their results
+
+        :param rules: Spec rules sending the same request
+        :type rules: list
+        :param host: Host address to perform request against
+        :param port: Host port to perform request against
+        """
+        if self.get_remaining() == 0:
+            # Queued before the deadline passed
+            return []
+        compiled = [rule.compile() for rule in rules]
+        needs_body = any(compiled_rule.needs_body for compiled_rule in compiled)
+        timeout = self.get_timeout(rules)
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = (rules[0].request_key(), host, port)
+        # Rules without body assertions only wait for the response headers. A
+        # streamed body can only be matched once, so bodies of shared and
+        # cached responses are read in full
+        stream = not needs_body or (self.stream and len(rules) == 1)
+        if cache_key is not None:
+            stream = False
+        session = self.get_session()
+        try:
+            req = compiled[0].prepare(host, port)
+            if self.head and not needs_body and req.method == "GET" and cache_key is None:
+                req.method = "HEAD"
+            revalidate = self.get_revalidation(rules, host, port)
+            if revalidate is not None:
+                req.headers["If-None-Match"] = revalidate[0]
             if self.debug:
-                pprint.pprint(req.__dict__)
+                self.debug_print(req)
+            resp = None
+            attempts = 1
+            if cache_key is not None:
+                resp = self.response_cache.get(cache_key)
+            shared = resp is not None
+            if resp is None:
+                (resp, error, attempts, session) = self.fetch(session, req, stream, timeout)
+                if resp is None:
+                    # No response yet
+                    error = get_timeout_error(error, timeout)
+                    return set_attempts(
+                        [
+                            ValidationFail(
+                                rule=rule,
+                                request=req,
+                                response=None,
+                                error=error,
+                                host=host,
+                                shared=n > 0,
+                                keep=self.keep_responses,
+                            )
+                            for (n, rule) in enumerate(rules)
+                        ],
+                        attempts,
+                    )
+                if not stream:
+                    finish_timing(resp)
+                if cache_key is not None:
+                    self.response_cache[cache_key] = resp
             try:
-                resp = session.send(req.prepare(), allow_redirects=False, verify=self.verify)
                 if self.debug:
-                    pprint.pprint(resp.__dict__)
-                if rule.matches(resp):
-                    yield ValidationPass(rule=rule, request=req, response=resp)
-            except (ConnectionError, SSLError) as exc:
-                # No response yet
-                yield ValidationFail(rule=rule, request=req, response=None, error=exc)
-            except ValidationError as exc:
-                # Response received, validation error
-                yield ValidationFail(rule=rule, request=req, response=resp, error=exc)
+                    self.debug_print(resp)
+                if revalidate is not None and resp.status_code == 304:
+                    return set_attempts(
+                        [
+                            result.revalidate(resp, shared or n > 0)
+                            for (n, result) in enumerate(revalidate[1])
+                        ],
+                        attempts,
+                    )
+                results = [
+                    self._match(
+                        rule, compiled_rule, req, resp, stream, host, shared or n > 0, timeout
+                    )
+                    for (n, (rule, compiled_rule)) in enumerate(zip(rules, compiled))
+                ]
+                set_attempts(results, attempts)
+                if self.etags is not None and resp.headers.get("ETag"):
+                    self.etags[(rules[0].request_key(), host, port)] = (
+                        resp.headers["ETag"],
+                        results,
+                    )
+                return results
+            finally:
+                if stream:
+                    release_response(resp)
+                    finish_timing(resp)
+        finally:
+            self.put_session(session)
+
+    def get_revalidation(self, rules, host, port):
+        """Return entity tag and results of the last response to a group of rules
+
+        Only responses matched against the same rules are revalidated, as the
+        results are reused as they are when the response is not modified.
+        Rules are compared by content, so rules reloaded from a spec file are
+        revalidated.
+
+        :returns: Tuple of entity tag and results, or None if the request
+            can't be revalidated
+        """
+        if self.etags is None:
+            return None
+        from .history import get_rule_key
+
+        revalidate = self.etags.get((rules[0].request_key(), host, port))
+        if revalidate is None:
+            return None
+        if [get_rule_key(result.rule) for result in revalidate[1]] != [
+            get_rule_key(rule) for rule in rules
+        ]:
+            return None
+        return revalidate
+
+    @staticmethod
+    def debug_print(obj):
+        """Print attributes of a request or response, in debug mode"""
+        import pprint
+
+        pprint.pprint(obj.__dict__)
+
+    def get_timeout(self, rules):
+        """Return timeout for a request shared by a group of rules
+
+        This is the longest timeout of the rules, rules without a timeout use
+        the validator timeout. With a deadline, the timeout is capped to the
+        time remaining.
+        """
+        timeouts = [self.timeout if rule.timeout is None else rule.timeout for rule in rules]
+        timeout = None
+        if None not in timeouts:
+            timeout = max(timeouts)
+        remaining = self.get_remaining()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            # A zero timeout would be taken as no timeout
+            timeout = max(remaining, 0.001)
+        return timeout
+
+    def fetch(self, session, req, stream=False, timeout=None):
+        """Send request, retrying connection errors and hedging slow requests
+
+        Failed requests are retried up to :py:attr:`retries` times, if
+        :py:func:`is_retryable`, waiting longer before each retry. Retries
+        are not sent past the deadline.
+
+        :param session: Session to send the request over
+        :type session: Session
+        :param req: Request to send
+        :type req: requests.PreparedRequest
+        :param stream: Return as soon as the response headers are received
+        :param timeout: Seconds to wait for the server to connect and respond
+        :returns: Tuple of the response, or None if every attempt failed, the
+            error of the last attempt, the number of requests sent, and the
+            session to return to the pool, see :py:meth:`send_hedged`
+        """
+        attempts = 0
+        retry = 0
+        while True:
+            (resp, error, sent, session) = self.send_hedged(session, req, stream, timeout)
+            attempts += sent
+            if resp is not None or retry >= self.retries or not is_retryable(error, req.method):
+                return (resp, error, attempts, session)
+            retry += 1
+            delay = get_backoff(retry, self.retry_backoff)
+            remaining = self.get_remaining()
+            if remaining is not None:
+                if delay >= remaining:
+                    return (resp, error, attempts, session)
+                timeout = min(timeout or remaining, remaining - delay)
+            time.sleep(delay)
+
+    def send_hedged(self, session, req, stream=False, timeout=None):
+        """Send request, and a duplicate request if the response is slow
+
+        With hedging, requests that take longer than the hedging delay are
+        sent again over another session, and the first response wins. The
+        losing request runs on in the background, then its response is
+        released and its session is returned to the pool.
+
+        :returns: Tuple of the response, or None if the request failed, the
+            error, the number of requests sent, and the session to return to
+            the pool. This is the session of the winning request, which isn't
+            ``session`` if the duplicate request won.
+        """
+        delay = None
+        if self.hedge_delay is not None and req.method in SAFE_METHODS:
+            delay = self.hedge_delay.get()
+        start = time.monotonic()
+        if delay is None:
+            try:
+                resp = self.send(session, req, stream, timeout)
+            except SEND_ERRORS as exc:
+                return (None, exc, 1, session)
+            if self.hedge_delay is not None:
+                self.hedge_delay.add(time.monotonic() - start)
+            return (resp, None, 1, session)
+
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import wait
+
+        executor = self.get_hedge_executor()
+        primary = executor.submit(self.send, session, req, stream, timeout)
+        (done, _) = wait([primary], timeout=delay)
+        futures = [primary]
+        sessions = {primary: session}
+        if not done:
+            hedge_session = self.get_session()
+            hedge = executor.submit(self.send, hedge_session, req.copy(), stream, timeout)
+            futures.append(hedge)
+            sessions[hedge] = hedge_session
+        winner = None
+        pending = set(futures)
+        while pending and winner is None:
+            (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in futures:
+                if future in done and winner is None and future.exception() is None:
+                    winner = future
+        if winner is None:
+            # Every request failed, the primary session is returned by the caller
+            for future in futures[1:]:
+                self.put_session(sessions[future])
+            error = primary.exception()
+            if not isinstance(error, SEND_ERRORS):
+                raise error
+            return (None, error, len(futures), session)
+        for future in futures:
+            if future is not winner:
+                future.add_done_callback(functools.partial(self._discard, sessions[future]))
+        self.hedge_delay.add(time.monotonic() - start)
+        return (winner.result(), None, len(futures), sessions[winner])
+
+    def _discard(self, session, future):
+        """Release the response of a losing hedged request, and return its session"""
+        if future.exception() is None:
+            release_response(future.result())
+        self.put_session(session)
+
+    def get_hedge_executor(self):
+        """Return thread pool sending hedged requests, creating it on first use"""
+        if self._hedge_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # Each worker waits on two requests, and losing requests run on
+            # until they complete
+            self._hedge_executor = ThreadPoolExecutor(max_workers=self.concurrency * 4)
+        return self._hedge_executor
+
+    def send(self, session, req, stream=False, timeout=None):
+        """Send request over session, paced by the scheduler
+
+        :param session: Session to send the request over
+        :type session: Session
+        :param req: Request to send
+        :type req: requests.PreparedRequest
+        :param stream: Return as soon as the response headers are received
+        :param timeout: Seconds to wait for the server to connect and respond
+        """
+        kwargs = {
+            "allow_redirects": False,
+            "verify": self.verify,
+            "stream": stream,
+            "timeout": timeout,
+        }
+        if self.scheduler is None:
+            return session.send(req, **kwargs)
+        netloc = urlsplit(req.url).netloc
+        self.scheduler.acquire(netloc)
+        resp = None
+        try:
+            resp = session.send(req, **kwargs)
+        finally:
+            if resp is None:
+                self.scheduler.release(netloc, ok=False)
+            else:
+                self.scheduler.release(
+                    netloc, resp.elapsed.total_seconds(), ok=resp.status_code < 500
+                )
+        return resp
+
+    def _match(self, rule, compiled, req, resp, stream, host, shared, timeout=None):
+        """Match response against a compiled rule and return the validation result"""
+        try:
+            if compiled.matches(resp, stream=stream):
+                return ValidationPass(
+                    rule=rule,
+                    request=req,
+                    response=resp,
+                    host=host,
+                    shared=shared,
+                    keep=self.keep_responses,
+                )
+        except (
+            ValidationError,
+            ConnectionError,
+            ChunkedEncodingError,
+            ContentDecodingError,
+            LookupError,
+        ) as exc:
+            # Response received, validation error or error reading or decoding body
+            return ValidationFail(
+                rule=rule,
+                request=req,
+                response=resp,
+                error=get_timeout_error(exc, timeout),
+                host=host,
+                shared=shared,
+                keep=self.keep_responses,
+            )
+
+    def get_session(self):
+        """Take an idle session from the pool, or create a new one
+
+        Sessions are handed out to one worker at a time, so each worker has a
+        private connection pool, kept warm between runs of this validator.
+        """
+        if not self._sessions.empty():
+            return self._sessions.get_nowait()
+        session = Session()
+        # Keep a pool per target host, so connections stay alive across hosts
+        adapter = TimingAdapter(
+            resolver=self.resolver, pool_connections=max(len(self.targets), 10), pool_maxsize=1
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def put_session(self, session):
+        """Return session to the pool of idle sessions"""
+        self._sessions.put_nowait(session)
+
+    def close(self):
+        """Shut down worker threads and close pooled connections"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=True)
+            self._hedge_executor = None
+        while not self._sessions.empty():
+            self._sessions.get_nowait().close()
+
+    def fork(self):
+        """Run validation on forked worker processes, and merge their results
+
+        Each worker runs its own shard of the rules, splitting the shard of
+        this validator further if it has one. Results are yielded in
+        completion order across workers, without their responses.
+        """
+        import multiprocessing
+        from multiprocessing.connection import wait as wait_connections
+
+        context = multiprocessing.get_context("fork")
+        (index, count) = self.shard or (1, 1)
+        workers = {}
+        for number in range(self.processes):
+            (reader, writer) = context.Pipe(duplex=False)
+            shard = (index + count * number, count * self.processes)
+            process = context.Process(target=self._run_worker, args=(shard, writer, number == 0))
+            process.daemon = True
+            process.start()
+            writer.close()
+            workers[reader] = process
+        try:
+            while workers:
+                for reader in wait_connections(list(workers)):
+                    try:
+                        (kind, data) = reader.recv()
+                    except EOFError:
+                        process = workers.pop(reader)
+                        process.join()
+                        reader.close()
+                        if process.exitcode != 0:
+                            raise RuntimeError(
+                                "Validation worker exited with code {0}".format(process.exitcode)
+                            )
+                        continue
+                    if kind == "result":
+                        yield data
+                    elif kind == "errors":
+                        self.spec.errors = data
+        finally:
+            for reader, process in workers.items():
+                process.terminate()
+                process.join()
+                reader.close()
+
+    def _run_worker(self, shard, writer, send_errors):
+        """Validate a shard of the rules in a worker process
+
+        Results are sent to the parent process over ``writer``, followed by the
+        list of invalid spec rules if ``send_errors`` is set.
+        """
+        self.shard = shard
+        if self.scheduler is not None:
+            # Workers share the rate limit of each host
+            max_rps = self.scheduler.max_rps and self.scheduler.max_rps / self.processes
+            self.scheduler = Scheduler(max_rps, self.scheduler.adaptive, self.concurrency)
+        self.processes = 1
+        # The parent records the run history of the whole run
+        self._record_history = False
+        # Connections and threads of the parent are not usable after a fork
+        self._sessions = LifoQueue()
+        self._executor = None
+        self._hedge_executor = None
+        results = self.validate()
+        if inspect.isasyncgen(results):
+            from .aio import iterate
+
+            results = iterate(results)
+        for result in results:
+            try:
+                writer.send(("result", result))
+            except (pickle.PicklingError, TypeError, AttributeError):
+                # Some errors hold objects that can't be pickled, keep the message
+                result.error = ValidationError(str(result.error))
+                writer.send(("result", result))
+        self.close()
+        if send_errors:
+            writer.send(("errors", list(self.spec.errors)))
+        writer.close()
+
+    def _dispatch(self, jobs):
+        """Run checks on the worker pool, with a bounded number of pending rules"""
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        window = self.concurrency * 2
+        pending = deque()
+        try:
+            for rules, host, port in jobs:
+                pending.append(self._executor.submit(self.check_group, rules, host, port))
+                if len(pending) >= window:
+                    for results in self._collect(pending):
+                        for result in results:
+                            yield result
+            while pending:
+                for results in self._collect(pending):
+                    for result in results:
+                        yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _collect(self, pending):
+        """Wait for pending checks and pop finished result lists off the queue"""
+        if self.ordered:
+            yield pending.popleft().result()
+            return
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import wait
+
+        (done, _) = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            yield future.result()
+
+
+def is_retryable(error, method):
+    """Test whether a request can be retried after an error
+
+    Requests that timed out connecting were never sent, and can be retried
+    whatever their method. Requests that failed to connect otherwise, or lost
+    their connection before a complete response, can be retried if they are
+    idempotent. Requests that timed out waiting for the response are not
+    retried, as the retry would likely time out as well, and neither are TLS
+    errors, which don't go away on their own.
+
+    :param error: Request error
+    :param method: Request method
+    """
+    if isinstance(error, ConnectTimeout):
+        return True
+    if isinstance(error, (SSLError, Timeout)) or not isinstance(error, SEND_ERRORS):
+        return False
+    if isinstance(get_timeout_error(error, None), ValidationTimeout):
+        # Timed out reading the response
+        return False
+    return method in IDEMPOTENT_METHODS
+
+
+def set_attempts(results, attempts):
+    """Set number of requests sent on each result, and return the results"""
+    for result in results:
+        result.attempts = attempts
+    return results
+
+
+def release_response(resp, drain_limit=DRAIN_LIMIT):
+    """Release connection of a streamed response back to the pool
+
+    Small or empty unread bodies are read and discarded, so the connection is
+    kept alive for the next request. Larger unread bodies are not downloaded,
+    the connection is closed instead, freeing its slot in the pool.
+
+    :param resp: HTTP response object, sent with ``stream=True``
+    :type resp: Response
+    :param drain_limit: Largest body size, in bytes, to read and discard
+    """
+    if resp.raw is None:
+        return
+    if not resp._content_consumed and hasattr(resp.raw, "drain_conn"):
+        length = resp.headers.get("content-length", "")
+        method = getattr(resp.request, "method", None)
+        if (
+            method == "HEAD"
+            or resp.status_code in (204, 304)
+            or (length.isdigit() and int(length) <= drain_limit)
+        ):
+            resp.raw.drain_conn()
+            resp._content_consumed = True
+    resp.close()
+
+
+def get_timeout_error(exc, timeout):
+    """Return :py:cls:`ValidationTimeout` for a timed out request, or the error
+
+    Timeouts reading the response body are raised as connection errors by
+    requests, these are detected from the underlying urllib3 error.
+
+    :param exc: Request error
+    :param timeout: Request timeout, in seconds
+    """
+    if isinstance(exc, Timeout) or any(
+        isinstance(arg, urllib3.exceptions.ReadTimeoutError) for arg in exc.args
+    ):
+        return ValidationTimeout(timeout)
+    return exc
+
+
+def parse_host(value, port=None):
+    """Split host address into host and port
+
+    :param value: Host address, optionally with a port as ``host:port``
+    :param port: Default port, when the address does not include one
+    :returns: Tuple of host and port
+    """
+    if value.startswith("["):
+        # IPv6 address, with or without port
+        (host, _, rest) = value[1:].partition("]")
+        if rest.startswith(":"):
+            port = rest[1:]
+        return (host, port)
+    if value.count(":") == 1:
+        (host, port) = value.split(":")
+        return (host, port)
+    return (value, port)
+
+
+def parse_shard(value):
+    """Parse shard in ``i/n`` form
+
+    :param value: Shard number, starting at 1, and number of shards
+    :returns: Tuple of shard number and number of shards
+    """
+    try:
+        (index, count) = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard: {0}".format(value))
+    if not 1 <= index <= count:
+        raise ValueError("Invalid shard: {0}".format(value))
+    return (index, count)
+
+
+def in_shard(uri, index, count):
+    """Test whether a rule URI belongs to shard ``index`` of ``count``
+
+    Rules are assigned to shards by a CRC32 hash of their URI, which is stable
+    across processes, machines and Python versions.
+    """
+    return (zlib.crc32(uri.encode("utf-8")) & 0xFFFFFFFF) % count == index - 1
+
+
+def get_percentiles(values, percents=(50, 95, 99)):
+    """Return nearest rank percentiles of values
+
+    :param values: List of values
+    :param percents: Percentiles to return
+    :returns: List of values at each percentile, or None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return [
+        values[max(int(math.ceil(percent * len(values) / 100.0)) - 1, 0)] for percent in percents
+    ]
+
+
+def compact_error(error, limit=MISMATCH_LIMIT):
+    """Drop references to the response from an error, in place
+
+    The error traceback is dropped, as its frames refer to the response, and
+    long text values of the error mismatch are truncated, as mismatches of
+    rules testing the whole response text would keep the body alive.
+    """
+    error.__traceback__ = None
+    mismatch = getattr(error, "mismatch", None)
+    if not isinstance(mismatch, tuple):
+        return
+    values = []
+    for value in mismatch:
+        if isinstance(value, str) and len(value) > limit:
+            value = value[:limit] + "..."
+        elif isinstance(value, bytes) and len(value) > limit:
+            value = value[:limit] + b"..."
+        values.append(value)
+    error.mismatch = tuple(values)
+
+
+def load_hosts(hosts_file):
+    """Load list of host addresses from file, one host per line
+
+    Blank lines and lines starting with ``#`` are ignored.
+    """
+    with open(hosts_file) as handle:
+        return [
+            line.strip() for line in handle if line.strip() and not line.strip().startswith("#")
+        ]
 
 
 class ValidationResult(object):
-    """Base for validation"""
+    """Base for validation
+
+    Results are compact records of the request outcome: the response status,
+    latency, phase timings and body size are kept, and the request and
+    response objects are dropped once the response is matched, so that their
+    bodies can be freed. With ``keep`` set, the request and response objects
+    are kept on the result, for debugging.
+
+    :param keep: Keep request and response objects on the result
+    """
+
+    __slots__ = (
+        "rule",
+        "request",
+        "response",
+        "verbose",
+        "host",
+        "shared",
+        "status",
+        "elapsed",
+        "timing",
+        "size",
+        "revalidated",
+        "attempts",
+    )
 
-    def __init__(self, rule, request, response, verbose=False):
+    def __init__(self, rule, request, response, verbose=False, host=None, shared=False, keep=False):
         self.rule = rule
-        self.request = request
-        self.response = response
+        self.request = request if keep else None
+        self.response = response if keep else None
         self.verbose = verbose
+        self.host = host
+        # Response was shared with another rule, no request was sent
+        self.shared = shared
+        # Response status, seconds taken to receive response headers, timing
+        # of each request phase and response body bytes received
+        self.status = None
+        self.elapsed = None
+        self.timing = None
+        self.size = None
+        if response is not None:
+            self.status = response.status_code
+            if response.elapsed is not None:
+                self.elapsed = response.elapsed.total_seconds()
+            self.timing = getattr(response, "timing", None)
+            if self.timing is not None:
+                self.size = self.timing.received
+            elif isinstance(getattr(response, "_content", None), bytes):
+                self.size = len(response._content)
+        # Result of an earlier response, reused as the response was not modified
+        self.revalidated = False
+        # Requests sent, counting retries and hedged requests
+        self.attempts = 1
+
+    def revalidate(self, response, shared=False):
+        """Return copy of result for a not modified response, with its latency
+
+        :param response: Not modified response to a conditional request
+        :param shared: Response was shared with another rule
+        """
+        result = copy.copy(self)
+        result.shared = shared
+        result.revalidated = True
+        result.elapsed = response.elapsed.total_seconds()
+        result.timing = getattr(response, "timing", None)
+        return result
+
+    def __getstate__(self):
+        """Pickled result, without the request and response"""
+        state = dict(
+            (key, getattr(self, key, None))
+            for cls in type(self).__mro__
+            for key in getattr(cls, "__slots__", ())
+        )
+        state["request"] = None
+        state["response"] = None
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
 
 
 class ValidationPass(ValidationResult):
     """Validation pass"""
 
-    pass
+    __slots__ = ()
 
 
 class ValidationFail(ValidationResult):
-    def __init__(self, rule, request, response, error, verbose=False):
+    __slots__ = ("error",)
+
+    def __init__(
+        self, rule, request, response, error, verbose=False, host=None, shared=False, keep=False
+    ):
+        if not keep:
+            compact_error(error)
         self.error = error
-        super(ValidationFail, self).__init__(rule, request, response, verbose)
+        super(ValidationFail, self).__init__(rule, request, response, verbose, host, shared, keep)
 
     def mismatch(self):
         try:
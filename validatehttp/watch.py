@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Watch a spec file, and validate rules as they change
+
+:py:cls:`SpecWatcher` keeps a validator, and its open connections, between
+runs. When the spec file changes, the new rules are compared to the rules of
+the last run, and only added or changed rules are validated again.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import time
+
+from .history import get_rule_key
+
+
+# Seconds between checks of the spec file modification time
+WATCH_INTERVAL = 0.1
+
+
+class SpecWatcher(object):
+    """Validate rules of a spec file as the file changes
+
+    :param cli: Command line interface to run the validator with
+    :type cli: ValidatorCLI
+    :param spec_file: Spec file path
+    :param cache_dir: Directory to cache parsed spec files in
+    :param revalidate: Also validate unchanged rules on each change, with
+        conditional requests where the last response had an entity tag
+    :param interval: Seconds between checks of the spec file
+    """
+
+    def __init__(self, cli, spec_file, cache_dir=None, revalidate=False, interval=WATCH_INTERVAL):
+        self.cli = cli
+        self.validator = cli.validator
+        self.spec_file = spec_file
+        self.cache_dir = cache_dir
+        self.revalidate = revalidate
+        self.interval = interval
+        self.mtime = None
+        self.keys = set()
+
+    def get_mtime(self):
+        """Return spec file modification time, or None if the file is missing"""
+        try:
+            return os.stat(self.spec_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def diff(self, spec):
+        """Return rules of spec to validate, and the number of unchanged and removed rules
+
+        Rules are compared by URI, request and response assertions.
+
+        :param spec: Newly loaded spec
+        :returns: Tuple of rules to validate, number of unchanged rules, and
+            number of removed rules
+        """
+        keys = set()
+        changed = []
+        unchanged = []
+        for rule in spec.get_rules():
+            key = get_rule_key(rule)
+            keys.add(key)
+            if key in self.keys:
+                unchanged.append(rule)
+            else:
+                changed.append(rule)
+        removed = len(self.keys - keys)
+        self.keys = keys
+        if self.revalidate:
+            changed.extend(unchanged)
+        return (changed, len(unchanged), removed)
+
+    def update(self):
+        """Reload the spec file, and validate changed rules
+
+        :returns: Status code of the run, or None if the spec could not be loaded
+        """
+        try:
+            spec = self.validator.load_spec(self.spec_file, cache_dir=self.cache_dir)
+        except Exception as exc:  # pylint: disable=broad-except
+            # The spec file may be saved part way, or have a syntax error
+            print("! Could not load spec: {0}".format(exc))
+            return None
+        (rules, unchanged, removed) = self.diff(spec)
+        print(
+            "Spec changed: {0} rules to validate, {1} unchanged, {2} removed".format(
+                len(rules), unchanged, removed
+            )
+        )
+        self.validator.spec = type(spec)(rules)
+        self.validator.spec.errors = spec.errors
+        return self.cli.run()
+
+    def run(self):
+        """Validate the whole spec, then validate changed rules on each change
+
+        Runs until interrupted.
+        """
+        self.mtime = self.get_mtime()
+        self.keys = set(get_rule_key(rule) for rule in self.validator.spec.get_rules())
+        self.cli.run()
+        print("Watching {0} for changes".format(self.spec_file))
+        while True:
+            time.sleep(self.interval)
+            mtime = self.get_mtime()
+            if mtime is None or mtime == self.mtime:
+                continue
+            self.mtime = mtime
+            print("")
+            self.update()